@@ -0,0 +1,13 @@
+# LIBTBX_SET_DISPATCHER_NAME yamtbx.benchmark
+"""
+(c) RIKEN 2015. All rights reserved. 
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+
+from yamtbx.dataproc.command_line import benchmark
+
+if __name__ == "__main__":
+    import sys
+    benchmark.run_from_args(sys.argv[1:])
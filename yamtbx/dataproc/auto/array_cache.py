@@ -0,0 +1,127 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Cache of merged (and reindexed) miller arrays read from files.
+
+An array is identified by the file (path, mtime and size), the reader
+function with its keyword arguments (e.g. d_min and min_ios) and the
+reindexing operator. Reindexed arrays are made from the cached original
+array and mapped to ASU, so each file is parsed only once.
+
+Arrays are kept in memory up to max_reflections in total. Least recently
+used arrays beyond the limit are pickled into spill_dir (created in tmp when
+needed) and read back when requested again.
+"""
+
+import os
+import shutil
+import tempfile
+import hashlib
+import collections
+import threading
+import cPickle as pickle
+from yamtbx.util.parsecache import file_stamp
+
+class MergedArrayCache:
+    def __init__(self, max_reflections=20000000, spill_dir=None):
+        self.max_reflections = max_reflections
+        self.spill_dir = spill_dir
+        self._spill_dir_created = False
+        self._data = collections.OrderedDict() # key -> array or None
+        self._spilled = set()
+        self._nref = 0
+        self._lock = threading.RLock()
+    # __init__()
+
+    def make_key(self, filename, reader, op=None, **kwds):
+        abspath = os.path.abspath(filename)
+        op_str = None if op is None or op.is_identity_op() else op.as_hkl()
+        return (abspath, file_stamp(abspath), reader.__module__, reader.__name__,
+                tuple(sorted(kwds.items())), op_str)
+    # make_key()
+
+    def get(self, filename, reader, op=None, **kwds):
+        """
+        Returns reader(filename, **kwds), reindexed by op and mapped to ASU if op is given.
+        reader() must return a merged miller array or None.
+        """
+        key = self.make_key(filename, reader, op, **kwds)
+
+        with self._lock:
+            if key in self._data:
+                arr = self._data.pop(key)
+                self._data[key] = arr # most recently used
+                return arr
+
+            arr = self._load_spilled(key)
+            if arr is not None or key in self._spilled:
+                self._put(key, arr)
+                return arr
+
+        if key[-1] is None:
+            arr = reader(filename, **kwds)
+        else:
+            arr = self.get(filename, reader, **kwds)
+            if arr is not None:
+                arr = arr.customized_copy(indices=op.apply(arr.indices())).map_to_asu()
+
+        with self._lock:
+            self._put(key, arr)
+        return arr
+    # get()
+
+    def _put(self, key, arr):
+        if key in self._data: return
+        self._data[key] = arr
+        self._nref += arr.size() if arr is not None else 0
+
+        while self._nref > self.max_reflections and len(self._data) > 1:
+            old_key, old_arr = self._data.popitem(last=False)
+            self._nref -= old_arr.size() if old_arr is not None else 0
+            self._spill(old_key, old_arr)
+    # _put()
+
+    def _spill_file(self, key):
+        return os.path.join(self.spill_dir, hashlib.md5(repr(key)).hexdigest() + ".pkl")
+    # _spill_file()
+
+    def _spill(self, key, arr):
+        if key in self._spilled: return
+
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="arraycache")
+            self._spill_dir_created = True
+        elif not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+
+        try:
+            pickle.dump(arr, open(self._spill_file(key), "wb"), -1)
+            self._spilled.add(key)
+        except (IOError, OSError):
+            pass
+    # _spill()
+
+    def _load_spilled(self, key):
+        if key not in self._spilled: return None
+        try:
+            return pickle.load(open(self._spill_file(key), "rb"))
+        except:
+            self._spilled.discard(key)
+            return None
+    # _load_spilled()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._spilled.clear()
+            self._nref = 0
+            if self._spill_dir_created and os.path.isdir(self.spill_dir):
+                shutil.rmtree(self.spill_dir)
+                self.spill_dir, self._spill_dir_created = None, False
+    # clear()
+
+# class MergedArrayCache
@@ -29,6 +29,7 @@ import shutil
 from yamtbx.dataproc.xds import xds_ascii
 from yamtbx.dataproc.xds import integrate_hkl_as_flex
 from yamtbx import util
+from yamtbx.dataproc.auto import cluster_stats
 from cctbx.array_family import flex
 from cctbx import miller
 from libtbx.utils import null_out
@@ -100,7 +101,10 @@ def load_xds_data_only_indices(xac_files, d_min=None):
             ms = xds_ascii.XDS_ASCII(f, i_only=True).as_miller_set()
             miller_sets[f] = ms.resolution_filter(d_min=d_min)
         elif integrate_hkl_as_flex.is_integrate_hkl(f):
-            print "Sorry, skipping", f
+            print "Loading", f
+            r = integrate_hkl_as_flex.reader(f, [])
+            ms = miller.set(crystal_symmetry=r.crystal_symmetry(), indices=r.hkl, anomalous_flag=False)
+            miller_sets[f] = ms.resolution_filter(d_min=d_min)
         else:
             print "Skipping unrecognized:", f
     return miller_sets
@@ -184,12 +188,23 @@ class BlendClusters:
             return cmpl
     # cluster_completeness()
 
+    def all_cluster_completeness(self, anomalous_flag):
+        """
+        Returns dict of clno -> (completeness, redundancy) for all clusters at once.
+        """
+        msets = map(lambda f: self.miller_sets.get(f), self.files)
+        clusters = dict(map(lambda x: (x, self.clusters[x][3]), self.clusters))
+        return cluster_stats.ClusterCompleteness(msets, anomalous_flag).calc(clusters)
+    # all_cluster_completeness()
+
     def show_cluster_summary(self, out=null_out()):
         tmp = []
+        stats = self.all_cluster_completeness(anomalous_flag=False)
+        astats = self.all_cluster_completeness(anomalous_flag=True)
         for clno in self.clusters:
             cluster_height, LCV, aLCV, IDs = self.clusters[clno]
-            cmpl, redun = self.cluster_completeness(clno, anomalous_flag=False)
-            acmpl, aredun = self.cluster_completeness(clno, anomalous_flag=True)
+            cmpl, redun = stats[clno]
+            acmpl, aredun = astats[clno]
             tmp.append((clno, IDs, cluster_height, cmpl*100., redun, acmpl*100., aredun, LCV, aLCV))
 
         tmp.sort(key=lambda x: (-x[4], -x[3])) # redundancy & completeness
@@ -0,0 +1,123 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Completeness and redundancy of all clusters in a dendrogram.
+
+Unique reflections (in ASU) of each dataset are encoded as sorted IDs in the
+union of all datasets. Clusters are processed from the smallest, and the
+unique reflections of a cluster are obtained as the union of those of its
+direct children (sub-clusters or datasets), so that each dataset is not read
+again for every cluster it belongs to.
+
+Compared to merging all indices of a cluster with merge_equivalents():
+ - resolution of a cluster is the highest resolution of its member datasets
+   (calculated with their own cells), not recalculated with the median cell.
+ - number of reflections in the complete set is counted on a reference set
+   built once, assuming that cells of the datasets are similar.
+"""
+
+import numpy
+from cctbx import crystal
+from cctbx import miller
+from cctbx import uctbx
+from yamtbx.util.maths import pack_hkl
+
+class ClusterCompleteness:
+    def __init__(self, miller_sets, anomalous_flag):
+        """
+        miller_sets: list of miller.set (or None if not available). Index in this list + 1 is dataset ID.
+        All must belong to the same Laue group and appropriately reindexed.
+        """
+        self.anomalous_flag = anomalous_flag
+        self.leaf_ids = []
+        self.nobs = numpy.zeros(len(miller_sets), dtype=numpy.int64)
+        self.d_mins = numpy.empty(len(miller_sets))
+        self.d_mins.fill(float("inf"))
+        self.cells = numpy.empty((len(miller_sets), 6))
+        self.cells.fill(float("nan"))
+        self.space_group_info = None
+
+        ukeys_list = []
+        for i, ms in enumerate(miller_sets):
+            if ms is None or ms.size() == 0:
+                ukeys_list.append(numpy.zeros(0, dtype=numpy.int64))
+                continue
+
+            if self.space_group_info is None: self.space_group_info = ms.space_group_info()
+            ms = ms.customized_copy(space_group_info=self.space_group_info,
+                                    anomalous_flag=anomalous_flag).map_to_asu()
+            ukeys_list.append(numpy.unique(pack_hkl(ms.indices())))
+            self.nobs[i] = ms.size()
+            self.d_mins[i] = ms.d_min()
+            self.cells[i] = ms.unit_cell().parameters()
+
+        all_keys = numpy.unique(numpy.concatenate(ukeys_list)) if ukeys_list else numpy.zeros(0, dtype=numpy.int64)
+        self.leaf_ids = map(lambda x: numpy.searchsorted(all_keys, x).astype(numpy.int32), ukeys_list)
+        self.n_ids = len(all_keys)
+
+        self.ref_indices = None
+        if self.space_group_info is not None:
+            # Reference set which should include all possible indices of any clusters
+            ok = self.d_mins < float("inf")
+            ref_cell = numpy.median(self.cells[ok], axis=0)
+            ref_cell[:3] = numpy.max(self.cells[ok][:,:3], axis=0)
+            symm = crystal.symmetry(tuple(ref_cell), space_group_info=self.space_group_info)
+            self.ref_indices = miller.build_set(symm, anomalous_flag=anomalous_flag,
+                                                d_min=0.95*numpy.min(self.d_mins[ok])).indices()
+    # __init__()
+
+    def n_complete(self, cell, d_min, d_min_tolerance=1.e-6):
+        if self.ref_indices is None: return 0
+        d_star_sq = uctbx.unit_cell(tuple(cell)).d_star_sq(self.ref_indices)
+        return (d_star_sq <= 1./(d_min*(1.-d_min_tolerance))**2).count(True)
+    # n_complete()
+
+    def calc(self, clusters):
+        """
+        clusters: dict of clno -> list of dataset IDs (1-based).
+        Returns dict of clno -> (completeness, redundancy)
+        """
+        ret = {}
+        scratch = numpy.zeros(self.n_ids, dtype=bool)
+        top = {} # dataset ID -> largest cluster processed so far containing it
+        nodes = {} # clno -> [unique reflection IDs, number of datasets pointing to it]
+
+        for clno in sorted(clusters, key=lambda x: (len(clusters[x]), x)):
+            IDs = clusters[clno]
+            children = set(map(lambda x: top.get(x, -x), IDs)) # negative for datasets
+
+            for c in children:
+                ids = self.leaf_ids[-c-1] if c < 0 else nodes[c][0]
+                scratch[ids] = True
+            ids = numpy.flatnonzero(scratch).astype(numpy.int32)
+            scratch[ids] = False
+
+            nodes[clno] = [ids, len(IDs)]
+            for x in IDs:
+                c = top.get(x)
+                if c is not None:
+                    nodes[c][1] -= 1
+                    if nodes[c][1] == 0: del nodes[c] # not needed anymore
+                top[x] = clno
+
+            idxes = numpy.array(IDs) - 1
+            n_uniq = len(ids)
+            if n_uniq == 0:
+                ret[clno] = (0., 0.)
+                continue
+
+            ok = idxes[self.d_mins[idxes] < float("inf")]
+            median_cell = numpy.median(self.cells[ok], axis=0)
+            n_compl = self.n_complete(median_cell, numpy.min(self.d_mins[ok]))
+            cmpl = n_uniq / float(max(1, n_compl))
+            redun = numpy.sum(self.nobs[idxes]) / float(n_uniq)
+            ret[clno] = (cmpl, redun)
+
+        return ret
+    # calc()
+
+# class ClusterCompleteness
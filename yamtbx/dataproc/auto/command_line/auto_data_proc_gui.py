@@ -19,6 +19,8 @@ from yamtbx.dataproc.adxv import Adxv
 from yamtbx.dataproc.dataset import find_existing_files_in_template
 from yamtbx.dataproc.bl_logfiles import BssJobLog
 from yamtbx.util import batchjob, directory_included, read_path_list, safe_float, expand_wildcard_in_list
+from yamtbx.util.parsecache import MtimeLruCache
+from yamtbx.util.logtail import LogTail
 from yamtbx.util.xtal import format_unit_cell
 
 import iotbx.phil
@@ -231,7 +233,9 @@ class BssJobs:
     def __init__(self):
         self.jobs = {} # { (path+prefix, number range) as key: }
         self.jobs_prefix_lookup = {} # {prefix: number_range in keys of self.jobs}
-        self.bsslogs_checked = {}
+        self._bsslog_tail = LogTail() # only new lines of bss logs are read in check_bss_log()
+        self._joblog_tail = LogTail()
+        self._joblog_parsed = {} # {joblog: BssJobLog} for pending joblogs; new lines are added
 
         self.procjobs = {} # key: batchjob
 
@@ -241,7 +245,7 @@ class BssJobs:
         self._prev_job_finished = False
         self._current_prefix = None
         self._joblogs = []
-        self._chaches = {} # chache logfile objects. {filename: [timestamp, objects..]
+        self._chaches = MtimeLruCache(maxsize=20000) # chache logfile objects. {(key, filename): (timestamp, object)}
 
         self.xds_inp_overrides = []
     # __init__()
@@ -278,14 +282,20 @@ class BssJobs:
                                       (date + datetime.timedelta(days=dday)).strftime("bss_%Y%m%d.log"))
                 if os.path.isfile(bsslog): bsslogs.append(bsslog)
 
+        for bsslog in set(self._bsslog_tail.paths()).difference(bsslogs):
+            self._bsslog_tail.forget(bsslog) # out of days to check
+
         for bsslog in bsslogs:
             #print "reading", bsslog
 
-            last_line = self.bsslogs_checked.get(bsslog, -1)
+            known = bsslog in self._bsslog_tail.paths()
+            restarted, first_lineno, lines = self._bsslog_tail.read(bsslog)
+            if known and restarted:
+                mylog.info("bss log was rotated or truncated. reading new one from the beginning: %s" % bsslog)
+
             read_job_flag = False
-            for i, l in enumerate(open(bsslog)):
+            for i, l in enumerate(lines, first_lineno):
                 try:
-                    if i <= last_line: continue
                     if l.startswith("echo "): continue # Must skip this line.
 
                     if "Beamline Scheduling Software Start" in l:
@@ -353,10 +363,31 @@ class BssJobs:
                     mylog.error(traceback.format_exc())
                     raise e
 
-            self.bsslogs_checked[bsslog] = i
-            # Check if start number and bss log were found. If not, set line number
+            self._bsslog_tail.commit(bsslog) # only after all lines are processed
     # check_bss_log()
 
+    def read_joblog(self, joblog):
+        """
+        Returns BssJobLog of joblog, parsing only lines added since the last call.
+        """
+        restarted, first_lineno, lines = self._joblog_tail.read(joblog)
+        if restarted or joblog not in self._joblog_parsed:
+            self._joblog_parsed[joblog] = BssJobLog()
+
+        bjl = self._joblog_parsed[joblog]
+        try:
+            bjl.parse_lines(joblog, lines)
+            bjl.annotate_overwritten_images(remove=True)
+        except:
+            # Partly parsed; parse from the beginning next time.
+            del self._joblog_parsed[joblog]
+            self._joblog_tail.forget(joblog)
+            raise
+
+        self._joblog_tail.commit(joblog)
+        return bjl
+    # read_joblog()
+
     def update_jobs(self, date, daystart=-2): #, joblogs, prev_job_finished, job_is_running):
         self.check_bss_log(date, daystart)
         mylog.debug("joblogs= %s" % self._joblogs)
@@ -372,7 +403,7 @@ class BssJobs:
                 mylog.info("Joblog not found. not created yet? pending: %s"%joblog)
                 continue
 
-            bjl = BssJobLog(joblog, remove_overwritten=True)
+            bjl = self.read_joblog(joblog)
             prefix = os.path.splitext(joblog)[0] # XXX what if .gz etc?
             is_running_job = (self._job_is_running and i == len(self._joblogs)-1)
 
@@ -439,6 +470,13 @@ class BssJobs:
         for i in sorted(remove_idxes, reverse=True):
             del self._joblogs[i]
 
+        # Parsed joblogs are kept only while pending
+        pending = set(map(lambda x: x[0], self._joblogs))
+        for joblog in self._joblog_parsed.keys():
+            if joblog in pending: continue
+            del self._joblog_parsed[joblog]
+            self._joblog_tail.forget(joblog)
+
         mylog.debug("remaining joblogs= %s" % self._joblogs)
 
         # Dump jobs
@@ -651,19 +689,27 @@ run_dials_auto.run_dials_sequence(**pickle.load(open("args.pkl")))
         self.procjobs[key] = job
     # process_data_dials()
 
-    def _save_chache(self, key, filename, obj):
-        self._chaches[(key,filename)] = (os.path.getmtime(filename), obj)
+    def _save_chache(self, key, filename, obj, mtime=None):
+        self._chaches.put(key, filename, obj, mtime)
     # _save_chache()
 
     def _load_if_chached(self, key, filename):
-        if (key, filename) not in self._chaches: return None
-        if not os.path.isfile(filename): return None
-        last_mtime, obj = self._chaches[(key, filename)]
-        if last_mtime == os.path.getmtime(filename):
-            return obj
-        return None
+        return self._chaches.get(key, filename)
     # _load_if_chached()
 
+    def load_chache(self, pklin):
+        if os.path.isfile(pklin) and self._chaches.load(pklin):
+            mylog.info("Cached results loaded from %s (%d entries)" % (pklin, len(self._chaches)))
+    # load_chache()
+
+    def save_chache(self, pklout):
+        try:
+            self._chaches.save(pklout)
+        except:
+            mylog.error("Failed to save cache: %s" % pklout)
+            mylog.error(traceback.format_exc())
+    # save_chache()
+
     def get_process_status(self, key):
         prefix, nr = key
         workdir = self.get_xds_workdir(key)
@@ -686,13 +732,16 @@ run_dials_auto.run_dials_sequence(**pickle.load(open("args.pkl")))
                 if os.path.isfile(correct_lp):
                     lp = self._load_if_chached("correctlp", correct_lp)
                     if lp is None:
-                        lp = correctlp.CorrectLp(correct_lp)
-                        self._save_chache("correctlp", correct_lp, lp)
+                        mtime = os.path.getmtime(correct_lp)
+                        lp = correctlp.parse_cached(correct_lp)
+                        self._save_chache("correctlp", correct_lp, lp, mtime)
 
                     ISa = lp.get_ISa() if lp.is_ISa_valid() else float("nan")
 
-                    resn = lp.resolution_based_on_ios_of_error_table(min_ios=1.)
-                    self._save_chache("resn", correct_lp, resn) # for html report
+                    resn = self._load_if_chached("resn", correct_lp)
+                    if resn is None:
+                        resn = lp.resolution_based_on_ios_of_error_table(min_ios=1.)
+                        self._save_chache("resn", correct_lp, resn) # for html report
 
                     sg = lp.space_group_str()
                     cmpl = float(lp.table["all"]["cmpl"][-1]) if "all" in lp.table else float("nan")
@@ -715,8 +764,9 @@ run_dials_auto.run_dials_sequence(**pickle.load(open("args.pkl")))
                 if os.path.isfile(summary_pkl):
                     pkl = self._load_if_chached("summary_pkl", summary_pkl)
                     if pkl is None:
+                        mtime = os.path.getmtime(summary_pkl)
                         pkl = pickle.load(open(summary_pkl))
-                        self._save_chache("summary_pkl", summary_pkl, pkl)
+                        self._save_chache("summary_pkl", summary_pkl, pkl, mtime)
 
                     try: resn = float(pkl.get("d_min"))
                     except: resn = float("nan")
@@ -748,7 +798,7 @@ run_dials_auto.run_dials_sequence(**pickle.load(open("args.pkl")))
             stats_pkl = os.path.join(workdir, "merging_stats.pkl")
 
             if os.path.isfile(correct_lp):
-                lp = correctlp.CorrectLp(correct_lp)
+                lp = correctlp.parse_cached(correct_lp)
                 ret["ISa"] = lp.get_ISa() if lp.is_ISa_valid() else float("nan")
                 ret["resn"] = lp.resolution_based_on_ios_of_error_table(min_ios=1.)
                 ret["sg"] = lp.space_group_str()
@@ -841,6 +891,9 @@ class WatchLogThread:
     def run(self):
         mylog.info("WatchLogThread loop STARTED")
         counter = 0
+        kamo_report = html_report.KamoReport(topdir=config.params.topdir,
+                                             htmlout=os.path.join(config.params.workdir, "report.html"),
+                                             update_individual=True)
         while self.keep_going:
             counter += 1
             if config.params.date == "today": date = datetime.datetime.today()
@@ -875,9 +928,10 @@ class WatchLogThread:
             wx.PostEvent(self.parent, ev)
 
             # Make html report # TODO Add DIALS support
-            html_report.make_kamo_report(bssjobs, 
-                                         topdir=config.params.topdir,
-                                         htmlout=os.path.join(config.params.workdir, "report.html"))
+            n_updated = kamo_report.update(bssjobs)
+            mylog.debug("html report updated for %d datasets" % n_updated)
+
+            bssjobs.save_chache(os.path.join(config.params.workdir, "kamo_cache.pkl"))
             #print
             #print "Done. Open?"
             #print "firefox %s" % os.path.join(config.params.workdir, "report.html")
@@ -1967,6 +2021,9 @@ This is an alpha-version. If you found something wrong, please let staff know! W
     if config.params.xds.override.geometry_reference:
         bssjobs.load_override_geometry(config.params.xds.override.geometry_reference)
 
+    # Parsed results in previous session
+    bssjobs.load_chache(os.path.join(config.params.workdir, "kamo_cache.pkl"))
+
     app = wx.App()
     mainFrame = MainFrame(parent=None, id=wx.ID_ANY)
     app.TopWindow = mainFrame
@@ -7,12 +7,26 @@ This software is released under the new BSD License; see LICENSE.
 
 """
 Just do an evaluation part of automatic processing.
+
+A summary table of all runs (space group, cell, ISa, resolution, completeness,
+mosaicity and frame range) is written as CSV and as numpy .npz (one array per
+column), so that runs can be filtered quickly before merging. Log files are
+read by a thread pool and the rows are cached (validated by mtime of the
+last log file) so that only new or updated runs are read again.
 """
 
 import os
+import re
+import csv
+import numpy
+import traceback
+from multiprocessing.pool import ThreadPool
 
 from yamtbx.dataproc.xds.command_line import xds_plot_integrate
 from yamtbx.dataproc.auto.command_line import run_all_xds_simple
+from yamtbx.dataproc.xds import correctlp
+from yamtbx.dataproc.xds import get_xdsinp_keyword
+from yamtbx.util.parsecache import MtimeLruCache
 from yamtbx import util
 
 import iotbx.phil
@@ -24,8 +38,30 @@ topdir = None
 nproc = None
  .type = int
  .help = number of processors for single xds job OR number of parallel jobs
+summary_only = False
+ .type = bool
+ .help = Only make the summary table. Evaluation (plot_integrate.log, merging statistics and xdsstat) is not run.
+summary_prefix = xds_runs_summary
+ .type = path
+ .help = Summary table is written to prefix.csv and prefix.npz
+nthreads = 8
+ .type = int(value_min=1)
+ .help = Number of threads to read log files for summary
+min_ios = 1.
+ .type = float
+ .help = Resolution in summary is where I/sigma in CORRECT.LP error table drops below this
+cache_file = None
+ .type = path
+ .help = Cache of summary rows. Default: .xds_runs_summary.pkl in topdir
 """
 
+summary_columns = (("dir", str), ("sg", str),
+                   ("a", float), ("b", float), ("c", float), ("alpha", float), ("beta", float), ("gamma", float),
+                   ("isa", float), ("d_min", float), ("cmpl", float), ("mosaicity", float),
+                   ("frame_first", int), ("frame_last", int))
+
+re_mosaicity = re.compile("^ CRYSTAL MOSAICITY \(DEGREES\) *([0-9\.]+)")
+
 def evaluate_run(root):
     integrate_lp = os.path.join(root, "INTEGRATE.LP")
     xds_ascii_hkl = os.path.join(root, "XDS_ASCII.HKL")
@@ -38,6 +74,103 @@ def evaluate_run(root):
         run_all_xds_simple.run_xdsstat(wdir=root)
 # evaluate_run()
 
+def read_mosaicity(integrate_lp):
+    # The last value in INTEGRATE.LP
+    ret = float("nan")
+    for l in open(integrate_lp):
+        r = re_mosaicity.search(l)
+        if r: ret = float(r.group(1))
+    return ret
+# read_mosaicity()
+
+def empty_summary_row():
+    nan = float("nan")
+    return dict(sg="", a=nan, b=nan, c=nan, alpha=nan, beta=nan, gamma=nan,
+                isa=nan, d_min=nan, cmpl=nan, mosaicity=nan, frame_first=-1, frame_last=-1)
+# empty_summary_row()
+
+def summarize_run(root, min_ios=1.):
+    """
+    Returns dict of summary_columns except dir. Unavailable values are nan (or -1 for frames, "" for sg).
+    """
+    ret = empty_summary_row()
+
+    xdsinp = os.path.join(root, "XDS.INP")
+    if os.path.isfile(xdsinp):
+        data_range = dict(get_xdsinp_keyword(xdsinp)).get("DATA_RANGE", "").split()
+        if len(data_range) == 2: ret["frame_first"], ret["frame_last"] = map(int, data_range)
+
+    integrate_lp = os.path.join(root, "INTEGRATE.LP")
+    if os.path.isfile(integrate_lp): ret["mosaicity"] = read_mosaicity(integrate_lp)
+
+    correct_lp = os.path.join(root, "CORRECT.LP")
+    if os.path.isfile(correct_lp):
+        lp = correctlp.CorrectLp(correct_lp) # not parse_cached(); the row is cached in make_summary_table()
+        if lp.space_group is not None: ret["sg"] = str(lp.space_group.info()).replace(" ", "")
+        if lp.unit_cell is not None:
+            for k, v in zip(("a", "b", "c", "alpha", "beta", "gamma"), lp.unit_cell): ret[k] = v
+        ret["isa"] = lp.get_ISa()
+        ret["d_min"] = lp.resolution_based_on_ios_of_error_table(min_ios)
+        if "all" in lp.table: ret["cmpl"] = lp.table["all"]["cmpl"][-1]
+
+    return ret
+# summarize_run()
+
+def make_summary_table(xds_dirs, topdir, min_ios=1., nthreads=8, cache=None):
+    """
+    Returns dict of column name -> numpy array, in the order of xds_dirs.
+    cache: MtimeLruCache; rows are keyed by directory and validated by mtimes of XDS.INP, INTEGRATE.LP and CORRECT.LP.
+    """
+    tag = "summary_%g" % min_ios
+    def get_row(root):
+        mtimes = tuple(map(lambda x: os.path.getmtime(x) if os.path.isfile(x) else None,
+                           map(lambda x: os.path.join(root, x), ("XDS.INP", "INTEGRATE.LP", "CORRECT.LP"))))
+        row = cache.get(tag, root, mtime=mtimes) if cache is not None else None
+        if row is None:
+            try:
+                row = summarize_run(root, min_ios)
+            except:
+                # e.g. files being written. One run should not spoil the table. Not cached.
+                print "Warning: error in summarizing %s: %s" % (root, traceback.format_exc().splitlines()[-1])
+                return empty_summary_row()
+            if cache is not None: cache.put(tag, root, row, mtime=mtimes)
+        return row
+
+    pool = ThreadPool(nthreads)
+    try:
+        rows = pool.map(get_row, xds_dirs)
+    finally:
+        pool.close()
+
+    table = {}
+    for name, typ in summary_columns:
+        if name == "dir": vals = map(lambda x: os.path.relpath(x, topdir), xds_dirs)
+        else: vals = map(lambda x: x[name], rows)
+        table[name] = numpy.array(vals, dtype=typ)
+    return table
+# make_summary_table()
+
+def save_summary_table(table, prefix):
+    names = map(lambda x: x[0], summary_columns)
+
+    ofs = open(prefix+".csv", "wb")
+    writer = csv.writer(ofs)
+    writer.writerow(names)
+    for i in xrange(len(table["dir"])):
+        writer.writerow(map(lambda x: table[x][i], names))
+    ofs.close()
+
+    numpy.savez(prefix+".npz", **table)
+# save_summary_table()
+
+def load_summary_table(npzin):
+    # Returns dict of column name -> numpy array
+    f = numpy.load(npzin)
+    ret = dict(map(lambda x: (x, f[x]), f.files))
+    f.close()
+    return ret
+# load_summary_table()
+
 def run(params):
     xds_dirs = []
     print "Found xds directories:"
@@ -46,15 +179,32 @@ def run(params):
             print "", os.path.relpath(root, params.topdir)
             xds_dirs.append(root)
 
-    print
-    print "Start running.."
+    if not params.summary_only:
+        print
+        print "Start running.."
 
-    npar = util.get_number_of_processors() if params.nproc is None else params.nproc
+        npar = util.get_number_of_processors() if params.nproc is None else params.nproc
 
-    fun_local = lambda x: evaluate_run(x)#, params)
-    easy_mp.pool_map(fixed_func=fun_local,
-                     args=xds_dirs,
-                     processes=npar)
+        fun_local = lambda x: evaluate_run(x)#, params)
+        easy_mp.pool_map(fixed_func=fun_local,
+                         args=xds_dirs,
+                         processes=npar)
+
+    print
+    print "Making summary table.."
+    cache_file = params.cache_file
+    if cache_file is None: cache_file = os.path.join(params.topdir, ".xds_runs_summary.pkl")
+    cache = MtimeLruCache(maxsize=max(10000, 2*len(xds_dirs)))
+    cache.load(cache_file)
+
+    table = make_summary_table(xds_dirs, params.topdir, params.min_ios, params.nthreads, cache)
+    save_summary_table(table, params.summary_prefix)
+    try:
+        cache.save(cache_file)
+    except (IOError, OSError):
+        print "Cannot write cache: %s" % cache_file
+
+    print "Summary of %d runs saved: %s.csv %s.npz" % (len(xds_dirs), params.summary_prefix, params.summary_prefix)
 # run()
 
 
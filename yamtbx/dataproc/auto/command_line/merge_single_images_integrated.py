@@ -251,6 +251,11 @@ def mc_integration(params, xac_files, scale_ref=None, split_idxes=None):
             #    tmp.iobs *= flex.exp(-b*d_star_sq)
             #    tmp.sigma_iobs *= flex.exp(-b*d_star_sq)
 
+        if params.nproc > 1:
+            # Only indices, I, sigma and symm are used in merging. Don't send others back to parent.
+            tmp.xd, tmp.yd, tmp.zd, tmp.rlp, tmp.peak, tmp.corr = [flex.double() for i in xrange(6)]
+            tmp.iframe, tmp.iset = flex.int(), flex.int()
+
         return i, tmp, k, b
     # load_xds()
 
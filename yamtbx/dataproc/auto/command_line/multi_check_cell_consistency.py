@@ -15,11 +15,14 @@ from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
 from yamtbx.dataproc import pointless
 from yamtbx.dataproc.xds import correctlp
 from yamtbx.dataproc.dials.command_line import run_dials_auto
+from libtbx import easy_mp
 
 import os
 import sys
+import json
 import networkx as nx
 import numpy
+from scipy import spatial
 
 master_params_str = """
 topdir = None
@@ -37,90 +40,189 @@ tol_angle = 5
 do_pointless = False
  .type = bool
  .help = Run pointless for largest group data to determine symmetry
+nproc = 1
+ .type = int(value_min=1)
+ .help = Number of processes to read cells from files
+cache_file = None
+ .type = path
+ .help = JSON file to keep cells read (with modification times of files) across runs
 """
 
+# Files from which cells are read. Cached cells are used if none of these have been modified.
+cell_source_files = ("GXPARM.XDS", "CORRECT.LP_noscale", "CORRECT.LP",
+                     "DIALS.HKL", "pointless.log", "integrated_experiments.json")
+
+_cell_cache = {} # directory -> dict(mtimes=, info=); kept while the process lives (e.g. GUI)
+
+def source_mtimes(root):
+    ret = {}
+    for f in cell_source_files:
+        f = os.path.join(root, f)
+        if os.path.isfile(f): ret[os.path.basename(f)] = os.path.getmtime(f)
+    return ret
+# source_mtimes()
+
+def read_cell_info(root):
+    """
+    Returns dict(sg=Hall symbol, cell=, p1cell=), or dict(error=message) if failed.
+    Only plain types are returned so that results can be passed from processes and saved as JSON.
+    """
+    gxparm_xds = os.path.join(root, "GXPARM.XDS")
+    if os.path.isfile(gxparm_xds):
+        correct_lp = filter(lambda x: os.path.isfile(x), map(lambda f: os.path.join(root, f), ("CORRECT.LP_noscale", "CORRECT.LP")))
+        if not correct_lp: return dict(error="CORRECT.LP not found: %s" % root)
+        p1cell = correctlp.get_P1_cell(correct_lp[0], force_obtuse_angle=True)
+        if p1cell is None: return dict(error="P1 cell not found: %s" % correct_lp[0])
+        try:
+            xparm = XPARM(gxparm_xds)
+        except ValueError:
+            return dict(error="Invalid xparm format: %s" % gxparm_xds)
+        xs = xparm.crystal_symmetry()
+    else: # DIALS
+        xs = run_dials_auto.get_most_possible_symmetry(root)
+        if xs is None:
+            return dict(error="Cannot get crystal symmetry: %s" % root)
+
+        p1cell = list(xs.niggli_cell().unit_cell().parameters())
+        # force obtuse angle
+        tmp = map(lambda x: (x[0]+3,abs(90.-x[1])), enumerate(p1cell[3:])) # Index and difference from 90 deg
+        tmp.sort(key=lambda x: x[1], reverse=True)
+        if p1cell[tmp[0][0]] < 90:
+            tmp = map(lambda x: (x[0]+3,90.-x[1]), enumerate(p1cell[3:])) # Index and 90-val.
+            tmp.sort(key=lambda x: x[1], reverse=True)
+            for i,v in tmp[:2]: p1cell[i] = 180.-p1cell[i]
+
+        p1cell = uctbx.unit_cell(p1cell)
+
+    return dict(sg=xs.space_group_info().type().hall_symbol(),
+                cell=xs.unit_cell().parameters(),
+                p1cell=p1cell.parameters())
+# read_cell_info()
+
+def read_cell_infos(dirs, nproc=1, cache_file=None):
+    """
+    Returns list of read_cell_info() results for dirs.
+    Cells of directories whose files have not been modified are taken from the cache.
+    """
+    if cache_file and os.path.isfile(cache_file):
+        try:
+            for root, v in json.load(open(cache_file)).items(): _cell_cache.setdefault(root, v)
+        except ValueError:
+            pass
+
+    mtimes = map(source_mtimes, dirs)
+    todo = filter(lambda i: _cell_cache.get(dirs[i], {}).get("mtimes") != mtimes[i], xrange(len(dirs)))
+
+    if nproc > 1 and len(todo) > 1:
+        infos = easy_mp.pool_map(fixed_func=read_cell_info,
+                                 args=map(lambda i: dirs[i], todo),
+                                 processes=nproc)
+    else:
+        infos = map(lambda i: read_cell_info(dirs[i]), todo)
+
+    for i, info in zip(todo, infos):
+        _cell_cache[dirs[i]] = dict(mtimes=mtimes[i], info=info)
+
+    if cache_file and todo:
+        json.dump(_cell_cache, open(cache_file+".tmp", "w"))
+        os.rename(cache_file+".tmp", cache_file)
+
+    return map(lambda x: _cell_cache[x]["info"], dirs)
+# read_cell_infos()
+
 class CheckMulti:
     def __init__(self, topdir=None, xdsdirs=None, out=sys.stdout):
         assert (topdir, xdsdirs).count(None) == 1
 
         self.topdir, self.xdsdirs = topdir, xdsdirs
         self.dirs, self.p1cells, self.symms = [], [], []
+        self.reduced_lengths = [] # a, b, c of Niggli cells, i.e. the length part of G6 vectors
         self.reference_symmetries = []
         self.G = None
+        self.graph_tols = None
         self.cosets = {}
         self.groups = []
         self.grouped_dirs = []
         self.out = out
     # __init__()
 
-    def get_symms_from_xds_results(self):
+    def get_symms_from_xds_results(self, nproc=1, cache_file=None):
+        """
+        Can be called again (e.g. during data collection) to add datasets found after the last call.
+        Then call construct_graph() and group_xds_results() to update groups.
+        """
         if self.xdsdirs is not None:
             xdsdirs = filter(lambda x: os.path.isfile(os.path.join(x, "GXPARM.XDS")) or os.path.isfile(os.path.join(x, "DIALS.HKL")), self.xdsdirs)
         else:
             xdsdirs = map(lambda x: x[0], filter(lambda x: "GXPARM.XDS" in x[2] or "DIALS.HKL" in x[2], os.walk(self.topdir)))
 
-        symms = []
-        print >>self.out, "Idx Dir Cell P1Cell"
-        idx = 0
-        for root in xdsdirs:
+        known = set(self.dirs)
+        xdsdirs = filter(lambda x: x not in known, xdsdirs) # failed ones are tried again (from cache unless updated)
+        infos = read_cell_infos(xdsdirs, nproc, cache_file)
+
+        if not self.dirs: print >>self.out, "Idx Dir Cell P1Cell"
+        idx = len(self.dirs)
+        for root, info in zip(xdsdirs, infos):
             print >>self.out, "%.3d"%idx,
             print >>self.out, os.path.relpath(root, self.topdir) if self.topdir is not None else root,
-            gxparm_xds = os.path.join(root, "GXPARM.XDS")
-            if os.path.isfile(gxparm_xds):
-                correct_lp = filter(lambda x: os.path.isfile(x), map(lambda f: os.path.join(root, f), ("CORRECT.LP_noscale", "CORRECT.LP")))[0]
-                p1cell = correctlp.get_P1_cell(correct_lp, force_obtuse_angle=True)
-                try:
-                    xparm = XPARM(gxparm_xds)
-                except ValueError:
-                    print >>self.out, "Invalid xparm format:", gxparm_xds
-                    continue
-                xs = xparm.crystal_symmetry()
-            else: # DIALS
-                xs = run_dials_auto.get_most_possible_symmetry(root)
-                if xs is None:
-                    print >>self.out, "Cannot get crystal symmetry:", root
-                    continue
-
-                p1cell = list(xs.niggli_cell().unit_cell().parameters())
-                # force obtuse angle
-                tmp = map(lambda x: (x[0]+3,abs(90.-x[1])), enumerate(p1cell[3:])) # Index and difference from 90 deg
-                tmp.sort(key=lambda x: x[1], reverse=True)
-                if p1cell[tmp[0][0]] < 90:
-                    tmp = map(lambda x: (x[0]+3,90.-x[1]), enumerate(p1cell[3:])) # Index and 90-val.
-                    tmp.sort(key=lambda x: x[1], reverse=True)
-                    for i,v in tmp[:2]: p1cell[i] = 180.-p1cell[i]
-
-                p1cell = uctbx.unit_cell(p1cell)
+            if "error" in info:
+                print >>self.out, info["error"]
+                continue
+
+            xs = crystal.symmetry(info["cell"], space_group_info=sgtbx.space_group_info("Hall: "+str(info["sg"])))
+            p1cell = uctbx.unit_cell(info["p1cell"])
 
             self.dirs.append(root)
             self.p1cells.append(p1cell)
             self.symms.append(xs)
+            self.reduced_lengths.append(sorted(p1cell.niggli_cell().parameters()[:3]))
             print >>self.out, xs.space_group_info(), xs.unit_cell(), p1cell
             idx += 1
 
         assert len(self.dirs) == len(self.symms) == len(self.p1cells)
     # get_cells_from_xds_results()
 
-    def construct_graph(self, tol_length, tol_angle):
-        self.G = nx.Graph()
+    def candidate_pairs(self, tol_length, tol_angle, n_old=0):
+        """
+        Pairs (i, j; i < j and j >= n_old) that can be compatible, found by neighbour search on the reduced cell lengths.
+        Lengths of the reduced cell are those of the shortest lattice vectors, which do not depend on the setting,
+        so compatible cells (even if reindexing is needed) have close values. Search radius is taken generously
+        in log scale because the tolerance in angle also changes the lengths.
+        """
+        if len(self.p1cells) < 2: return []
+
+        v = numpy.log(numpy.array(self.reduced_lengths))
+        r = numpy.log(1. + tol_length) + 2. * numpy.tan(numpy.radians(tol_angle))
+        tree = spatial.cKDTree(v)
+        return sorted(filter(lambda x: x[1] >= n_old, tree.query_pairs(r, p=numpy.inf)))
+    # candidate_pairs()
 
-        for i in xrange(len(self.p1cells)):
+    def construct_graph(self, tol_length, tol_angle):
+        """
+        If called again after datasets are added, only pairs including new ones are tested.
+        """
+        if self.G is None or self.graph_tols != (tol_length, tol_angle):
+            self.G = nx.Graph()
+            self.cosets = {}
+            self.graph_tols = (tol_length, tol_angle)
+
+        n_old = self.G.number_of_nodes()
+        for i in xrange(n_old, len(self.p1cells)):
             self.G.add_node(i)
 
-        for i in xrange(len(self.p1cells)-1):
-            for j in xrange(i+1, len(self.p1cells)):
-                cell_i = self.p1cells[i]
-                cell_j = self.p1cells[j]
-                if cell_i.is_similar_to(cell_j, tol_length, tol_angle):
+        for i, j in self.candidate_pairs(tol_length, tol_angle, n_old):
+            cell_i = self.p1cells[i]
+            cell_j = self.p1cells[j]
+            if cell_i.is_similar_to(cell_j, tol_length, tol_angle):
+                self.G.add_edge(i, j)
+            else:
+                cosets = reindex.reindexing_operators(crystal.symmetry(cell_i, 1),
+                                                      crystal.symmetry(cell_j, 1),
+                                                      tol_length, tol_angle)
+                self.cosets[(i,j)] = cosets
+                if cosets.double_cosets is not None:
+                    print cell_i, cell_j, cosets.combined_cb_ops()[0]
                     self.G.add_edge(i, j)
-                else:
-                    cosets = reindex.reindexing_operators(crystal.symmetry(cell_i, 1),
-                                                          crystal.symmetry(cell_j, 1),
-                                                          tol_length, tol_angle)
-                    self.cosets[(i,j)] = cosets
-                    if cosets.double_cosets is not None:
-                        print cell_i, cell_j, cosets.combined_cb_ops()[0]
-                        self.G.add_edge(i, j)
         #nx.write_dot(self.G, "compatible_cell_graph.dot")
     # construct_graph()
 
@@ -268,7 +370,7 @@ class CheckMulti:
 
 def run(params, out=sys.stdout):
     cm = CheckMulti(topdir=params.topdir, xdsdirs=params.xdsdir, out=out)
-    cm.get_symms_from_xds_results()
+    cm.get_symms_from_xds_results(nproc=params.nproc, cache_file=params.cache_file)
     cm.construct_graph(params.tol_length, params.tol_angle)
     cm.group_xds_results()
     print
@@ -289,7 +391,7 @@ def run(params, out=sys.stdout):
             continue
         
         sg = sgtbx.space_group_info(XPARM(gxparm_xds).spacegroup)
-        clp = correctlp.CorrectLp(correct_lp)
+        clp = correctlp.parse_cached(correct_lp)
         if "all" in clp.table:
             cmpl = clp.table["all"]["cmpl"][-1]
         else:
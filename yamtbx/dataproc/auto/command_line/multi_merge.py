@@ -85,6 +85,9 @@ xscale {
   .help = controls CORRECTIONS=. Use lower case to specify
  use_tmpdir_if_available = True
   .type = bool
+ check_connectivity = True
+  .type = bool
+  .help = "Check common strong reflections between datasets before running XSCALE, and use only the largest connected group of datasets"
 }
 
 rejection {
@@ -162,6 +165,9 @@ cc_clustering {
  min_ios = None
   .type = float
   .help = minimum I/sigma for CC calculation
+ method = *ward average complete
+  .type = choice(multi=False)
+  .help = Linkage method for hierarchical clustering on 1-CC
  min_cmpl = 90
   .type = float
   .help = minimum completeness of cluster for merging
@@ -217,12 +223,47 @@ batch {
  nproc_each = 4
   .type = int
   .help = maximum number of cores used for single data processing
- sh_max_jobs = 1
+ sh_max_jobs = None
+  .type = int
+  .help = maximum number of concurrent jobs when engine=sh. Default: sh_max_cores if given, otherwise 1.
+ sh_max_cores = None
   .type = int
-  .help = maximum number of concurrent jobs when engine=sh
+  .help = "total number of cores for merging clusters in parallel when engine=sh. If given, number of cores for each cluster is decided from its estimated cost (up to nproc_each), and jobs are started whenever cores are free (up to sh_max_jobs)."
 }
 """
 
+def estimate_merge_cost(xds_files):
+    """
+    Relative cost of merging a cluster: total size of XDS_ASCII files as reflection volume,
+    plus per-dataset overhead which is counted as 1 MB.
+    """
+    return sum(map(lambda f: os.path.getsize(f) if os.path.isfile(f) else 0, xds_files)) + len(xds_files) * 2**20
+# estimate_merge_cost()
+
+def decide_nproc_for_merging(costs, total_nproc, max_nproc, max_parallel):
+    """
+    Share cores in proportion to the cost of each cluster.
+    Clusters are run in descending order of cost, and at most min(max_parallel, total_nproc) run at the same time;
+    cores of each cluster are shared with the clusters that are expected to run with it (neighbors in the order).
+    Returned list is in the original order.
+    """
+    order = sorted(xrange(len(costs)), key=lambda i: -costs[i])
+    n_concurrent = max(1, min(max_parallel, total_nproc, len(costs)))
+    ret = [1] * len(costs)
+    for k, i in enumerate(order):
+        start = min(k, len(costs) - n_concurrent)
+        window_cost = float(sum(map(lambda j: costs[j], order[start:start+n_concurrent])))
+        if window_cost <= 0: continue
+        ret[i] = max(1, min(max_nproc, total_nproc, int(round(total_nproc * costs[i] / window_cost))))
+    return ret
+# decide_nproc_for_merging()
+
+def sh_max_parallel(batch_params):
+    if batch_params.sh_max_jobs is not None: return batch_params.sh_max_jobs
+    if batch_params.sh_max_cores is not None: return batch_params.sh_max_cores # concurrency limited by cores
+    return 1
+# sh_max_parallel()
+
 def merge_datasets(params, workdir, xds_files, cells, space_group):
     if not os.path.exists(workdir): os.makedirs(workdir)
     out = open(os.path.join(workdir, "merge.log"), "w")
@@ -277,8 +318,10 @@ def merge_datasets(params, workdir, xds_files, cells, space_group):
         for i in xrange(1, cycles.get_last_cycle_number()+1):
             wd = os.path.join(workdir, "run_%.2d"%i)
             xscale_lp = os.path.join(wd, "XSCALE.LP")
-            table = xscalelp.read_stats_table(xscale_lp)
-            num_files = len(xscalelp.get_read_data(xscale_lp))
+            lp = xscalelp.parse_cached(xscale_lp)
+            table = lp.stats_table
+            if table is None: raise RuntimeError("Unexpected format of statistics table in %s" % xscale_lp)
+            num_files = len(lp.read_data)
             xtriage_logfile = os.path.join(wd, "ccp4", "logfile.log")
             cellinfo = cycles.cell_info_at_cycles[i]
             ret.append([i, wd, num_files, 
@@ -299,7 +342,7 @@ def merge_datasets(params, workdir, xds_files, cells, space_group):
 
         xscale_lp = os.path.join(cycles.current_working_dir(), "XSCALE.LP")
         print >>out, "\nFinal statistics:\n"
-        print >>out, xscalelp.snip_stats_table(xscale_lp)
+        print >>out, xscalelp.parse_cached(xscale_lp).stats_table_snip
 
         return ret
 
@@ -397,7 +440,8 @@ def run(params):
     if params.batch.engine == "sge":
         batchjobs = batchjob.SGE(pe_name=params.batch.sge_pe_name)
     elif params.batch.engine == "sh":
-        batchjobs = batchjob.ExecLocal(max_parallel=params.batch.sh_max_jobs)
+        batchjobs = batchjob.ExecLocal(max_parallel=sh_max_parallel(params.batch),
+                                       max_cores=params.batch.sh_max_cores)
     else:
         raise "Unknown batch engine: %s" % params.batch.engine
 
@@ -577,6 +621,7 @@ def run(params):
         cc_clusters.do_clustering(nproc=params.cc_clustering.nproc,
                                   b_scale=params.cc_clustering.b_scale,
                                   use_normalized=params.cc_clustering.use_normalized,
+                                  method=params.cc_clustering.method,
                                   html_maker=html_report)
         summary_out = os.path.join(ccc_wdir, "cc_cluster_summary.dat")
         clusters = cc_clusters.show_cluster_summary(d_min=params.d_min, out=open(summary_out, "w"))
@@ -654,62 +699,86 @@ def run(params):
         ofs_summary.flush()
     # write_ofs_summary()
 
+    def add_merge_results(workdir, xds_files, LCV, aLCV, clh, results):
+        if len(results) == 0:
+            ofs_summary.write("#%s failed\n" % os.path.relpath(workdir, params.workdir))
+
+        lcv, alcv = float("nan"), float("nan")
+        for cycle, wd, num_files, stats in results:
+            lcv, alcv = stats.get("lcv", LCV), stats.get("alcv", aLCV)
+            write_ofs_summary(workdir, cycle, clh, lcv, alcv, xds_files, num_files, stats)
+
+        # Last lcv & alcv
+        try: html_report.add_merge_result(workdir, clh, lcv, alcv, xds_files, results[-1][2], results[-1][3])
+        except: print >>out, traceback.format_exc()
+
+        # Update report as soon as each cluster is finished
+        try: html_report.write_html()
+        except: print >>out, traceback.format_exc()
+    # add_merge_results()
+
     if "merging" in params.batch.par_run:
         params.nproc = params.batch.nproc_each
-        jobs = []
-        for workdir, xds_files, LCV, aLCV, clh in data_for_merge:
+        if params.batch.engine == "sh" and params.batch.sh_max_cores is not None:
+            # Start expensive clusters first, giving more cores to them
+            costs = map(lambda x: estimate_merge_cost(x[1]), data_for_merge)
+            nprocs = decide_nproc_for_merging(costs, params.batch.sh_max_cores, params.batch.nproc_each,
+                                              sh_max_parallel(params.batch))
+            order = sorted(xrange(len(data_for_merge)), key=lambda i: -costs[i])
+            for i in order:
+                print >>out, "Estimated cost of %s: %.1f MB, nproc= %d" % (os.path.relpath(data_for_merge[i][0], params.workdir),
+                                                                         costs[i]/2.**20, nprocs[i])
+        else:
+            nprocs = [params.batch.nproc_each] * len(data_for_merge)
+            order = range(len(data_for_merge))
+
+        jobs = collections.OrderedDict() # job -> args
+        for i in order:
+            workdir, xds_files, LCV, aLCV, clh = data_for_merge[i]
+            params.nproc = nprocs[i]
             if not os.path.exists(workdir): os.makedirs(workdir)
             shname = "merge_%s.sh" % os.path.relpath(workdir, params.workdir)
             pickle.dump((params, os.path.abspath(workdir), xds_files, cells, space_group), open(os.path.join(workdir, "args.pkl"), "w"), -1)
-            job = batchjob.Job(workdir, shname, nproc=params.batch.nproc_each)
+            job = batchjob.Job(workdir, shname, nproc=nprocs[i])
             job.write_script("""\
 cd "%s" || exit 1
 "%s" -c '\
 import pickle; \
+import os; \
 from yamtbx.dataproc.auto.command_line.multi_merge import merge_datasets; \
+from yamtbx.util.batchjob import nproc_env_name; \
 args = pickle.load(open("args.pkl")); \
+args[0].nproc = int(os.environ.get(nproc_env_name, args[0].nproc)); \
 ret = merge_datasets(*args); \
 pickle.dump(ret, open("result.pkl","w")); \
 '
 """ % (os.path.abspath(workdir), sys.executable))
             batchjobs.submit(job)
-            jobs.append(job)
+            jobs[job] = data_for_merge[i]
 
-        batchjobs.wait_all(jobs)
-        for workdir, xds_files, LCV, aLCV, clh in data_for_merge:
-            try:
-                results = pickle.load(open(os.path.join(workdir, "result.pkl")))
-            except:
-                print >>out, "Error in unpickling result in %s" % workdir
-                print >>out, traceback.format_exc()
-                results = []
-
-            if len(results) == 0:
-                ofs_summary.write("#%s failed\n" % os.path.relpath(workdir, params.workdir))
-
-            lcv, alcv = float("nan"), float("nan")
-            for cycle, wd, num_files, stats in results:
-                lcv, alcv = stats.get("lcv", LCV), stats.get("alcv", aLCV)
-                write_ofs_summary(workdir, cycle, clh, lcv, alcv, xds_files, num_files, stats)
-
-            # Last lcv & alcv
-            try: html_report.add_merge_result(workdir, clh, lcv, alcv, xds_files, results[-1][2], results[-1][3])
-            except: print >>out, traceback.format_exc()
+        params.nproc = params.batch.nproc_each
+
+        # Collect results as jobs finish
+        while jobs:
+            for job in jobs: batchjobs.update_state(job)
+            for job in filter(lambda j: j.state in (batchjob.STATE_FINISHED, batchjob.STATE_FAILED), jobs.keys()):
+                workdir, xds_files, LCV, aLCV, clh = jobs.pop(job)
+                try:
+                    results = pickle.load(open(os.path.join(workdir, "result.pkl")))
+                except:
+                    print >>out, "Error in unpickling result in %s" % workdir
+                    print >>out, traceback.format_exc()
+                    results = []
+
+                add_merge_results(workdir, xds_files, LCV, aLCV, clh, results)
+
+            if jobs: time.sleep(5)
     else:
         for workdir, xds_files, LCV, aLCV, clh in data_for_merge:
             print >>out, "Merging %s..." % os.path.relpath(workdir, params.workdir)
             out.flush()
             results = merge_datasets(params, workdir, xds_files, cells, space_group)
-            
-            if len(results) == 0:
-                ofs_summary.write("#%s failed\n" % os.path.relpath(workdir, params.workdir))
-
-            for cycle, wd, num_files, stats in results:
-                lcv, alcv = stats.get("lcv", LCV), stats.get("alcv", aLCV)
-                write_ofs_summary(workdir, cycle, clh, lcv, alcv, xds_files, num_files, stats)
-
-            try: html_report.add_merge_result(workdir, clh, lcv, alcv, xds_files, results[-1][2], results[-1][3])
-            except: print >>out, traceback.format_exc()
+            add_merge_results(workdir, xds_files, LCV, aLCV, clh, results)
 
     try: html_report.write_html()
     except: print >>out, traceback.format_exc()
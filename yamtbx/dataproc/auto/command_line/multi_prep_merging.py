@@ -11,6 +11,7 @@ from yamtbx.dataproc.xds import files as xds_files
 from yamtbx.dataproc.xds import correctlp
 from yamtbx.dataproc.xds import modify_xdsinp, make_backup, revert_files
 from yamtbx.dataproc.xds.xparm import XPARM
+from yamtbx.dataproc.auto.array_cache import MergedArrayCache
 from yamtbx import util
 
 import iotbx.phil
@@ -48,6 +49,9 @@ reference_for_reindex = None
  .help = Reference reflection data for resolving indexing ambiguity
 """
 
+# Merged (and reindexed) data read in this session
+data_cache = MergedArrayCache()
+
 def prepare_dials_files(wd, out, space_group=None, reindex_op=None):
     try:
         from yamtbx.dataproc.dials.command_line import import_xds_for_refine
@@ -297,7 +301,7 @@ def resolve_indexing_ambiguity(dirs, reidx_ops):
     # Read all (strong) data
     for wd in dirs:
         print "reading", wd
-        tmp = read_strong_i_from_xds_ascii(os.path.join(wd, "XDS_ASCII.HKL"))
+        tmp = data_cache.get(os.path.join(wd, "XDS_ASCII.HKL"), read_strong_i_from_xds_ascii)
         if tmp is None:
             continue
         data[wd] = tmp
@@ -316,7 +320,7 @@ def resolve_indexing_ambiguity(dirs, reidx_ops):
                 if k == 0:
                     data_j_ = data_j
                 else:
-                    data_j_ = data_j.customized_copy(indices=rop.apply(data_j.indices()))
+                    data_j_ = data_cache.get(os.path.join(wd_j, "XDS_ASCII.HKL"), read_strong_i_from_xds_ascii, op=rop)
                 cc_list.append(get_cc(data_i, data_j_))
                 if k > 0 and cc_list[k] is not None:
                     if cc_list[k] < cc_list[idx_min]: idx_min = k
@@ -357,7 +361,7 @@ def resolve_indexing_ambiguity_using_reference(dirs, reidx_ops, reference_file):
     # Read all (strong) data
     for wd in dirs:
         print "reading", wd
-        tmp = read_strong_i_from_xds_ascii(os.path.join(wd, "XDS_ASCII.HKL"))
+        tmp = data_cache.get(os.path.join(wd, "XDS_ASCII.HKL"), read_strong_i_from_xds_ascii)
         if tmp is None:
             continue
         data[wd] = tmp
@@ -375,7 +379,7 @@ def resolve_indexing_ambiguity_using_reference(dirs, reidx_ops, reference_file):
             if k == 0:
                 data_i_ = data_i
             else:
-                data_i_ = data_i.customized_copy(indices=rop.apply(data_i.indices()))
+                data_i_ = data_cache.get(os.path.join(dirs[i], "XDS_ASCII.HKL"), read_strong_i_from_xds_ascii, op=rop)
             cc_list.append(get_cc(data_i_, ref_data))
             if cc_list[k] is not None:
                 if cc_list[k] > cc_list[idx_max]: idx_max = k
@@ -459,6 +463,8 @@ def run(params):
     else:
         resolve_indexing_ambiguity(dirs, reidx_ops)
 
+    data_cache.clear()
+
     ofs = open(params.lstout, "w")
     for wd in dirs:
         xas_full = os.path.join(wd, "XDS_ASCII_fullres.HKL")
@@ -14,7 +14,9 @@ import re
 import pickle
 import time
 import glob
+import copy
 import numpy
+import multiprocessing
 
 from yamtbx.dataproc.xds import get_xdsinp_keyword, modify_xdsinp, optimal_delphi_by_nproc, make_backup, revert_files, remove_backups
 from yamtbx.dataproc.xds import idxreflp
@@ -79,6 +81,14 @@ use_tmpdir_if_available = true
 auto_frame_exclude_spot_based = false
  .type = bool
  .help = automatic frame exclusion from integration based on spot search result.
+scheduler {
+ frames_per_core = 10
+  .type = int(value_min=1)
+  .help = "With multiproc=true and parmethod=multiprocessing, cores are shared by datasets. A dataset gets up to nframes/frames_per_core cores."
+ processors_per_job = None
+  .type = int(value_min=1)
+  .help = MAXIMUM_NUMBER_OF_PROCESSORS= limit. If a dataset gets more cores, MAXIMUM_NUMBER_OF_JOBS= is increased. None: one job uses all cores given.
+}
 cell_prior {
  check = true
   .type = bool
@@ -266,7 +276,8 @@ def try_indexing_hard(wdir, show_progress, decilog,
                                               ])           
 # try_indexing_hard()
 
-def xds_sequence(root, params):
+def xds_sequence(root, params, njobs=None):
+    # params.nproc is the number of cores for this run. If njobs is given, they are divided into MAXIMUM_NUMBER_OF_JOBS=
     print
     print os.path.relpath(root, params.topdir)
 
@@ -306,9 +317,13 @@ def xds_sequence(root, params):
         modify_xdsinp(xdsinp, inp_params=[("DELPHI", str(delphi)),
                                           ])
 
-    if params.nproc is not None and params.nproc > 1:
-        modify_xdsinp(xdsinp, inp_params=[("MAXIMUM_NUMBER_OF_PROCESSORS", str(params.nproc)),
+    if params.nproc is not None:
+        # Also when nproc=1; otherwise xds_par uses all cores
+        modify_xdsinp(xdsinp, inp_params=[("MAXIMUM_NUMBER_OF_PROCESSORS", str(max(1, params.nproc//(njobs or 1)))),
                                           ])
+        if njobs is not None:
+            modify_xdsinp(xdsinp, inp_params=[("MAXIMUM_NUMBER_OF_JOBS", str(njobs)),
+                                              ])
 
     if params.mode == "initial":
         # Peak search
@@ -531,7 +546,7 @@ def xds_sequence(root, params):
     decilog.close()
 # xds_sequence()
 
-def run_xds_sequence(root, params):
+def run_xds_sequence(root, params, njobs=None):
     tmpdir = None
     
     if params.use_tmpdir_if_available:
@@ -541,7 +556,7 @@ def run_xds_sequence(root, params):
 
     # If tmpdir is not used
     if tmpdir is None:
-        return xds_sequence(root, params)
+        return xds_sequence(root, params, njobs)
 
     print "Using %s as temp dir.." % tmpdir
 
@@ -562,7 +577,7 @@ def run_xds_sequence(root, params):
                                        os.path.join("data_loc", os.path.basename(org_data_template)))])
 
     try:
-        ret = xds_sequence(tmpdir, params)
+        ret = xds_sequence(tmpdir, params, njobs)
     finally:
         # Revert XDS.INP
         modify_xdsinp(xdsinp, inp_params=[("NAME_TEMPLATE_OF_DATA_FRAMES", org_data_template)])
@@ -602,6 +617,57 @@ class xds_runmanager(object):
 
 # xds_runmanager()
 
+def dataset_nframes(root):
+    data_range = dict(get_xdsinp_keyword(os.path.join(root, "XDS.INP"))).get("DATA_RANGE", "").split()
+    if len(data_range) != 2: return 1
+    return max(1, int(data_range[1]) - int(data_range[0]) + 1)
+# dataset_nframes()
+
+def _scheduled_run(root, params, ncores, njobs):
+    params = copy.deepcopy(params)
+    params.nproc = ncores
+    try:
+        run_xds_sequence(root, params, njobs)
+    except:
+        print traceback.format_exc()
+# _scheduled_run()
+
+def run_scheduled(xds_dirs, params, total_cores):
+    """
+    Run xds_sequence() for xds_dirs in processes, keeping the total number of cores used <= total_cores.
+    Larger datasets are started first. Each gets min(nframes/frames_per_core, total_cores/(datasets waiting), free cores)
+    cores, which decide DELPHI= and MAXIMUM_NUMBER_OF_PROCESSORS/JOBS=. Cores freed by finished runs are given to waiting ones.
+    """
+    queue = sorted(map(lambda x: (dataset_nframes(x), x), xds_dirs), reverse=True)
+    running = [] # (process, ncores, root)
+    free = total_cores
+
+    while queue or running:
+        while queue and free > 0:
+            nframes, root = queue.pop(0)
+            need = -(-nframes // params.scheduler.frames_per_core)
+            share = max(1, total_cores // (len(queue)+1))
+            ncores = max(1, min(need, share, free))
+            njobs = None
+            if params.scheduler.processors_per_job is not None:
+                njobs = max(1, ncores // params.scheduler.processors_per_job)
+
+            p = multiprocessing.Process(target=_scheduled_run, args=(root, params, ncores, njobs))
+            p.start()
+            running.append((p, ncores, root))
+            free -= ncores
+            print "Started %s (%d frames) with %d cores (jobs=%s). %d waiting, %d cores free" % (os.path.relpath(root, params.topdir),
+                                                                                             nframes, ncores, njobs,
+                                                                                             len(queue), free)
+
+        time.sleep(1)
+        for p, ncores, root in filter(lambda x: not x[0].is_alive(), running):
+            p.join()
+            running.remove((p, ncores, root))
+            free += ncores
+            print "Finished %s" % os.path.relpath(root, params.topdir)
+# run_scheduled()
+
 def run(params):
     params.topdir = os.path.abspath(params.topdir)
 
@@ -621,7 +687,11 @@ def run(params):
     import functools
     from yamtbx.dataproc.auto.command_line import run_all_xds_simple
 
-    if params.multiproc:
+    if params.multiproc and params.parmethod == "multiprocessing":
+        ncores = util.get_number_of_processors() if params.nproc is None else params.nproc
+        print "Total cores=", ncores
+        run_scheduled(xds_dirs, params, ncores)
+    elif params.multiproc:
         npar = util.get_number_of_processors() if params.nproc is None else params.nproc
 
         # Override nproc
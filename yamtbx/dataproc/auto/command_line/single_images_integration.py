@@ -15,6 +15,8 @@ import numpy
 import glob
 import time
 import tempfile
+import collections
+import cStringIO
 
 from yamtbx.dataproc.xds import xds_inp
 from yamtbx.dataproc.xds import modify_xdsinp
@@ -22,6 +24,7 @@ from yamtbx.dataproc.xds.xparm import XPARM
 from yamtbx.dataproc.xds import integrate_hkl_as_flex
 from yamtbx.dataproc.xds import xds_ascii
 from yamtbx.dataproc.auto.command_line.run_all_xds_simple import run_xds, try_indexing_hard
+from yamtbx.dataproc.auto import frame_result_store
 from yamtbx.dataproc import crystfel
 from yamtbx.dataproc import cbf
 
@@ -147,6 +150,18 @@ light_pickle = false
 tmpdir = None
  .type = path
  .help = temporary directory for xds run
+
+eiger_batch {
+ enable = False
+  .type = bool
+  .help = Process EIGER frames (master.h5<>frame in lstin) in groups. Results are saved in topdir/results/ instead of a directory per frame.
+ frames_per_group = 100
+  .type = int(value_min=1)
+  .help = Number of frames processed in a work area by a process
+ workdir = None
+  .type = path
+  .help = Where work areas are made. Default is tmpdir if given, otherwise /dev/shm (if writable) or topdir.
+}
 """
 
 bool_to_str = lambda x: ("FALSE", "TRUE")[int(x)]
@@ -246,6 +261,161 @@ def check_cell(params, xs):
     return cosets
 # check_cell()
 
+def integrate_in_dir(tmpdir, params, decilog):
+    """
+    Run XDS from indexing to CORRECT in tmpdir, where XDS.INP for a single image is prepared.
+    Raises ProcFailed.
+    """
+    xparm = os.path.join(tmpdir, "XPARM.XDS")
+    xdsinp = os.path.join(tmpdir, "XDS.INP")
+    integrate_hkl = os.path.join(tmpdir, "INTEGRATE.HKL")
+
+    # Start processing
+    modify_xdsinp(xdsinp, inp_params=[("JOB", "XYCORR INIT COLSPOT IDXREF"),
+                                      ("MAXIMUM_NUMBER_OF_PROCESSORS", "1"),
+                                      ("MINPK", "%.2f"%params.minpk),
+                                      ("PROFILE_FITTING", bool_to_str(params.profile_fitting)),
+                                      ("STRONG_PIXEL", "%.2f"%params.strong_pixel),
+                                      ("MINIMUM_NUMBER_OF_PIXELS_IN_A_SPOT", "%d"%params.minimum_number_of_pixels_in_a_spot),
+                                      ("SEPMIN", "%.2f"%params.sepmin),
+                                      ("CLUSTER_RADIUS", "%.2f"%params.cluster_radius),
+                                      ("INDEX_ERROR", "%.4f"%params.index_error),
+                                      ("INDEX_MAGNITUDE", "%d"%params.index_magnitude),
+                                      ("INDEX_QUALITY", "%.2f"%params.index_quality),
+                                      ("REFINE(IDXREF)", " ".join(params.refine_idxref)),
+                                      ("INCLUDE_RESOLUTION_RANGE", "%.2f %.2f" % (params.d_max, params.idxref_d_min)),
+                                      ("VALUE_RANGE_FOR_TRUSTED_DETECTOR_PIXELS", "%.1f %.1f" % tuple(params.value_range_for_trusted_detector_pixels))
+                                      ])
+
+    if len(params.extra_inp_str) > 0:
+        ofs = open(xdsinp, "a")
+        ofs.write("\n%s\n" % "\n".join(params.extra_inp_str))
+        ofs.close()
+
+    run_xds(wdir=tmpdir, show_progress=False)
+
+    if params.tryhard:
+        try_indexing_hard(tmpdir, show_progress=True, decilog=decilog)
+
+        # If Cell hint exists, try to use it..
+        if params.sgnum > 0:
+            flag_try_cell_hint = False
+            if not os.path.isfile(xparm):
+                flag_try_cell_hint = True
+            else:
+                xsxds = XPARM(xparm).crystal_symmetry()
+                cosets = check_cell(params, xsxds)
+                if cosets.double_cosets is None: flag_try_cell_hint = True
+
+            if flag_try_cell_hint:
+                print >>decilog, " Worth trying to use prior cell for indexing."
+                modify_xdsinp(xdsinp, inp_params=[("JOB", "IDXREF"),
+                                                  ("UNIT_CELL_CONSTANTS",
+                                                   " ".join(map(lambda x: "%.3f"%x, params.cell))),
+                                                  ("SPACE_GROUP_NUMBER", "%d"%params.sgnum),
+                                                  ])
+                run_xds(wdir=tmpdir, show_progress=False)
+                modify_xdsinp(xdsinp, inp_params=[("SPACE_GROUP_NUMBER", "0"),
+                                                  ])
+
+    if not os.path.isfile(xparm):
+        raise ProcFailed("Indexing failed")
+
+    if params.checkcell.check and params.sgnum > 0:
+        xsxds = XPARM(xparm).crystal_symmetry()
+        cosets = check_cell(params, xsxds)
+        if cosets.double_cosets is None:
+            raise ProcFailed("Incompatible cell. Indexing failed.")
+
+        if not cosets.combined_cb_ops()[0].is_identity_op():
+            print >>decilog, "Re-idxref to match reference symmetry."
+            xsxds_cb = xsxds.change_basis(cosets.combined_cb_ops()[0]) # Really OK??
+            modify_xdsinp(xdsinp, inp_params=[("JOB", "IDXREF"),
+                                              ("SPACE_GROUP_NUMBER", "%d"%params.sgnum),
+                                              ("UNIT_CELL_CONSTANTS", " ".join(map(lambda x: "%.3f"%x, xsxds_cb.unit_cell().parameters())))
+                                              ])
+            run_xds(wdir=tmpdir, show_progress=False)
+
+    modify_xdsinp(xdsinp, inp_params=[("INCLUDE_RESOLUTION_RANGE", "%.2f %.2f" % (params.d_max, params.d_min)),
+                                      ])
+
+    # To Integration
+    modify_xdsinp(xdsinp, inp_params=[("JOB", "DEFPIX INTEGRATE"),])
+    run_xds(wdir=tmpdir, show_progress=False)
+
+    if not os.path.isfile(integrate_hkl):
+        raise ProcFailed("Integration failed.")
+
+    # Determine unit cell in CORRECT
+    if params.refine_correct:
+        tmp = [("REFINE(CORRECT)", "ALL"),
+               ("UNIT_CELL_CONSTANTS", " ".join(map(lambda x: "%.3f"%x, params.cell)))]
+    else:
+        # XXX What if CELL is refined in INTEGRATE?
+        xsxds = XPARM(xparm).crystal_symmetry()
+        cosets = check_cell(params, xsxds)
+        if cosets.double_cosets is None:
+            raise ProcFailed(" Incompatible cell. Failed before CORRECT.")
+
+        xsxds_cb = xsxds.change_basis(cosets.combined_cb_ops()[0]) # Really OK??
+        tmp = [("REFINE(CORRECT)", ""),
+               ("UNIT_CELL_CONSTANTS", " ".join(map(lambda x: "%.3f"%x, xsxds_cb.unit_cell().parameters())))]
+
+    # PEAK-corrected INTEGRATE.HKL
+    ihk = os.path.join(tmpdir, "INTEGRATE.HKL")
+    ihk_full = os.path.join(tmpdir, "INTEGRATE_full.HKL")
+    ihk_part = os.path.join(tmpdir, "INTEGRATE_part.HKL")
+    inhkl = integrate_hkl_as_flex.reader(ihk, [], False)
+    inhkl.write_peak_corrected(ihk_part)
+    os.rename(ihk, ihk_full)
+    
+    modify_xdsinp(xdsinp, inp_params=[("JOB", "CORRECT"),
+                                      ("DATA_RANGE", "1 20000"),
+                                      ("CORRECTIONS", ""),
+                                      ("NBATCH", "1"),
+                                      ("SPACE_GROUP_NUMBER", "%d"%params.sgnum)] + tmp)
+
+    xac = os.path.join(tmpdir, "XDS_ASCII.HKL")
+    xac_full = os.path.join(tmpdir, "XDS_ASCII_full.HKL")
+    xac_part = os.path.join(tmpdir, "XDS_ASCII_part.HKL")
+
+    # CORRECT for full
+    os.symlink(ihk_full, ihk)
+    run_xds(wdir=tmpdir, comm="xds", show_progress=False)
+    if os.path.isfile(xac):
+        os.rename(xac, xac_full)
+        os.rename(os.path.join(tmpdir, "CORRECT.LP"),
+                  os.path.join(tmpdir, "CORRECT_full.LP"))
+    os.remove(ihk)
+
+    # CORRECT for part
+    os.symlink(ihk_part, ihk)
+    run_xds(wdir=tmpdir, comm="xds", show_progress=False)
+    if os.path.isfile(xac):
+        os.rename(xac, xac_part)
+        os.rename(os.path.join(tmpdir, "CORRECT.LP"),
+                  os.path.join(tmpdir, "CORRECT_part.LP"))
+    os.remove(ihk)
+# integrate_in_dir()
+
+def read_results(tmpdir, params, decilog):
+    """
+    Returns OrderedDict of file name -> XDS_ASCII or integrate_hkl_as_flex.reader object
+    for XDS_ASCII_{part,full}.HKL and INTEGRATE_{part,full}.HKL found in tmpdir.
+    """
+    ret = collections.OrderedDict()
+    for f in ("XDS_ASCII_part.HKL", "XDS_ASCII_full.HKL"):
+        if not os.path.isfile(os.path.join(tmpdir, f)): continue
+        x = xds_ascii.XDS_ASCII(os.path.join(tmpdir, f), log_out=decilog)
+        if params.light_pickle: x.xd, x.yd, x.zd, x.rlp, x.corr = None, None, None, None, None # To make reading faster
+        ret[f] = x
+    for f in ("INTEGRATE_part.HKL", "INTEGRATE_full.HKL"):
+        if not os.path.isfile(os.path.join(tmpdir, f)): continue
+        ret[f] = integrate_hkl_as_flex.reader(os.path.join(tmpdir, f),
+                                              read_columns=["IOBS","SIGMA","XCAL","YCAL","RLP","PEAK","MAXC"])
+    return ret
+# read_results()
+
 def xds_sequence(img_in, topdir, data_root_dir, params):
     relpath = os.path.relpath(os.path.dirname(img_in), data_root_dir)
     workdir = os.path.abspath(os.path.join(topdir, relpath, os.path.splitext(os.path.basename(img_in))[0]))
@@ -274,9 +444,7 @@ def xds_sequence(img_in, topdir, data_root_dir, params):
         
     if not os.path.exists(tmpdir): os.makedirs(tmpdir)
 
-    xparm = os.path.join(tmpdir, "XPARM.XDS")
     xdsinp = os.path.join(tmpdir, "XDS.INP")
-    integrate_hkl = os.path.join(tmpdir, "INTEGRATE.HKL")
     decilog = open(os.path.join(tmpdir, "decision.log"), "w")
 
     try:
@@ -311,144 +479,13 @@ def xds_sequence(img_in, topdir, data_root_dir, params):
         ofs = open(xdsinp, "w")
         ofs.write(xdsinp_str)
         ofs.close()
-        # Start processing
-        modify_xdsinp(xdsinp, inp_params=[("JOB", "XYCORR INIT COLSPOT IDXREF"),
-                                          ("MAXIMUM_NUMBER_OF_PROCESSORS", "1"),
-                                          ("MINPK", "%.2f"%params.minpk),
-                                          ("PROFILE_FITTING", bool_to_str(params.profile_fitting)),
-                                          ("STRONG_PIXEL", "%.2f"%params.strong_pixel),
-                                          ("MINIMUM_NUMBER_OF_PIXELS_IN_A_SPOT", "%d"%params.minimum_number_of_pixels_in_a_spot),
-                                          ("SEPMIN", "%.2f"%params.sepmin),
-                                          ("CLUSTER_RADIUS", "%.2f"%params.cluster_radius),
-                                          ("INDEX_ERROR", "%.4f"%params.index_error),
-                                          ("INDEX_MAGNITUDE", "%d"%params.index_magnitude),
-                                          ("INDEX_QUALITY", "%.2f"%params.index_quality),
-                                          ("REFINE(IDXREF)", " ".join(params.refine_idxref)),
-                                          ("INCLUDE_RESOLUTION_RANGE", "%.2f %.2f" % (params.d_max, params.idxref_d_min)),
-                                          ("VALUE_RANGE_FOR_TRUSTED_DETECTOR_PIXELS", "%.1f %.1f" % tuple(params.value_range_for_trusted_detector_pixels))
-                                          ])
-
-        if len(params.extra_inp_str) > 0:
-            ofs = open(xdsinp, "a")
-            ofs.write("\n%s\n" % "\n".join(params.extra_inp_str))
-            ofs.close()
-
-        run_xds(wdir=tmpdir, show_progress=False)
-
-        if params.tryhard:
-            try_indexing_hard(tmpdir, show_progress=True, decilog=decilog)
-
-            # If Cell hint exists, try to use it..
-            if params.sgnum > 0:
-                flag_try_cell_hint = False
-                if not os.path.isfile(xparm):
-                    flag_try_cell_hint = True
-                else:
-                    xsxds = XPARM(xparm).crystal_symmetry()
-                    cosets = check_cell(params, xsxds)
-                    if cosets.double_cosets is None: flag_try_cell_hint = True
-
-                if flag_try_cell_hint:
-                    print >>decilog, " Worth trying to use prior cell for indexing."
-                    modify_xdsinp(xdsinp, inp_params=[("JOB", "IDXREF"),
-                                                      ("UNIT_CELL_CONSTANTS",
-                                                       " ".join(map(lambda x: "%.3f"%x, params.cell))),
-                                                      ("SPACE_GROUP_NUMBER", "%d"%params.sgnum),
-                                                      ])
-                    run_xds(wdir=tmpdir, show_progress=False)
-                    modify_xdsinp(xdsinp, inp_params=[("SPACE_GROUP_NUMBER", "0"),
-                                                      ])
-
-        if not os.path.isfile(xparm):
-            raise ProcFailed("Indexing failed")
-
-        if params.checkcell.check and params.sgnum > 0:
-            xsxds = XPARM(xparm).crystal_symmetry()
-            cosets = check_cell(params, xsxds)
-            if cosets.double_cosets is None:
-                raise ProcFailed("Incompatible cell. Indexing failed.")
-
-            if not cosets.combined_cb_ops()[0].is_identity_op():
-                print >>decilog, "Re-idxref to match reference symmetry."
-                xsxds_cb = xsxds.change_basis(cosets.combined_cb_ops()[0]) # Really OK??
-                modify_xdsinp(xdsinp, inp_params=[("JOB", "IDXREF"),
-                                                  ("SPACE_GROUP_NUMBER", "%d"%params.sgnum),
-                                                  ("UNIT_CELL_CONSTANTS", " ".join(map(lambda x: "%.3f"%x, xsxds_cb.unit_cell().parameters())))
-                                                  ])
-                run_xds(wdir=tmpdir, show_progress=False)
-
-        modify_xdsinp(xdsinp, inp_params=[("INCLUDE_RESOLUTION_RANGE", "%.2f %.2f" % (params.d_max, params.d_min)),
-                                          ])
-
-        # To Integration
-        modify_xdsinp(xdsinp, inp_params=[("JOB", "DEFPIX INTEGRATE"),])
-        run_xds(wdir=tmpdir, show_progress=False)
 
-        if not os.path.isfile(integrate_hkl):
-            raise ProcFailed("Integration failed.")
+        integrate_in_dir(tmpdir, params, decilog)
 
-        # Determine unit cell in CORRECT
-        if params.refine_correct:
-            tmp = [("REFINE(CORRECT)", "ALL"),
-                   ("UNIT_CELL_CONSTANTS", " ".join(map(lambda x: "%.3f"%x, params.cell)))]
-        else:
-            # XXX What if CELL is refined in INTEGRATE?
-            xsxds = XPARM(xparm).crystal_symmetry()
-            cosets = check_cell(params, xsxds)
-            if cosets.double_cosets is None:
-                raise ProcFailed(" Incompatible cell. Failed before CORRECT.")
-
-            xsxds_cb = xsxds.change_basis(cosets.combined_cb_ops()[0]) # Really OK??
-            tmp = [("REFINE(CORRECT)", ""),
-                   ("UNIT_CELL_CONSTANTS", " ".join(map(lambda x: "%.3f"%x, xsxds_cb.unit_cell().parameters())))]
-
-        # PEAK-corrected INTEGRATE.HKL
-        ihk = os.path.join(tmpdir, "INTEGRATE.HKL")
-        ihk_full = os.path.join(tmpdir, "INTEGRATE_full.HKL")
-        ihk_part = os.path.join(tmpdir, "INTEGRATE_part.HKL")
-        inhkl = integrate_hkl_as_flex.reader(ihk, [], False)
-        inhkl.write_peak_corrected(ihk_part)
-        os.rename(ihk, ihk_full)
-        
-        modify_xdsinp(xdsinp, inp_params=[("JOB", "CORRECT"),
-                                          ("DATA_RANGE", "1 20000"),
-                                          ("CORRECTIONS", ""),
-                                          ("NBATCH", "1"),
-                                          ("SPACE_GROUP_NUMBER", "%d"%params.sgnum)] + tmp)
-
-        xac = os.path.join(tmpdir, "XDS_ASCII.HKL")
-        xac_full = os.path.join(tmpdir, "XDS_ASCII_full.HKL")
-        xac_part = os.path.join(tmpdir, "XDS_ASCII_part.HKL")
-
-        # CORRECT for full
-        os.symlink(ihk_full, ihk)
-        run_xds(wdir=tmpdir, comm="xds", show_progress=False)
-        if os.path.isfile(xac):
-            os.rename(xac, xac_full)
-            os.rename(os.path.join(tmpdir, "CORRECT.LP"),
-                      os.path.join(tmpdir, "CORRECT_full.LP"))
-        os.remove(ihk)
-
-        # CORRECT for part
-        os.symlink(ihk_part, ihk)
-        run_xds(wdir=tmpdir, comm="xds", show_progress=False)
-        if os.path.isfile(xac):
-            os.rename(xac, xac_part)
-            os.rename(os.path.join(tmpdir, "CORRECT.LP"),
-                      os.path.join(tmpdir, "CORRECT_part.LP"))
-        os.remove(ihk)
-
-        if params.pickle_hkl:
-            for f in filter(lambda x: os.path.isfile(x), (xac_part, xac_full)):
-                print >>decilog, "Pickling %s" % os.path.basename(f)
-                x = xds_ascii.XDS_ASCII(f, log_out=decilog)
-                if params.light_pickle: x.xd, x.yd, x.zd, x.rlp, x.corr = None, None, None, None, None # To make reading faster
-                pickle.dump(x, open(f+".pkl", "w"), -1)
         if params.pickle_hkl:
-            for f in filter(lambda x: os.path.isfile(x), (ihk_part, ihk_full)):
+            for f, obj in read_results(tmpdir, params, decilog).items():
                 print >>decilog, "Pickling %s" % os.path.basename(f)
-                inhkl = integrate_hkl_as_flex.reader(f, read_columns=["IOBS","SIGMA","XCAL","YCAL","RLP","PEAK","MAXC"])
-                pickle.dump(inhkl, open(f+".pkl", "w"), -1)
+                pickle.dump(obj, open(os.path.join(tmpdir, f+".pkl"), "w"), -1)
 
     except ProcFailed, e:
         print >>decilog, "Processing failed: %s" % e.message
@@ -463,6 +500,84 @@ def xds_sequence(img_in, topdir, data_root_dir, params):
 
 # xds_sequence()
 
+def xds_sequence_eiger_batch(h5master, frames, pklout, params):
+    """
+    Process frames of an EIGER master file one by one in a single work area, which is cleaned and reused.
+    The master file is opened only once, and XDS.INP is generated only for the first frame.
+    Results (see read_results()) of all frames are written to pklout by frame_result_store.GroupWriter.
+    Returns index entries of the frames.
+    """
+    from yamtbx.dataproc import eiger
+
+    workbase = params.eiger_batch.workdir
+    if workbase is None: workbase = params.tmpdir
+    if workbase is None: workbase = "/dev/shm" if os.access("/dev/shm", os.W_OK) else os.path.dirname(pklout)
+
+    tmpdir = tempfile.mkdtemp(prefix="xds", dir=workbase)
+    xdsinp = os.path.join(tmpdir, "XDS.INP")
+    img_in_work = os.path.join(tmpdir, "data_10000.cbf")
+    xdsinp_str = None
+    extractor = None
+
+    writer = frame_result_store.GroupWriter(pklout)
+    grouplog = open(os.path.splitext(pklout)[0] + ".log", "w")
+    print >>grouplog, "Paramters:"
+    libtbx.phil.parse(master_params_str).format(params).show(out=grouplog, prefix=" ")
+
+    try:
+        extractor = eiger.MinicbfExtractor(h5master)
+
+        for frame_num in frames:
+            for f in os.listdir(tmpdir):
+                f = os.path.join(tmpdir, f)
+                if os.path.isdir(f): shutil.rmtree(f)
+                else: os.remove(f)
+
+            decilog = cStringIO.StringIO()
+            result = dict(img_in=h5master, frame=frame_num, failed=None)
+            print >>decilog, "\nFrame %d of %s" % (frame_num, h5master)
+            print >>decilog, "Starting at %s" % time.strftime("%Y-%m-%d %H:%M:%S")
+
+            try:
+                extractor.write_minicbf(frame_num, img_in_work)
+                if xdsinp_str is None:
+                    xdsinp_str = xds_inp.generate_xds_inp(img_files=[img_in_work],
+                                                          inp_dir=tmpdir,
+                                                          reverse_phi=True, anomalous=params.anomalous,
+                                                          spot_range=None, minimum=False,
+                                                          crystal_symmetry=None,
+                                                          integrate_nimages=None,
+                                                          osc_range=params.osc_range,
+                                                          orgx=params.orgx, orgy=params.orgy,
+                                                          rotation_axis=params.rotation_axis,
+                                                          distance=params.distance)
+                ofs = open(xdsinp, "w")
+                ofs.write(xdsinp_str)
+                ofs.close()
+
+                integrate_in_dir(tmpdir, params, decilog)
+                result.update(read_results(tmpdir, params, decilog))
+            except ProcFailed, e:
+                print >>decilog, "Processing failed: %s" % e.message
+                result["failed"] = e.message
+            except:
+                print >>decilog, "Uncaught exception:"
+                print >>decilog, traceback.format_exc()
+                result["failed"] = "Uncaught exception"
+
+            print >>decilog, "Finished at %s" % time.strftime("%Y-%m-%d %H:%M:%S")
+            result["log"] = decilog.getvalue()
+            writer.add("%s<>%d" % (h5master, frame_num), result)
+            grouplog.write(result["log"])
+    finally:
+        if extractor is not None: extractor.close()
+        writer.close()
+        grouplog.close()
+        shutil.rmtree(tmpdir)
+
+    return writer.entries
+# xds_sequence_eiger_batch()
+
 def get_file_list(lstin):
     ret = []
     for l in open(lstin):
@@ -472,8 +587,49 @@ def get_file_list(lstin):
     return ret
 # get_file_list()
 
+def run_eiger_batch(eiger_frames, params):
+    """
+    eiger_frames: OrderedDict of master file -> list of frame numbers
+    """
+    storedir = os.path.join(params.topdir, "results")
+    if not os.path.exists(storedir): os.makedirs(storedir)
+
+    args = []
+    for i, (h5master, frames) in enumerate(eiger_frames.items()):
+        prefix = os.path.basename(h5master).replace("_master.h5", "")
+        for j in xrange(0, len(frames), params.eiger_batch.frames_per_group):
+            group = frames[j:j+params.eiger_batch.frames_per_group]
+            args.append((h5master, group, os.path.join(storedir, "%.4d_%s_%.6d.pkl" % (i, prefix, group[0]))))
+
+    def fun_local(x):
+        try:
+            return xds_sequence_eiger_batch(x[0], x[1], x[2], params)
+        except:
+            print "Error in processing %s" % x[2]
+            print traceback.format_exc()
+            return []
+
+    ret = easy_mp.pool_map(fixed_func=fun_local,
+                           args=args,
+                           processes=params.nproc)
+
+    frame_result_store.write_index(storedir, sum(ret, []))
+    print "Results saved in %s" % storedir
+# run_eiger_batch()
+
 def run(params):
     input_files = get_file_list(params.lstin)
+
+    if params.eiger_batch.enable:
+        eiger_frames = collections.OrderedDict()
+        for f in filter(lambda x: "<>" in x, input_files):
+            img_in, num = f.split("<>")
+            eiger_frames.setdefault(img_in, []).append(int(num))
+
+        input_files = filter(lambda x: "<>" not in x, input_files)
+        if eiger_frames: run_eiger_batch(eiger_frames, params)
+        if not input_files: return
+
     top_dirs = map(lambda i: os.path.join(params.topdir, "split_%.4d" % (i//params.split_num+1)),
                    xrange(len(input_files)))
 
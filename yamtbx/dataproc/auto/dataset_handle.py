@@ -0,0 +1,68 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Handles of datasets whose merged intensities are read only when needed.
+
+Used for many-dataset analyses (CC-based clustering, indexing ambiguity
+resolution) instead of keeping merged arrays of all files in memory. A handle
+keeps only the file name, the parameters and (once read) the crystal symmetry
+and number of reflections. get() reads the file each time it is called unless
+hold() has been called.
+"""
+
+import os
+from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
+
+class MergedXdsAscii:
+    def __init__(self, xac_file, d_min=None, d_max=None, min_ios=None, min_ios_before_merge=False):
+        self.xac_file = xac_file
+        self.d_min, self.d_max = d_min, d_max
+        self.min_ios = min_ios
+        self.min_ios_before_merge = min_ios_before_merge
+        self.modifier = None # function applied to the merged array, e.g. for scaling
+        self.symm, self.n_refl = None, None
+        self._array = None
+    # __init__()
+
+    def load(self):
+        xac = XDS_ASCII(self.xac_file, i_only=True)
+        xac.remove_rejected()
+        a = xac.i_obs().resolution_filter(d_min=self.d_min, d_max=self.d_max)
+        if self.min_ios is not None and self.min_ios_before_merge: a = a.select(a.data()/a.sigmas()>=self.min_ios)
+        a = a.as_non_anomalous_array().merge_equivalents(use_internal_variance=False).array()
+        if self.min_ios is not None and not self.min_ios_before_merge: a = a.select(a.data()/a.sigmas()>=self.min_ios)
+        if self.modifier is not None: a = self.modifier(a)
+
+        self.symm, self.n_refl = a.crystal_symmetry(), a.size()
+        return a
+    # load()
+
+    def get(self):
+        if self._array is not None: return self._array
+        return self.load()
+    # get()
+
+    def hold(self):
+        # Keep the array in memory until release()
+        if self._array is None: self._array = self.load()
+    # hold()
+
+    def release(self):
+        self._array = None
+    # release()
+
+    def crystal_symmetry(self):
+        if self.symm is None: self.get()
+        return self.symm
+    # crystal_symmetry()
+
+    def estimated_size(self):
+        # Upper estimate of the number of reflections, without reading the file (about 100 bytes per line)
+        if self.n_refl is not None: return self.n_refl
+        return os.path.getsize(self.xac_file) // 100 + 1
+    # estimated_size()
+# class MergedXdsAscii
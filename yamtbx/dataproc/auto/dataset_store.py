@@ -0,0 +1,174 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Shared-memory store of merged intensity arrays for multi-process workers.
+
+All datasets are packed into flat arrays (indices, data, sigmas and packed
+hkl keys) with an offset table, and written as raw files under a directory
+(by default on /dev/shm).  Workers attach the files read-only with
+numpy.memmap, so the pages are shared among all processes instead of being
+copied into each worker.
+
+Within a dataset, reflections are sorted by the packed hkl key so that
+common reflections between two datasets can be found with searchsorted.
+"""
+
+import os
+import json
+import shutil
+import numpy
+from cctbx import crystal
+from cctbx import miller
+from cctbx.array_family import flex
+from yamtbx import util
+from yamtbx.util.maths import pack_hkl, linear_correlation
+
+_files = dict(indices=("indices.bin", numpy.int32, 3),
+              data=("data.bin", numpy.float64, 1),
+              sigmas=("sigmas.bin", numpy.float64, 1),
+              keys=("keys.bin", numpy.int64, 1))
+
+_attached = {} # path -> SharedDatasetStore; per-process cache for workers
+
+class SharedDatasetStore:
+    def __init__(self, path, mode="r"):
+        self.path = path
+        meta = json.load(open(os.path.join(path, "meta.json")))
+        self.names = meta["names"]
+        self.cells = meta["cells"]
+        self.space_groups = meta["space_groups"]
+        self.anomalous_flags = meta["anomalous_flags"]
+        self.offsets = numpy.array(meta["offsets"], dtype=numpy.int64)
+        nref = int(self.offsets[-1])
+
+        for key, (fname, dtype, ncol) in _files.items():
+            shape = (nref, ncol) if ncol > 1 else (nref,)
+            if nref == 0:
+                arr = numpy.zeros(shape, dtype=dtype)
+            else:
+                arr = numpy.memmap(os.path.join(path, fname), dtype=dtype, mode=mode, shape=shape)
+            setattr(self, key, arr)
+    # __init__()
+
+    @classmethod
+    def from_arrays(cls, arrays, path=None, nref_hint=None):
+        """
+        arrays: OrderedDict of name -> miller.array, list of miller.array, or any iterable of miller.array.
+        Arrays are written one by one and not kept, so a generator can be given to avoid having all in memory.
+        nref_hint: estimate of total number of reflections to choose temp dir (if arrays is not a list or dict)
+        If path is None, a directory on local ramdisk (or tmp) is created.
+        """
+        names = None
+        if isinstance(arrays, dict): names, arrays = map(str, arrays.keys()), arrays.values()
+        if isinstance(arrays, (list, tuple)): nref_hint = sum(map(lambda x: x.size(), arrays))
+
+        if path is None:
+            path = util.get_temp_local_dir("dsstore", min_kb=((nref_hint or 0)*44)//1024+1)
+            if path is None: raise RuntimeError("Can't get temp dir with sufficient size.")
+        elif not os.path.exists(path):
+            os.makedirs(path)
+
+        ofs = dict(map(lambda k: (k, open(os.path.join(path, _files[k][0]), "wb")), _files))
+        offsets = [0]
+        cells, space_groups, anomalous_flags = [], [], []
+
+        for a in arrays:
+            offsets.append(offsets[-1] + a.size())
+            cells.append(a.unit_cell().parameters())
+            space_groups.append(str(a.space_group_info()))
+            anomalous_flags.append(bool(a.anomalous_flag()))
+            if a.size() == 0: continue
+
+            indices = a.indices().as_vec3_double().as_double().as_numpy_array().astype(numpy.int32).reshape(-1, 3)
+            keys = pack_hkl(indices)
+            perm = numpy.argsort(keys, kind="mergesort")
+            if a.sigmas() is not None: sigmas = a.sigmas().as_numpy_array()[perm]
+            else: sigmas = numpy.zeros(a.size())
+            for key, val in (("indices", indices[perm]), ("keys", keys[perm]),
+                             ("data", a.data().as_numpy_array()[perm]), ("sigmas", sigmas)):
+                ofs[key].write(numpy.ascontiguousarray(val, dtype=_files[key][1]).tostring())
+
+        for f in ofs.values(): f.close()
+
+        if names is None: names = map(str, xrange(len(cells)))
+        meta = dict(names=names,
+                    cells=cells,
+                    space_groups=space_groups,
+                    anomalous_flags=anomalous_flags,
+                    offsets=offsets)
+        json.dump(meta, open(os.path.join(path, "meta.json"), "w"))
+
+        return cls(path)
+    # from_arrays()
+
+    def __len__(self): return len(self.names)
+
+    def size(self, i): return int(self.offsets[i+1] - self.offsets[i])
+
+    def get_numpy(self, i):
+        """
+        Returns zero-copy views (indices, data, sigmas) of i-th dataset, sorted by hkl.
+        """
+        s, e = self.offsets[i], self.offsets[i+1]
+        return self.indices[s:e], self.data[s:e], self.sigmas[s:e]
+    # get_numpy()
+
+    def get_array(self, i):
+        """
+        Returns i-th dataset as miller.array. Note that this makes a copy.
+        """
+        indices, data, sigmas = self.get_numpy(i)
+        symm = crystal.symmetry(self.cells[i], self.space_groups[i])
+        mset = miller.set(crystal_symmetry=symm,
+                          indices=flex.miller_index(map(tuple, indices.tolist())),
+                          anomalous_flag=self.anomalous_flags[i])
+        return miller.array(mset, data=flex.double(data.tolist()),
+                            sigmas=flex.double(sigmas.tolist()))
+    # get_array()
+
+    def common_selection(self, i, j):
+        """
+        Returns positions (in i and j datasets) of common reflections.
+        """
+        si, ei = self.offsets[i], self.offsets[i+1]
+        sj, ej = self.offsets[j], self.offsets[j+1]
+        ki, kj = self.keys[si:ei], self.keys[sj:ej]
+        if len(ki) == 0 or len(kj) == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+        pos = numpy.searchsorted(kj, ki)
+        pos[pos >= len(kj)] = 0
+        sel = kj[pos] == ki
+        return numpy.where(sel)[0], pos[sel]
+    # common_selection()
+
+    def calc_cc(self, i, j):
+        """
+        Equivalent to cc_clustering.calc_cc() for merged arrays. Returns (cc, nref).
+        """
+        seli, selj = self.common_selection(i, j)
+        x = self.data[self.offsets[i]:self.offsets[i+1]][seli]
+        y = self.data[self.offsets[j]:self.offsets[j+1]][selj]
+        return linear_correlation(x, y), len(seli)
+    # calc_cc()
+
+    def remove(self):
+        _attached.pop(self.path, None)
+        for key in _files: setattr(self, key, None)
+        if os.path.isdir(self.path): shutil.rmtree(self.path)
+    # remove()
+
+# class SharedDatasetStore
+
+def attach(path):
+    """
+    Attach store read-only. Attached store is cached in each process.
+    """
+    if path not in _attached:
+        _attached[path] = SharedDatasetStore(path, mode="r")
+    return _attached[path]
+# attach()
@@ -0,0 +1,88 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Indexed store of per-frame results of single image processing.
+
+Results (dicts of picklable objects) of a group of frames are appended to one
+pickle file by the worker that processed the group, and index.json in the
+store directory maps the key of each frame to (file name, byte offset).
+A result can then be loaded without reading the others, and the number of
+files does not grow with the number of frames.
+"""
+
+import os
+import json
+import cPickle as pickle
+
+class GroupWriter:
+    def __init__(self, pklout):
+        self.pklout = pklout
+        self.ofs = open(pklout, "wb")
+        self.entries = [] # (key, file name, offset)
+    # __init__()
+
+    def add(self, key, result):
+        self.entries.append((key, os.path.basename(self.pklout), self.ofs.tell()))
+        pickle.dump(result, self.ofs, -1)
+        self.ofs.flush()
+    # add()
+
+    def close(self):
+        self.ofs.close()
+    # close()
+# class GroupWriter
+
+def write_index(path, entries):
+    """
+    entries: list of (key, file name, offset) from GroupWriter(s).
+    Entries are added to existing index.json, if any.
+    """
+    jsonfile = os.path.join(path, "index.json")
+    index = json.load(open(jsonfile)) if os.path.isfile(jsonfile) else {}
+    for key, filename, offset in entries: index[key] = (filename, offset)
+
+    json.dump(index, open(jsonfile+".tmp", "w"), indent=0)
+    os.rename(jsonfile+".tmp", jsonfile)
+# write_index()
+
+class FrameResultStore:
+    def __init__(self, path):
+        self.path = path
+        self.index = json.load(open(os.path.join(path, "index.json")))
+    # __init__()
+
+    def __len__(self): return len(self.index)
+
+    def __contains__(self, key): return key in self.index
+
+    def keys(self): return sorted(self.index)
+
+    def get(self, key):
+        filename, offset = self.index[key]
+        ifs = open(os.path.join(self.path, filename), "rb")
+        ifs.seek(offset)
+        ret = pickle.load(ifs)
+        ifs.close()
+        return ret
+    # get()
+
+    def iteritems(self):
+        """
+        Reads files sequentially, in the order of keys within each file.
+        """
+        by_file = {}
+        for key, (filename, offset) in self.index.items():
+            by_file.setdefault(filename, []).append((offset, key))
+
+        for filename in sorted(by_file):
+            ifs = open(os.path.join(self.path, filename), "rb")
+            for offset, key in sorted(by_file[filename]):
+                ifs.seek(offset)
+                yield key, pickle.load(ifs)
+            ifs.close()
+    # iteritems()
+# class FrameResultStore
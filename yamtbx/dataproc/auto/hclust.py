@@ -0,0 +1,169 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Hierarchical clustering without R.
+
+linkage() works on a dissimilarity matrix in memory using the
+nearest-neighbor chain algorithm with Lance-Williams updates (O(N^2) memory).
+The result (merge, height) follows the convention of R's hclust(), and
+write_clusters_txt() and dendrogram_json() write the same files as the R
+scripts previously used (CLUSTERS.txt and dendro.json).
+
+method="ward" is the same as R's hclust(method="ward") (="ward.D"), i.e.
+the distances themselves (not squared) are updated by Ward's formula.
+"""
+
+import numpy
+
+methods = ("ward", "average", "complete")
+
+def _lance_williams(method, dki, dkj, dij, ni, nj, nk):
+    if method == "ward":
+        return ((ni+nk)*dki + (nj+nk)*dkj - nk*dij) / (ni+nj+nk)
+    elif method == "average":
+        return (ni*dki + nj*dkj) / float(ni+nj)
+    elif method == "complete":
+        return numpy.maximum(dki, dkj)
+    else:
+        raise ValueError("Unknown method: %s" % method)
+# _lance_williams()
+
+def linkage(dmat, method="ward"):
+    """
+    dmat: symmetric (n, n) matrix of dissimilarities.
+    Returns (merge, height) like R's hclust:
+     merge[k] = [a, b]; negative value -i for i-th data (1-based) and positive value k for cluster made in k-th (1-based) step.
+     height[k] is the dissimilarity at the k-th merge, in increasing order.
+    """
+    if method not in methods: raise ValueError("Unknown method: %s" % method)
+
+    n = dmat.shape[0]
+    d = numpy.array(dmat, dtype=numpy.float64)
+    numpy.fill_diagonal(d, float("inf"))
+    size = numpy.ones(n, dtype=numpy.float64)
+    label = range(-1, -n-1, -1) # current cluster in each slot
+    steps = [] # [label1, label2, height] in the order of merging (not sorted)
+    chain = []
+
+    for step in xrange(n-1):
+        if not chain:
+            chain.append(filter(lambda x: label[x] is not None, xrange(n))[0])
+
+        # Follow nearest neighbors until reciprocal nearest neighbors are found
+        while True:
+            a = chain[-1]
+            b = int(numpy.argmin(d[a]))
+            if len(chain) > 1 and d[a, chain[-2]] <= d[a, b]: b = chain[-2]
+            if len(chain) > 1 and b == chain[-2]: break
+            chain.append(b)
+
+        b, a = chain.pop(), chain.pop()
+        i, j = min(a, b), max(a, b)
+        h = d[i, j]
+        steps.append([label[i], label[j], h])
+
+        # Cluster i+j is stored in slot i
+        new = _lance_williams(method, d[i], d[j], h, size[i], size[j], size)
+        d[i,:] = new
+        d[:,i] = new
+        d[j,:] = float("inf")
+        d[:,j] = float("inf")
+        d[i,i] = float("inf")
+        size[i] += size[j]
+        label[i], label[j] = step+1, None
+
+    # Sort by height. Clusters must come after their children even if heights were not monotonic due to rounding.
+    eff_height = []
+    for l1, l2, h in steps:
+        eff_height.append(max([h] + map(lambda x: eff_height[x-1], filter(lambda x: x > 0, (l1, l2)))))
+
+    order = sorted(xrange(len(steps)), key=lambda x: (eff_height[x], x))
+    new_no = dict(map(lambda x: (x[1]+1, x[0]+1), enumerate(order)))
+
+    merge, height = [], []
+    for k in order:
+        l1, l2, h = steps[k]
+        l1, l2 = map(lambda x: new_no[x] if x > 0 else x, (l1, l2))
+        # Same ordering as R: singleton first; otherwise smaller one first
+        if (l1 > 0 and l2 < 0) or (l1 * l2 > 0 and abs(l1) > abs(l2)): l1, l2 = l2, l1
+        merge.append([l1, l2])
+        height.append(h)
+
+    return merge, height
+# linkage()
+
+def groups(merge, labels):
+    """
+    Returns list of members (labels) for each cluster. Same as treeToList2() in $CCP4/share/blend/R/blend0.R
+    """
+    ret = []
+    for l1, l2 in merge:
+        lab = []
+        for x in (l1, l2):
+            if x < 0: lab.append(labels[-x-1])
+            else: lab.extend(ret[x-1])
+        ret.append(lab)
+    return ret
+# groups()
+
+def leaf_order(merge):
+    """
+    Order of data in dendrogram (1-based), like hclust()$order.
+    """
+    if not merge: return [1]
+    order = []
+    stack = [len(merge)]
+    while stack:
+        x = stack.pop()
+        if x < 0: order.append(-x)
+        else: stack.extend(reversed(merge[x-1]))
+    return order
+# leaf_order()
+
+def write_clusters_txt(filename, merge, height, labels):
+    ofs = open(filename, "w")
+    ofs.write("ClNumber             Nds         Clheight   IDs\n")
+    for i, (lab, h) in enumerate(zip(groups(merge, labels), height)):
+        ofs.write("%04d %4d %7.3f %s\n" % (i+1, len(lab), h, " ".join(map(str, sorted(lab)))))
+    ofs.close()
+# write_clusters_txt()
+
+def dendrogram_json(merge, labels):
+    """
+    Same JSON as HCtoJSON() in R (http://www.coppelia.io/2014/07/converting-an-r-hclust-object-into-a-d3-js-dendrogram/)
+    Built without recursion because the tree can be very deep.
+    """
+    nodes = []
+    for i, (l1, l2) in enumerate(merge):
+        children = map(lambda x: '{"name":%s}' % labels[-x-1] if x < 0 else nodes[x-1], (l1, l2))
+        nodes.append('{"name":"%d","children":[%s,%s]}' % (i+1, children[0], children[1]))
+    return nodes[-1] if nodes else ""
+# dendrogram_json()
+
+def plot_dendrogram(merge, height, labels, plotout):
+    import matplotlib
+    matplotlib.use('Agg') # Allow to work without X
+    import matplotlib.pyplot as plt
+
+    order = leaf_order(merge)
+    pos = {} # node -> (x, y)
+    for i, o in enumerate(order): pos[-o] = (i+1, 0.)
+
+    fig = plt.figure(figsize=(10,10))
+    ax = fig.add_subplot(111)
+    for k, ((l1, l2), h) in enumerate(zip(merge, height)):
+        (x1, y1), (x2, y2) = pos[l1], pos[l2]
+        ax.plot([x1, x1, x2, x2], [y1, h, h, y2], "k-", linewidth=0.5)
+        pos[k+1] = ((x1+x2)/2., h)
+
+    ax.set_xticks(range(1, len(order)+1))
+    ax.set_xticklabels(map(lambda x: str(labels[x-1]), order), rotation=90, fontsize="small")
+    ax.set_xlim(0, len(order)+1)
+    ax.set_ylabel("Height")
+    fig.savefig(plotout)
+    plt.close(fig)
+# plot_dendrogram()
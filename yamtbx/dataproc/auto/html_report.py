@@ -10,6 +10,7 @@ import time
 import cPickle as pickle
 import iotbx.phil
 import StringIO
+import traceback
 
 from yamtbx.dataproc.xds import correctlp
 from yamtbx.dataproc.xds import idxreflp
@@ -406,7 +407,7 @@ var chart2 = AmCharts.makeChart("chartdiv_integrate_rotxyz", {
 
     html += "<h1>CORRECT (Scaling)</h1>\n"
     if os.path.isfile(correct_lp):
-        lp = correctlp.CorrectLp(correct_lp)
+        lp = correctlp.parse_cached(correct_lp)
 
         if not lp.is_ISa_valid() or lp.get_ISa() < 10:
             problems.append("CORRECT")
@@ -676,7 +677,7 @@ def find_problems(xds_wd):
             problems.append("INTEGRATE")
         
     if os.path.isfile(correct_lp):
-        lp = correctlp.CorrectLp(correct_lp)
+        lp = correctlp.parse_cached(correct_lp)
 
         if not lp.is_ISa_valid() or lp.get_ISa() < 10:
             problems.append("CORRECT")
@@ -687,8 +688,7 @@ def find_problems(xds_wd):
     return problems
 # find_problems()
 
-def make_kamo_report(bssjobs, topdir, htmlout):
-    report_html = """\
+kamo_report_head = """\
 <html>
 <head>
 <style>
@@ -732,22 +732,55 @@ h3, h4, h5, h6 { text-indent: 0px; font-weight: bold;
 top dir: %s<br>
 created on %s
 </div>
-""" % (os.path.abspath(topdir), time.strftime("%Y-%m-%d %H:%M:%S"))
+"""
+
+kamo_report_table_head = """\
+<table class="dataset_table">
+<tr>
+ <th>Dataset</th> <th>Sample ID</th> <th>&lambda; (&Aring;)</th> <th>Total &phi; (&deg;)</th> <th>&Delta;&phi; (&deg;)</th> <th>IdxLatt (%)</th> <th>SG</th> <th>Resn (&Aring;)</th> <th>Cmpl (%)</th> <th>ISa</th> <th>Problems</th>
+</tr>
+"""
+
+class KamoReport:
+    """
+    Incremental builder of KAMO report.
+    A table row of each dataset is cached with modification times of its source files,
+    and only changed datasets are re-evaluated in update().
+    """
+
+    source_files = ("IDXREF.LP", "XPARM.XDS", "INTEGRATE.LP", "CORRECT.LP", "XDSSTAT.LP",
+                    "SPOT.XDS", "merging_stats.pkl", "shika.log")
+
+    def __init__(self, topdir, htmlout, update_individual=False):
+        self.topdir = topdir
+        self.htmlout = htmlout
+        self.update_individual = update_individual
+        self.rows = {} # jobkey: (stamp, relwd, row_html)
+    # __init__()
 
-    reports = {}
+    def get_stamp(self, bssjobs, jobkey, wd):
+        job = bssjobs.jobs[jobkey]
+        mtimes = []
+        for f in self.source_files:
+            f = os.path.join(wd, f)
+            mtimes.append(os.path.getmtime(f) if os.path.isfile(f) else None)
+
+        # Results cached in bssjobs may become available later than files
+        correct_lp, spot_xds = os.path.join(wd, "CORRECT.LP"), os.path.join(wd, "SPOT.XDS")
+        cached = (bssjobs._load_if_chached("correctlp", correct_lp) is not None,
+                  bssjobs._load_if_chached("resn", correct_lp),
+                  bssjobs._load_if_chached("resn", spot_xds))
+
+        return tuple(mtimes) + cached + (job.sample, job.wavelength, job.osc_start, job.osc_end, job.osc_step)
+    # get_stamp()
 
-    for jobkey in sorted(bssjobs.jobs):
-        wd = bssjobs.get_xds_workdir(jobkey)
-        relwd = os.path.relpath(wd, os.path.dirname(htmlout))
+    def make_row(self, bssjobs, jobkey, wd, relwd):
         job = bssjobs.jobs[jobkey]
 
         dsname = os.path.basename(wd).replace("xds_", "")
-        gxparm_xds = os.path.join(wd, "GXPARM.XDS")
         correct_lp = os.path.join(wd, "CORRECT.LP")
         spot_xds = os.path.join(wd, "SPOT.XDS")
         idxref_lp = os.path.join(wd, "IDXREF.LP")
-        xds_inp = os.path.join(wd, "XDS.INP")
-        stats_pkl = os.path.join(wd, "merging_stats.pkl")
 
         sampleid = "%s(%.2d)" % job.sample if job.sample is not None else "?"
         wavelen = job.wavelength
@@ -777,26 +810,76 @@ created on %s
         if resn is None: resn = bssjobs._load_if_chached("resn", spot_xds)
         if resn is None: resn = float("nan")
 
-        tmp = '<tr>\n <td><a href="%s">%s</a></td> <td>%s</td> <td>%.4f</td> <td>%.1f</td> <td>%.3f</td> <td>%.1f</td> <td>%s</td> <td>%.1f</td> <td>%.0f</td> <td>%.2f</td>  <td>%s</td>\n</tr>\n' % (indiv_html, dsname, sampleid, wavelen, totalphi, deltaphi, lattp, sg,
-                                                                                                                                                               resn, cmpl, ISa, problems_str)
-        reports.setdefault(os.path.dirname(relwd), []).append(tmp)
-
-    for wd in sorted(reports):
-        report_html += "<h3>%s</h3>\n" % wd
-        report_html += """\
-<table class="dataset_table">
-<tr>
- <th>Dataset</th> <th>Sample ID</th> <th>&lambda; (&Aring;)</th> <th>Total &phi; (&deg;)</th> <th>&Delta;&phi; (&deg;)</th> <th>IdxLatt (%)</th> <th>SG</th> <th>Resn (&Aring;)</th> <th>Cmpl (%)</th> <th>ISa</th> <th>Problems</th>
-</tr>
-"""
-        report_html += "".join(reports[wd])
-        report_html += "</table>\n"
-
-    report_html += """
+        return '<tr>\n <td><a href="%s">%s</a></td> <td>%s</td> <td>%.4f</td> <td>%.1f</td> <td>%.3f</td> <td>%.1f</td> <td>%s</td> <td>%.1f</td> <td>%.0f</td> <td>%.2f</td>  <td>%s</td>\n</tr>\n' % (indiv_html, dsname, sampleid, wavelen, totalphi, deltaphi, lattp, sg,
+                                                                                                                                                                  resn, cmpl, ISa, problems_str)
+    # make_row()
+
+    def update_individual_report(self, wd, stamp):
+        # Re-render only if the page exists (made by processing job) and is older than sources.
+        indiv_html = os.path.join(wd, "report.html")
+        if not os.path.isfile(indiv_html): return
+        last_source = max(filter(lambda x: x is not None, stamp[:len(self.source_files)]) + [0])
+        if os.path.getmtime(indiv_html) >= last_source: return
+
+        try:
+            make_individual_report(wd, wd)
+        except:
+            print "Error in making report for %s" % wd
+            print traceback.format_exc()
+    # update_individual_report()
+
+    def update(self, bssjobs):
+        """
+        Returns the number of datasets whose row was re-made.
+        """
+        n_updated = 0
+
+        for jobkey in bssjobs.jobs:
+            wd = bssjobs.get_xds_workdir(jobkey)
+            stamp = self.get_stamp(bssjobs, jobkey, wd)
+            if jobkey in self.rows and self.rows[jobkey][0] == stamp:
+                continue
+
+            relwd = os.path.relpath(wd, os.path.dirname(self.htmlout))
+            if self.update_individual and jobkey in self.rows:
+                self.update_individual_report(wd, stamp)
+
+            self.rows[jobkey] = (stamp, relwd, self.make_row(bssjobs, jobkey, wd, relwd))
+            n_updated += 1
+
+        for jobkey in set(self.rows).difference(bssjobs.jobs):
+            del self.rows[jobkey]
+
+        self.write_html()
+        return n_updated
+    # update()
+
+    def write_html(self):
+        reports = {}
+        for jobkey in sorted(self.rows):
+            stamp, relwd, row = self.rows[jobkey]
+            reports.setdefault(os.path.dirname(relwd), []).append(row)
+
+        report_html = kamo_report_head % (os.path.abspath(self.topdir), time.strftime("%Y-%m-%d %H:%M:%S"))
+
+        for wd in sorted(reports):
+            report_html += "<h3>%s</h3>\n" % wd
+            report_html += kamo_report_table_head
+            report_html += "".join(reports[wd])
+            report_html += "</table>\n"
+
+        report_html += """
 </body>
 </html>
 """
 
-    open(htmlout, "w").write(report_html)
+        # Write to temporary file and then rename, so that browser never sees incomplete file.
+        tmpout = self.htmlout + ".tmp"
+        open(tmpout, "w").write(report_html)
+        os.rename(tmpout, self.htmlout)
+    # write_html()
+# class KamoReport
 
-# run()
+def make_kamo_report(bssjobs, topdir, htmlout):
+    KamoReport(topdir, htmlout).update(bssjobs)
+# make_kamo_report()
@@ -0,0 +1,76 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Connectivity of datasets before scaling.
+
+XSCALE stops with "INSUFFICIENT NUMBER OF COMMON STRONG REFLECTIONS" when
+some datasets do not share enough strong reflections with the others. Here
+the number of common strong reflections (and correlation) is calculated for
+all pairs directly from XDS_ASCII files, so that a connected subset can be
+chosen before running XSCALE.
+
+Strong reflections are those with I/sigma >= min_i_over_sigma (the same
+criterion as MINIMUM_I/SIGMA= of XSCALE) after merging symmetry equivalents
+in each dataset. Pairs are compared with the shared dataset store (sorted
+hkl keys), which does not need to copy arrays to the workers.
+"""
+
+from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
+from yamtbx.dataproc.auto import dataset_store
+from libtbx import easy_mp
+from cctbx import sgtbx
+import networkx as nx
+
+def read_strong_reflections(xac_file, space_group, anomalous_flag, d_min=None, d_max=None, min_i_over_sigma=3):
+    xac = XDS_ASCII(xac_file, i_only=True)
+    xac.remove_rejected()
+    a = xac.i_obs(anomalous_flag=anomalous_flag).resolution_filter(d_min=d_min, d_max=d_max)
+    a = a.customized_copy(space_group_info=sgtbx.space_group_info(group=space_group)).map_to_asu()
+    a = a.merge_equivalents(use_internal_variance=False).array()
+    return a.select(a.data() >= min_i_over_sigma * a.sigmas())
+# read_strong_reflections()
+
+def calc_pairwise_common_strong(xac_files, space_group, anomalous_flag, d_min=None, d_max=None, min_i_over_sigma=3, nproc=1):
+    """
+    Returns list of (i, j, n_common, cc) for all pairs (i < j; 0-based).
+    """
+    arrays = easy_mp.pool_map(fixed_func=lambda f: read_strong_reflections(f, space_group, anomalous_flag,
+                                                                            d_min, d_max, min_i_over_sigma),
+                              args=xac_files,
+                              processes=nproc)
+
+    args = []
+    for i in xrange(len(arrays)-1):
+        for j in xrange(i+1, len(arrays)):
+            args.append((i,j))
+
+    store = dataset_store.SharedDatasetStore.from_arrays(arrays)
+    try:
+        results = easy_mp.pool_map(fixed_func=lambda x: dataset_store.attach(store.path).calc_cc(x[0], x[1]),
+                                   args=args,
+                                   processes=nproc)
+    finally:
+        store.remove()
+
+    return map(lambda x: (x[0][0], x[0][1], x[1][1], x[1][0]), zip(args, results))
+# calc_pairwise_common_strong()
+
+def choose_connected_datasets(n_data, pairs, min_common_refs=10, must_include=()):
+    """
+    Returns indices of the largest group connected by pairs having more than min_common_refs common reflections,
+    that includes all of must_include (if possible).
+    """
+    G = nx.Graph()
+    G.add_nodes_from(range(n_data))
+    for i, j, n_common, cc in pairs:
+        if n_common > min_common_refs: G.add_edge(i, j)
+
+    groups = sorted(map(list, nx.connected_components(G)), key=lambda x: -len(x))
+    for g in groups:
+        if all(map(lambda x: x in g, must_include)): return sorted(g)
+    return sorted(groups[0])
+# choose_connected_datasets()
@@ -5,6 +5,8 @@ Author: Keitaro Yamashita
 This software is released under the new BSD License; see LICENSE.
 """
 from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
+from yamtbx.dataproc.auto import dataset_store
+from yamtbx.dataproc.auto.dataset_handle import MergedXdsAscii
 
 from cctbx.crystal import reindex
 from cctbx.array_family import flex
@@ -31,25 +33,28 @@ class ReindexResolver:
         self.xac_files = xac_files
         self.log_out = log_out
         self.nproc = nproc
-        self.arrays = []
         self.max_delta = max_delta
         self.best_operators = None
 
-        print >>self.log_out, "Reading"
+        # Files are read when needed, not kept in memory
+        self.datasets = map(lambda f: MergedXdsAscii(f, d_min=d_min, min_ios=min_ios, min_ios_before_merge=True),
+                            self.xac_files)
+
+        print >>self.log_out, "Datasets"
         for i, f in enumerate(self.xac_files):
             print >>self.log_out, "%4d %s" % (i, f)
-            xac = XDS_ASCII(f, i_only=True)
-            xac.remove_rejected()
-            a = xac.i_obs().resolution_filter(d_min=d_min)
-            if min_ios is not None: a = a.select(a.data()/a.sigmas()>=min_ios)
-            a = a.as_non_anomalous_array().merge_equivalents(use_internal_variance=False).array()
-            self.arrays.append(a)
 
         print >>self.log_out, ""
     # __init__()
 
+    @property
+    def arrays(self):
+        # All merged arrays; reads all files. Only for methods that need all data at once.
+        return map(lambda x: x.get(), self.datasets)
+    # arrays
+
     def find_reindex_ops(self):
-        symm = self.arrays[0].crystal_symmetry()
+        symm = self.datasets[0].crystal_symmetry()
         cosets = reindex.reindexing_operators(symm, symm, max_delta=self.max_delta)
         reidx_ops = cosets.combined_cb_ops()
         return reidx_ops
@@ -74,7 +79,7 @@ class ReindexResolver:
             newf = f.replace(".HKL", suffix+".HKL") if ".HKL" in f else os.path.splitext(f)[0]+suffix+".HKL"
             print >>self.log_out, "%4d %s" % (i, newf)
 
-            cell_tr = xac.write_reindexed(op, newf, space_group=self.arrays[0].crystal_symmetry().space_group())
+            cell_tr = xac.write_reindexed(op, newf, space_group=self.datasets[0].crystal_symmetry().space_group())
             #ofs_lst.write(newf+"\n")
             new_files.append(newf)
 
@@ -116,7 +121,6 @@ class KabschSelectiveBreeding(ReindexResolver):
     # __init__()
     
     def assign_operators(self, reidx_ops=None, max_cycle=100):
-        arrays = self.arrays
         self.best_operators = None
 
         if reidx_ops is None: reidx_ops = self.find_reindex_ops()
@@ -127,48 +131,48 @@ class KabschSelectiveBreeding(ReindexResolver):
 
         reidx_ops.sort(key=lambda x: not x.is_identity_op()) # identity op to first
 
-        if self.nproc > 1:
-            # consumes much memory..
-            reindexed_arrays = [arrays]
-            for op in reidx_ops[1:]:
-                reindexed_arrays.append(map(lambda x: x.customized_copy(indices=op.apply(x.indices())).map_to_asu(), arrays))
-        else:
-            reindexed_arrays = None
+        # All reindexed arrays are kept in shared store; (dataset i, operator j) -> i*len(reidx_ops)+j
+        # Each file is read once, and only one dataset is in memory at a time.
+        nops = len(reidx_ops)
+        def reindexed_arrays():
+            for ds in self.datasets:
+                a = ds.get()
+                for op in reidx_ops:
+                    if op.is_identity_op(): yield a
+                    else: yield a.customized_copy(indices=op.apply(a.indices())).map_to_asu()
+        # reindexed_arrays()
+
+        store = dataset_store.SharedDatasetStore.from_arrays(reindexed_arrays(),
+                                                             nref_hint=sum(map(lambda x: x.estimated_size(), self.datasets))*nops)
+        try:
+            self._assign_operators_cycles(len(self.datasets), reidx_ops, store, max_cycle)
+        finally:
+            store.remove()
+    # assign_operators()
 
-        old_ops = map(lambda x:0, xrange(len(arrays)))
-        new_ops = map(lambda x:0, xrange(len(arrays)))
+    def _assign_operators_cycles(self, n_data, reidx_ops, store, max_cycle):
+        nops = len(reidx_ops)
+        old_ops = map(lambda x:0, xrange(n_data))
+        new_ops = map(lambda x:0, xrange(n_data))
 
         for ncycle in xrange(max_cycle):
             #new_ops = copy.copy(old_ops) # doesn't matter
-            for i in xrange(len(arrays)):
+            for i in xrange(n_data):
                 cc_means = []
-                a = arrays[i]
 
                 for j, op in enumerate(reidx_ops):
                     cc_list = []
-                    if self.nproc > 1:
-                        tmp = reindexed_arrays[j][i]
-                    else:
-                        if op.is_identity_op(): tmp = a
-                        else: tmp = a.customized_copy(indices=op.apply(a.indices())).map_to_asu()
                     
-                    def work_local(ref): # XXX This function is very slow when nproc>1...
+                    def work_local(ref):
                         if ref==i: return None
 
-                        if self.nproc > 1:
-                            tmp2 = reindexed_arrays[new_ops[ref]][ref]
-                        else:                                
-                            if reidx_ops[new_ops[ref]].is_identity_op(): tmp2 = arrays[ref]
-                            else: tmp2 = arrays[ref].customized_copy(indices=reidx_ops[new_ops[ref]].apply(arrays[ref].indices())).map_to_asu()
+                        cc = store.calc_cc(i*nops+j, ref*nops+new_ops[ref])[0]
 
-                        cc = calc_cc(tmp, tmp2)
                         if cc==cc: return cc
                         return None
                     # work_local()
 
-                    cc_list = easy_mp.pool_map(fixed_func=work_local,
-                                               args=range(len(arrays)),
-                                               processes=1)#self.nproc)
+                    cc_list = map(work_local, xrange(n_data))
                     cc_list = filter(lambda x: x is not None, cc_list)
 
                     if len(cc_list) > 0:
@@ -193,7 +197,7 @@ class KabschSelectiveBreeding(ReindexResolver):
 
         print >>self.log_out, "WARNING:: Selective breeding is not finished. max cycles reached."
         self.best_operators = map(lambda x: reidx_ops[x], new_ops) # better than nothing..
-    # assign_operators()
+    # _assign_operators_cycles()
 # class KabschSelectiveBreeding
 
 class ReferenceBased(ReindexResolver):
@@ -204,7 +208,6 @@ class ReferenceBased(ReindexResolver):
     # __init__()
 
     def assign_operators(self, reidx_ops=None):
-        arrays = self.arrays
         self.best_operators = None
 
         if reidx_ops is None: reidx_ops = self.find_reindex_ops()
@@ -214,11 +217,11 @@ class ReferenceBased(ReindexResolver):
 
         reidx_ops.sort(key=lambda x: not x.is_identity_op()) # identity op to first
 
-        new_ops = map(lambda x:0, xrange(len(arrays)))
+        new_ops = map(lambda x:0, xrange(len(self.datasets)))
 
-        for i, a in enumerate(arrays):
+        for i, ds in enumerate(self.datasets):
             cc_list = []
-            a = arrays[i]
+            a = ds.get()
 
             for j, op in enumerate(reidx_ops):
                 if op.is_identity_op(): tmp = a
@@ -290,10 +293,10 @@ if __name__ == "__main__":
         from cctbx import sgtbx
         import random
         debug_op = sgtbx.change_of_basis_op("k,h,l")
-        idxes = range(len(ksb.arrays))
+        idxes = range(len(ksb.datasets))
         random.shuffle(idxes)
-        for i in idxes[:len(ksb.arrays)//2]:
-            ksb.arrays[i] = ksb.arrays[i].customized_copy(indices=debug_op.apply(ksb.arrays[i].indices()))
+        for i in idxes[:len(ksb.datasets)//2]:
+            ksb.datasets[i].modifier = lambda a: a.customized_copy(indices=debug_op.apply(a.indices()))
 
         print "altered:", idxes
 
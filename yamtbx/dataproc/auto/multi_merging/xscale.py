@@ -12,6 +12,7 @@ from yamtbx.dataproc.xds import modify_xdsinp
 from yamtbx.dataproc.pointless import Pointless
 from yamtbx.dataproc import blend_lcv
 from yamtbx.dataproc.auto.resolution_cutoff import estimate_resolution_based_on_cc_half
+from yamtbx.dataproc.auto.multi_merging import connectivity
 from yamtbx import util
 from yamtbx.util import batchjob
 
@@ -22,6 +23,7 @@ import glob
 import traceback
 import networkx as nx
 import numpy
+from cctbx import sgtbx
 
 xscale_comm = "xscale_par"
 
@@ -52,11 +54,13 @@ class XscaleCycles:
         self.nproc = nproc
         self.nproc_each = batch_params.nproc_each
         if batch_params.engine == "sge": self.batchjobs = batchjob.SGE(pe_name=batch_params.sge_pe_name)
-        elif batch_params.engine == "sh": self.batchjobs = batchjob.ExecLocal(max_parallel=batch_params.sh_max_jobs)
+        elif batch_params.engine == "sh": self.batchjobs = batchjob.ExecLocal(max_parallel=batch_params.sh_max_jobs or 1)
         self.all_data_root = None # the root directory for all data
         self.altfile = {} # Modified files
         self.cell_info_at_cycles = {}
         self.dmin_est_at_cycles = {}
+        self.connectivity_checked = False
+        self.postprocess_threads = {} # {workdir: thread} cbf_to_dat and aniso analysis running in background
 
         if reject_params.delta_cchalf.bin == "total-then-outer":
             self.delta_cchalf_bin = "total"
@@ -170,16 +174,12 @@ OUTPUT_FILE= xscale.hkl
             d_min = est_resol(xscale_hkl, self.res_params,
                               os.path.join(tmpwd, "ccfit_%d.pdf"%(i+1)))
             if d_min is not None and d_min > self.d_min + 0.001:
-                for f in "XSCALE.INP", "XSCALE.LP": util.rotate_file(os.path.join(tmpwd, f))
+                self.rotate_xscale_files(tmpwd)
                 inp_new = os.path.join(tmpwd, "XSCALE.INP")
                 shutil.copyfile(os.path.join(last_wd, "XSCALE.INP"), inp_new)
                 modify_xdsinp(inp_new, [make_bin_str(d_min, self.d_max).split("= ")])
 
-                try:
-                    xscale.run_xscale(inp_new, cbf_to_dat=True, aniso_analysis=True,
-                                      use_tmpdir_if_available=self.xscale_params.use_tmpdir_if_available)
-                except:
-                    print >>self.out, traceback.format_exc()
+                self.run_xscale(inp_new)
 
                 xscale_hkl = os.path.abspath(os.path.join(tmpwd, "xscale.hkl"))
 
@@ -190,6 +190,7 @@ OUTPUT_FILE= xscale.hkl
 
         if d_min is not None:
             self.dmin_est_at_cycles[cycle_number] = d_min
+            self.wait_postprocess(tmpwd)
             os.rename(tmpwd, os.path.join(self.workdir_org, "run_%.2d_%.2fA"%(cycle_number, d_min)))
     # cut_resolution()
 
@@ -242,9 +243,44 @@ OUTPUT_FILE= xscale.hkl
                 # Don't want to stop the program.
                 print >>self.out, traceback.format_exc()
 
+        self.wait_postprocess()
         return self.removed_files, self.removed_reason
     # run_cycles()
 
+    def run_xscale(self, xscale_inp):
+        # Post-processing of the previous run in the same directory must be finished before next run.
+        # That in other directories can continue during this run.
+        wdir = os.path.dirname(os.path.abspath(xscale_inp))
+        self.wait_postprocess(wdir)
+        try:
+            th = xscale.run_xscale(xscale_inp, cbf_to_dat=True, aniso_analysis=True,
+                                   use_tmpdir_if_available=self.xscale_params.use_tmpdir_if_available,
+                                   postprocess_in_background=True)
+            if th is not None: self.postprocess_threads[wdir] = th
+        except:
+            print >>self.out, traceback.format_exc()
+    # run_xscale()
+
+    def wait_postprocess(self, wdir=None):
+        """
+        Join post-processing thread in wdir, or all threads if wdir is None.
+        """
+        if wdir is None:
+            wdirs = self.postprocess_threads.keys()
+        else:
+            wdirs = [os.path.abspath(wdir)]
+
+        for wd in wdirs:
+            th = self.postprocess_threads.pop(wd, None)
+            if th is not None: th.join()
+    # wait_postprocess()
+
+    def rotate_xscale_files(self, wdir):
+        # XSCALE.LP may be being read by post-processing thread
+        self.wait_postprocess(wdir)
+        for f in "XSCALE.INP", "XSCALE.LP": util.rotate_file(os.path.join(wdir, f))
+    # rotate_xscale_files()
+
     def check_remove_list(self, remove_idxes):
         new_list = []
         skip_num = 0
@@ -256,11 +292,48 @@ OUTPUT_FILE= xscale.hkl
     
     def current_working_dir(self): return self.workdir
 
+    def remove_unconnected_files(self, xds_ascii_files):
+        """
+        Check common strong reflections between all datasets and
+        return files in the largest connected group. Others are marked as removed.
+        """
+        sg = self.average_cells(xds_ascii_files)[0]
+        pairs = connectivity.calc_pairwise_common_strong(xds_ascii_files,
+                                                         space_group=sgtbx.space_group_info(sg).group(),
+                                                         anomalous_flag=bool(self.anomalous_flag),
+                                                         d_min=self.d_min, d_max=self.d_max,
+                                                         min_i_over_sigma=self.xscale_params.min_i_over_sigma,
+                                                         nproc=self.nproc)
+        ofs = open(os.path.join(self.workdir, "common_strong_refls.dat"), "w")
+        ofs.write("   i    j ncommon     cc\n")
+        for i, j, n_common, cc in pairs: ofs.write("%4d %4d %7d % .4f\n" % (i+1, j+1, n_common, cc))
+        ofs.close()
+
+        keep_idxes = connectivity.choose_connected_datasets(len(xds_ascii_files), pairs, min_common_refs=10,
+                                                            must_include=[0] if self.reference_file else [])
+        if len(keep_idxes) == len(xds_ascii_files): return xds_ascii_files
+
+        print >>self.out, "DEBUG:: %d files are not connected by common strong reflections." % (len(xds_ascii_files)-len(keep_idxes))
+        for i in filter(lambda j: j not in keep_idxes, xrange(len(xds_ascii_files))):
+            self.removed_files.append(xds_ascii_files[i])
+            self.removed_reason[xds_ascii_files[i]] = "no_common_refls"
+
+        return map(lambda i: xds_ascii_files[i], keep_idxes)
+    # remove_unconnected_files()
+
     def run_cycle(self, xds_ascii_files, reference_idx=None):
         if len(xds_ascii_files) == 0:
             print >>self.out, "Error: no files given."
             return
 
+        if self.xscale_params.check_connectivity and not self.connectivity_checked:
+            # Only once at the beginning; later cycles just remove datasets.
+            self.connectivity_checked = True
+            try:
+                xds_ascii_files = self.remove_unconnected_files(xds_ascii_files)
+            except:
+                print >>self.out, traceback.format_exc()
+
         xscale_inp = os.path.join(self.workdir, "XSCALE.INP")
         xscale_lp = os.path.join(self.workdir, "XSCALE.LP")
 
@@ -291,11 +364,7 @@ OUTPUT_FILE= xscale.hkl
         inp_out.close()
 
         print >>self.out, "DEBUG:: running xscale with %3d files.." % len(xds_ascii_files)
-        try:
-            xscale.run_xscale(xscale_inp, cbf_to_dat=True, aniso_analysis=True,
-                              use_tmpdir_if_available=self.xscale_params.use_tmpdir_if_available)
-        except:
-            print >>self.out, traceback.format_exc()
+        self.run_xscale(xscale_inp)
 
         xscale_log = open(xscale_lp).read()
         if "!!! ERROR !!! INSUFFICIENT NUMBER OF COMMON STRONG REFLECTIONS." in xscale_log:
@@ -318,7 +387,7 @@ OUTPUT_FILE= xscale.hkl
                 if self.reference_file:
                     max_clique = [0,] + filter(lambda x: x!=0, max_clique)
 
-                for f in "XSCALE.INP", "XSCALE.LP": util.rotate_file(os.path.join(self.workdir, f))
+                self.rotate_xscale_files(self.workdir)
 
                 try_later = map(lambda i: xds_ascii_files[i], filter(lambda x: x not in max_clique, G.nodes()))
 
@@ -343,7 +412,7 @@ OUTPUT_FILE= xscale.hkl
                 bad_idxes = xscalelp.read_no_common_ref_datasets(xscale_lp)
                 print >>self.out, "DEBUG:: %d files are of no use." % (len(bad_idxes))
 
-                for f in "XSCALE.INP", "XSCALE.LP": util.rotate_file(os.path.join(self.workdir, f))
+                self.rotate_xscale_files(self.workdir)
 
                 # XXX Actually, not all datasets need to be thrown.. some of them are useful..
                 for i in bad_idxes:
@@ -367,7 +436,7 @@ OUTPUT_FILE= xscale.hkl
                 self.removed_files.append(xds_ascii_files[i])
                 self.removed_reason[xds_ascii_files[i]] = "useless"
 
-            for f in "XSCALE.INP", "XSCALE.LP": util.rotate_file(os.path.join(self.workdir, f))
+            self.rotate_xscale_files(self.workdir)
             self.run_cycle(map(lambda i: xds_ascii_files[i], keep_idxes))
             return
         elif "INACCURATE SCALING FACTORS." in xscale_log:
@@ -388,7 +457,7 @@ OUTPUT_FILE= xscale.hkl
             ref_num = xscale.decide_scaling_reference_based_on_bfactor(xscale_lp, rescale_for, return_as="index")
             if reference_idx != ref_num:
                 print >>self.out, "Rescaling with %s" % rescale_for
-                for f in "XSCALE.INP", "XSCALE.LP": util.rotate_file(os.path.join(self.workdir, f))
+                self.rotate_xscale_files(self.workdir)
                 self.run_cycle(xds_ascii_files, reference_idx=ref_num)
 
         if len(self.reject_method) == 0:
@@ -397,6 +466,7 @@ OUTPUT_FILE= xscale.hkl
         # Remove bad data
         remove_idxes = []
         remove_reasons = {}
+        lp = xscalelp.parse_cached(xscale_lp)
 
         if self.reject_method[0] == "framecc":
             print >>self.out, "Rejections based on frame CC"
@@ -424,23 +494,27 @@ OUTPUT_FILE= xscale.hkl
                     continue
 
                 f = xds_ascii_files[i]
-                xac = XDS_ASCII(f)
-                if set(useframes).issuperset(set(range(min(xac.iframe), max(xac.iframe)))):
+                frame_min, frame_max = cclist[0][0], cclist[-1][0] # framecc covers all frames
+                if set(useframes).issuperset(set(range(frame_min, frame_max))):
                     continue # All useful frames.
 
-                sel = xac.iframe == useframes[0]
-                for x in useframes[1:]: sel |= xac.iframe == x
-                if sum(sel) < 10: # XXX care I/sigma
+                # Stream to temporary file first; the result may be too small to use
+                org_altfile = self.altfile.get(f)
+                newf = self.request_file_modify(f)
+                tmpf = newf + ".tmp"
+                nref = XDS_ASCII(f, read_data=False).write_selected_frames(useframes, tmpf)
+                if nref < 10: # XXX care I/sigma
+                    os.remove(tmpf)
+                    if org_altfile is None: self.altfile.pop(f) # not modified after all
+                    else: self.altfile[f] = org_altfile
                     remove_idxes.append(i)
                     remove_reasons.setdefault(i, []).append("allbadframe")
                     continue
 
                 print >>self.out, "Extracting frames %s out of %d-%d in %s" % (",".join(map(str,useframes)),
-                                                                               min(xac.iframe), max(xac.iframe),
+                                                                               frame_min, frame_max,
                                                                                f)
-
-                newf = self.request_file_modify(f)
-                xac.write_selected(sel, newf)
+                os.rename(tmpf, newf)
 
             self.reject_method.pop(0) # Perform only once
 
@@ -448,7 +522,7 @@ OUTPUT_FILE= xscale.hkl
             if "bfactor" in self.reject_params.lpstats.stats:
                 iqrc = self.reject_params.lpstats.iqr_coeff
                 print >>self.out, "Rejections based on B-factor outliers (%.2f*IQR)" % iqrc
-                Bs = numpy.array(map(lambda x:x[1], xscalelp.get_k_b(xscale_lp)))
+                Bs = numpy.array(map(lambda x:x[1], lp.k_b))
                 q25, q75 = numpy.percentile(Bs, [25, 75])
                 iqr = q75 - q25
                 lowlim, highlim = q25 - iqrc*iqr, q75 + iqrc*iqr
@@ -464,7 +538,7 @@ OUTPUT_FILE= xscale.hkl
             if "em.b" in self.reject_params.lpstats.stats:
                 iqrc = self.reject_params.lpstats.iqr_coeff
                 print >>self.out, "Rejections based on error model b outliers (%.2f*IQR)" % iqrc
-                bs = numpy.array(map(lambda x:x[1], xscalelp.get_ISa(xscale_lp)))
+                bs = numpy.array(map(lambda x:x[1], lp.ISa))
                 q25, q75 = numpy.percentile(bs, [25, 75])
                 iqr = q75 - q25
                 lowlim, highlim = q25 - iqrc*iqr, q75 + iqrc*iqr
@@ -480,7 +554,7 @@ OUTPUT_FILE= xscale.hkl
             if "em.ab" in self.reject_params.lpstats.stats:
                 iqrc = self.reject_params.lpstats.iqr_coeff
                 print >>self.out, "Rejections based on error model a*b outliers (%.2f*IQR)" % iqrc
-                vals = numpy.array(map(lambda x:x[0]*x[1], xscalelp.get_ISa(xscale_lp)))
+                vals = numpy.array(map(lambda x:x[0]*x[1], lp.ISa))
                 q25, q75 = numpy.percentile(vals, [25, 75])
                 iqr = q75 - q25
                 lowlim, highlim = q25 - iqrc*iqr, q75 + iqrc*iqr
@@ -496,7 +570,7 @@ OUTPUT_FILE= xscale.hkl
             if "rfactor" in self.reject_params.lpstats.stats:
                 iqrc = self.reject_params.lpstats.iqr_coeff
                 print >>self.out, "Rejections based on R-factor outliers (%.2f*IQR)" % iqrc
-                rstats = xscalelp.get_rfactors_for_each(xscale_lp)
+                rstats = lp.rfactors_for_each
                 vals = numpy.array(map(lambda x:rstats[x][-1][1], rstats)) # Read total R-factor
                 q25, q75 = numpy.percentile(vals, [25, 75])
                 iqr = q75 - q25
@@ -511,7 +585,7 @@ OUTPUT_FILE= xscale.hkl
                 print >>self.out, " %4d R-factor outliers (<%.2f, >%.2f) removed"% (count, lowlim, highlim)
 
             if "pairwise_cc" in self.reject_params.lpstats.stats:
-                corrs = xscalelp.get_pairwise_correlations(xscale_lp)
+                corrs = lp.pairwise_correlations
                 if self.reject_params.lpstats.pwcc.method == "tukey":
                     q25, q75 = numpy.percentile(map(lambda x: x[3], corrs), [25, 75])
                     iqr = q75 - q25
@@ -546,7 +620,8 @@ OUTPUT_FILE= xscale.hkl
             self.reject_method.pop(0) # Perform only once
         elif self.reject_method[0] == "delta_cc1/2":
             print >>self.out, "Rejection based on delta_CC1/2 in %s shell" % self.delta_cchalf_bin
-            table = xscalelp.read_stats_table(xscale_lp)
+            table = lp.stats_table
+            if table is None: raise RuntimeError("Unexpected format of statistics table in %s" % xscale_lp)
             i_stat = -1 if self.delta_cchalf_bin == "total" else -2
             prev_cchalf = table["cc_half"][i_stat]
             prev_nuniq = table["nuniq"][i_stat]
@@ -564,7 +639,8 @@ OUTPUT_FILE= xscale.hkl
                                                              stat_bin=self.delta_cchalf_bin,
                                                              nproc=self.nproc,
                                                              nproc_each=self.nproc_each,
-                                                             batchjobs=self.batchjobs)
+                                                             batchjobs=self.batchjobs,
+                                                             use_tmpdir_if_available=self.xscale_params.use_tmpdir_if_available)
 
                 rem_idx, cc_i, nuniq_i = cchalf_list[0] # First (largest) is worst one to remove.
                 rem_idx_in_org = remaining_files[remaining_files.keys()[rem_idx]]
@@ -611,7 +687,7 @@ OUTPUT_FILE= xscale.hkl
             ref_num = xscale.decide_scaling_reference_based_on_bfactor(xscale_lp, self.reference_choice, return_as="index")
             if reference_idx != ref_num:
                 print >>self.out, "Rescaling2 with %s" % self.reference_choice
-                for f in "XSCALE.INP", "XSCALE.LP": util.rotate_file(os.path.join(self.workdir, f))
+                self.rotate_xscale_files(self.workdir)
                 self.run_cycle(map(lambda i: xds_ascii_files[i], keep_idxes), reference_idx=ref_num)
 
     # run_cycle()
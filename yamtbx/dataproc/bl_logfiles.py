@@ -528,13 +528,17 @@ class BssJobLog:
     # __init__()
 
     def parse(self, joblog):
+        self.parse_lines(joblog, open(joblog))
+    # parse()
 
-        for l in open(joblog):
+    def parse_lines(self, joblog, lines):
+        # Lines can be given in pieces (e.g. new lines of a growing file)
+        for l in lines:
             if l.startswith(" JOB_ID#   ="):
                 self.jobs.append(JobInfo(joblog))
             if len(self.jobs) > 0:
                 self.jobs[-1].parse_line(l)
-    # parse()
+    # parse_lines()
 
     def annotate_overwritten_images(self, remove=False):
         del_indices = {} # {i: [j,...]}
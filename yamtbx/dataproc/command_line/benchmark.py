@@ -0,0 +1,243 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+import iotbx.phil
+from yamtbx.util import benchmark
+from yamtbx.dataproc import synthetic_data
+from distutils.spawn import find_executable
+import os
+import sys
+import shutil
+import traceback
+import collections
+
+master_params_str = """\
+workdir = benchmark
+ .type = path
+ .help = Synthetic data and temporary files are written here
+cases = *xds_ascii *integrate_hkl *eiger_extract *cbf *cc_clustering *kabsch *cchalf_by_removing *mc_integration *crystfel_stream
+ .type = choice(multi=True)
+scales = 1 4 16
+ .type = ints(value_min=1)
+ .help = Size of data relative to the base size of each case
+repeat = 1
+ .type = int(value_min=1)
+ .help = Best time of repeated runs is taken
+nproc = 1
+ .type = int(value_min=1)
+seed = 1234
+ .type = int
+baseline = None
+ .type = path
+ .help = JSON file of results saved before. Results are compared with this.
+tolerance = 0.2
+ .type = float
+ .help = Relative tolerance in time to report slower or faster than baseline
+json_out = benchmark_results.json
+ .type = path
+keep_data = False
+ .type = bool
+"""
+
+# Base sizes at scale=1
+n_refl_base = 100000 # reflections in a file
+n_data_base = 10 # number of datasets for clustering, indexing ambiguity and CC1/2 calculation
+n_refl_per_data = 10000
+n_frames_base = 10 # EIGER and CBF frames
+n_single_base = 100 # number of single images (mc_integration) or stream chunks
+n_refl_per_single = 300
+
+def prep_xds_ascii_files(wdir, true_i, n_files, n_refl, seed, reindex_fraction=0.):
+    from cctbx import sgtbx
+    ret = []
+    alt_op = sgtbx.change_of_basis_op("k,h,-l")
+    for i in xrange(n_files):
+        f = os.path.join(wdir, "XDS_ASCII_%.4d.HKL" % i)
+        op = alt_op if i < n_files * reindex_fraction else None
+        synthetic_data.write_xds_ascii(f, true_i, n_refl, reindex_op=op, seed=seed+i)
+        ret.append(f)
+    return ret
+# prep_xds_ascii_files()
+
+def case_xds_ascii(wdir, true_i, scale, params):
+    hklin = os.path.join(wdir, "XDS_ASCII.HKL")
+    synthetic_data.write_xds_ascii(hklin, true_i, n_refl_base*scale, seed=params.seed)
+
+    def run():
+        from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
+        return XDS_ASCII(hklin).iobs.size()
+    return run, "refl"
+# case_xds_ascii()
+
+def case_integrate_hkl(wdir, true_i, scale, params):
+    hklin = os.path.join(wdir, "INTEGRATE.HKL")
+    synthetic_data.write_integrate_hkl(hklin, true_i, n_refl_base*scale, seed=params.seed)
+
+    def run():
+        from yamtbx.dataproc.xds import integrate_hkl_as_flex
+        return integrate_hkl_as_flex.reader(hklin, ["IOBS","SIGMA","PEAK"]).hkl.size()
+    return run, "refl"
+# case_integrate_hkl()
+
+def case_eiger_extract(wdir, true_i, scale, params):
+    nframes = n_frames_base*scale
+    master = synthetic_data.write_eiger_h5(os.path.join(wdir, "eiger"), nframes, seed=params.seed)
+
+    def run():
+        from yamtbx.dataproc import eiger
+        for i in xrange(nframes): eiger.extract_data(master, i+1)
+        return nframes
+    return run, "frames"
+# case_eiger_extract()
+
+def case_cbf(wdir, true_i, scale, params):
+    import numpy
+    from yamtbx.dataproc import cbf
+    nframes = n_frames_base*scale
+    data = numpy.random.RandomState(params.seed).poisson(2., size=(2527,2463)).astype(numpy.int32)
+
+    def run():
+        for i in xrange(nframes):
+            cbfout = os.path.join(wdir, "image_%.6d.cbf" % (i+1))
+            cbf.save_numpy_data_as_cbf(data.flatten(), size1=data.shape[1], size2=data.shape[0], title="",
+                                       cbfout=cbfout)
+            cbf.load_cbf_as_numpy(cbfout)
+        return nframes
+    return run, "frames"
+# case_cbf()
+
+def case_cc_clustering(wdir, true_i, scale, params):
+    xac_files = prep_xds_ascii_files(wdir, true_i, n_data_base*scale, n_refl_per_data, params.seed)
+
+    def run():
+        from yamtbx.dataproc.auto.cc_clustering import CCClustering
+        cc = CCClustering(os.path.join(wdir, "cc_clustering"), xac_files, d_min=true_i.d_min)
+        cc.do_clustering(nproc=params.nproc)
+        return len(xac_files)
+    return run, "data"
+# case_cc_clustering()
+
+def case_kabsch(wdir, true_i, scale, params):
+    xac_files = prep_xds_ascii_files(wdir, true_i, n_data_base*scale, n_refl_per_data, params.seed,
+                                     reindex_fraction=0.5)
+
+    def run():
+        from yamtbx.dataproc.auto.multi_merging.resolve_reindex import KabschSelectiveBreeding
+        ksb = KabschSelectiveBreeding(xac_files, d_min=true_i.d_min, nproc=params.nproc)
+        ksb.assign_operators()
+        return len(xac_files)
+    return run, "data"
+# case_kabsch()
+
+def case_cchalf_by_removing(wdir, true_i, scale, params):
+    from yamtbx.dataproc.xds import xscale
+    if not find_executable(xscale.xscale_comm): raise ImportError("%s not found" % xscale.xscale_comm)
+
+    xac_files = prep_xds_ascii_files(wdir, true_i, n_data_base*scale//2, n_refl_per_data, params.seed)
+    sgnum = true_i.symm.space_group_info().type().number()
+    cell = " ".join(map(lambda x: "%.3f"%x, true_i.symm.unit_cell().parameters()))
+    inp_head = "OUTPUT_FILE= xscale.hkl\nSPACE_GROUP_NUMBER= %d\nUNIT_CELL_CONSTANTS= %s\n" % (sgnum, cell)
+
+    def run():
+        xscale.calc_cchalf_by_removing(wdir=os.path.join(wdir, "cchalf"), inp_head=inp_head,
+                                       inpfiles=xac_files, nproc=params.nproc)
+        return len(xac_files)
+    return run, "data"
+# case_cchalf_by_removing()
+
+def case_mc_integration(wdir, true_i, scale, params):
+    import yamtbx_dataproc_crystfel_ext # just to check it is available
+    from yamtbx.dataproc.auto.command_line import merge_single_images_integrated as msii
+    xac_files = prep_xds_ascii_files(wdir, true_i, n_single_base*scale, n_refl_per_single, params.seed)
+    mparams = iotbx.phil.parse(msii.master_params_str).extract()
+    mparams.space_group = str(true_i.symm.space_group_info())
+    mparams.usecell = "mean"
+    mparams.nproc = params.nproc
+    mparams.prefix = os.path.join(wdir, "merged")
+
+    def run():
+        msii.mc_integration(mparams, xac_files)
+        return len(xac_files)
+    return run, "images"
+# case_mc_integration()
+
+def case_crystfel_stream(wdir, true_i, scale, params):
+    strin = os.path.join(wdir, "synthetic.stream")
+    synthetic_data.write_crystfel_stream(strin, true_i, n_single_base*scale, n_refl_per_single, seed=params.seed)
+
+    def run():
+        from yamtbx.dataproc.crystfel.stream import Streamfile
+        return len(Streamfile(strin).chunks)
+    return run, "chunks"
+# case_crystfel_stream()
+
+cases = collections.OrderedDict([("xds_ascii", case_xds_ascii),
+                                 ("integrate_hkl", case_integrate_hkl),
+                                 ("eiger_extract", case_eiger_extract),
+                                 ("cbf", case_cbf),
+                                 ("cc_clustering", case_cc_clustering),
+                                 ("kabsch", case_kabsch),
+                                 ("cchalf_by_removing", case_cchalf_by_removing),
+                                 ("mc_integration", case_mc_integration),
+                                 ("crystfel_stream", case_crystfel_stream)])
+
+def run(params, out=sys.stdout):
+    if not os.path.exists(params.workdir): os.makedirs(params.workdir)
+    true_i = synthetic_data.TrueIntensities(seed=params.seed)
+    results = []
+
+    for name in filter(lambda x: x in params.cases, cases):
+        for scale in params.scales:
+            print >>out, "Running %s at scale %d" % (name, scale)
+            wdir = os.path.join(params.workdir, "%s_%d" % (name, scale))
+            if os.path.exists(wdir): shutil.rmtree(wdir)
+            os.makedirs(wdir)
+
+            r = dict(case=name, scale=scale, nproc=params.nproc)
+            try:
+                func, r["unit"] = cases[name](wdir, true_i, scale, params)
+            except ImportError, e:
+                r["skipped"] = str(e)
+            except:
+                r["error"] = traceback.format_exc()
+                print >>out, r["error"]
+            else:
+                r.update(benchmark.measure(func, repeat=params.repeat))
+                if "error" in r: print >>out, r["error"]
+
+            results.append(r)
+            if not params.keep_data: shutil.rmtree(wdir)
+
+    if params.baseline:
+        benchmark.compare_with_baseline(results, benchmark.load_results(params.baseline), params.tolerance)
+
+    print >>out
+    benchmark.show_results(results, out)
+    benchmark.save_results(results, params.json_out)
+    print >>out, "\nResults saved: %s" % params.json_out
+    return results
+# run()
+
+def run_from_args(argv):
+    if "-h" in argv or "--help" in argv:
+        print """\
+Benchmark of data-processing hot paths with synthetic data.
+Time, throughput and peak memory of each case are measured at several scales.
+
+Usage: %s [cases=xds_ascii+cc_clustering] [scales=1,4,16] [baseline=old_results.json]
+
+Parameters:""" % "yamtbx.benchmark"
+        iotbx.phil.parse(master_params_str).show(prefix="  ", attributes_level=1)
+        return
+
+    cmdline = iotbx.phil.process_command_line(args=argv,
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+    run(params)
+# run_from_args()
+
+if __name__ == "__main__":
+    run_from_args(sys.argv[1:])
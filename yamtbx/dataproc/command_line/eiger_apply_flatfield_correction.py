@@ -1,11 +1,19 @@
+import iotbx.phil
 import h5py
-import bitshuffle.h5
 from yamtbx.dataproc import cbf
 from yamtbx.dataproc import eiger
 import numpy
 import os
 
-def run(infile):
+master_params_str = """\
+nproc = 1
+ .type = int(value_min=1)
+block_frames = 10
+ .type = int(value_min=1)
+ .help = number of frames processed at once by each process
+"""
+
+def run(infile, nproc=1, block_frames=10):
     h5 = h5py.File(infile, "r")
 
     if h5["/entry/instrument/detector/flatfield_correction_applied"].value:
@@ -21,30 +29,26 @@ def run(infile):
                                cbfout=os.path.join(outdir, "flatfield.cbf"))
 
     for k in sorted(h5["/entry/data"].keys()):
-        outfile = os.path.join(outdir, h5["/entry/data"].get(k, getlink=True).filename)
-        ds = h5["/entry/data"][k]
-        
-        h5o = h5py.File(outfile, "w")
-        h5o.create_group("/entry")
-        h5o["/entry"].attrs["NX_class"] = "NXentry"
-        h5o.create_group("/entry/data")
-        h5o["/entry/data"].attrs["NX_class"] = "NXdata"
-        dataset = h5o.create_dataset("/entry/data/data", ds.shape,
-                                       compression=bitshuffle.h5.H5FILTER,
-                                       compression_opts=(0, bitshuffle.h5.H5_COMPRESS_LZ4),
-                                       chunks=ds.chunks, dtype=ds.dtype)
-        dataset.attrs["image_nr_low"] = ds.attrs["image_nr_low"]
-        dataset.attrs["image_nr_high"] = ds.attrs["image_nr_high"]
-
+        filename = h5["/entry/data"].get(k, getlink=True).filename
+        print "processing %s" % k
         # Don't want to load all data to memory at the same time
-        for i in xrange(ds.shape[0]):
-            print "processing %6d/%d in %s" % (i+1, ds.shape[0], k)
-            dataset[i,] = ds[i,] * ff + .5
+        nframes = eiger.process_data_file(os.path.join(os.path.dirname(infile), filename),
+                                          os.path.join(outdir, filename),
+                                          [eiger.FlatFieldCorrection(ff)],
+                                          block_frames=block_frames, nproc=nproc)
+        print " %d frames written" % nframes
 
 # run()
-    
+
+def run_from_args(argv):
+    cmdline = iotbx.phil.process_command_line(args=argv,
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+
+    for f in cmdline.remaining_args:
+        run(f, params.nproc, params.block_frames)
+# run_from_args()
 
 if __name__ == "__main__":
     import sys
-    masterh5 = sys.argv[1]
-    run(masterh5)
+    run_from_args(sys.argv[1:])
@@ -1,5 +1,4 @@
 import iotbx.phil
-from libtbx import easy_mp
 from yamtbx.dataproc import eiger
 import h5py
 import numpy
@@ -13,6 +12,9 @@ dead_area_treatment = 0
  .help = "0: treat as zero, 1: treat as -inf"
 nproc = 1
  .type = int(value_min=1)
+block_frames = 10
+ .type = int(value_min=1)
+ .help = number of frames processed at once by each process
 """
 
 def software_binning(data, binning, dead_area_treatment):
@@ -55,6 +57,15 @@ def software_binning(data, binning, dead_area_treatment):
     return newdata, u, l
 # software_binning()
 
+class Binning:
+    # To be used in eiger.process_data_file()
+    def __init__(self, binning, dead_area_treatment):
+        self.binning, self.dead_area_treatment = binning, dead_area_treatment
+
+    def __call__(self, data):
+        return software_binning(data, self.binning, self.dead_area_treatment)[0]
+# class Binning
+
 def run(params, h5file):
     outfile = os.path.splitext(h5file)[0] + "_bin%d.h5" % params.bin
     h5 = h5py.File(h5file, "r")
@@ -66,21 +77,18 @@ def run(params, h5file):
     h5out.create_group("/entry/data")
     h5out["/entry/data"].attrs["NX_class"] = "NXdata"
 
-    def worker(k):
+    # Offsets of the binned area
+    k0 = sorted(h5["/entry/data"].keys())[0]
+    u, l = software_binning(h5["/entry/data"][k0][0:1], params.bin, params.dead_area_treatment)[1:]
+    map_res = [(u, l)]
+
+    for k in sorted(h5["/entry/data"].keys()):
         print "Converting %s" % k
-        data = h5["/entry/data"][k][:]
-        data, u, l = software_binning(data, params.bin, params.dead_area_treatment)
+        datafile = os.path.join(os.path.dirname(h5file), h5["/entry/data"].get(k, getlink=True).filename)
         dfile = os.path.splitext(h5["/entry/data"].get(k, getlink=True).filename)[0]+"_bin%d.h5"%params.bin
-        eiger.create_data_file(os.path.join(os.path.dirname(outfile), dfile),
-                               data, (1, data.shape[1], data.shape[2]),
-                               h5["/entry/data"][k].attrs["image_nr_low"],
-                               h5["/entry/data"][k].attrs["image_nr_high"])
-        return u, l
-    # worker()
-
-    map_res = easy_mp.pool_map(fixed_func=worker,
-                               args=h5["/entry/data"].keys(),
-                               processes=params.nproc)
+        eiger.process_data_file(datafile, os.path.join(os.path.dirname(outfile), dfile),
+                                [Binning(params.bin, params.dead_area_treatment)],
+                                block_frames=params.block_frames, nproc=params.nproc)
 
     f_xyconv = lambda x,y: ((x-map_res[0][0])/params.bin, (y-map_res[0][1])/params.bin)
 
@@ -4,15 +4,30 @@ Author: Keitaro Yamashita
 
 This software is released under the new BSD License; see LICENSE.
 """
+import iotbx.phil
 import h5py
 from yamtbx.dataproc import eiger
+from libtbx import easy_mp
 import numpy
 import time
 import shutil
 import os
+import glob
 import traceback
 import tempfile
 
+master_params_str = """\
+nproc = 1
+ .type = int(value_min=1)
+ .help = Number of files processed concurrently
+check_data = True
+ .type = bool
+ .help = Compare each chunk with original data after writing
+tmpdir = /dev/shm
+ .type = path
+ .help = Compressed file is written here first and then moved
+"""
+
 def is_bslz4_applied(h5obj, dspath):
     import bitshuffle.h5
     ds = h5obj[dspath]
@@ -22,54 +37,80 @@ def is_bslz4_applied(h5obj, dspath):
     return p.get_filter(0)[0] == bitshuffle.h5.H5FILTER
 # is_bslz4_applied()
 
-def run_safe(infile, check_data=True):
+def run_safe(infile, check_data=True, tmpdir="/dev/shm"):
+    """
+    Returns (uncompressed size, compressed size) in bytes, or None if not done.
+    """
     startt = time.time()
     h5in = h5py.File(infile, "r")
+    try:
+        if is_bslz4_applied(h5in, "/entry/data/data"):
+            print "SKIPPING. Already bslz4'd: %s" % infile
+            return
+    finally:
+        h5in.close()
 
-    if is_bslz4_applied(h5in, "/entry/data/data"):
-        print "SKIPPING. Already bslz4'd: %s" % infile
-        return
-
-    outfile = tempfile.mkstemp(prefix=os.path.basename(infile), dir="/dev/shm")[1]
+    fd, outfile = tempfile.mkstemp(prefix=os.path.basename(infile), dir=tmpdir)
+    os.close(fd)
 
-    # copy and compress data
-    data = h5in["/entry/data/data"]
-    eiger.create_data_file(outfile, data, data.chunks,
-                           h5in["/entry/data/data"].attrs["image_nr_low"],
-                           h5in["/entry/data/data"].attrs["image_nr_high"])
+    try:
+        try:
+            # copy and compress data, checking each chunk
+            nbytes = eiger.recompress_data_file(infile, outfile, verify=check_data)
+        except RuntimeError, e:
+            print "Error! %s # %.3f sec" % (e, time.time() - startt)
+            return
 
-    h5in.close()
+        eltime = time.time() - startt
+        size1 = os.path.getsize(infile) / 1024.**2
+        size2 = os.path.getsize(outfile) / 1024.**2
+        ret = os.path.getsize(infile), os.path.getsize(outfile)
 
-    eltime = time.time() - startt
-    size1 = os.path.getsize(infile) / 1024**2
-    size2 = os.path.getsize(outfile) / 1024**2
-
-    if check_data:
-        # Check data and overwrite if ok
-        h5in = h5py.File(infile, "r")
-        h5out = h5py.File(outfile, "r")
-        if (h5in["/entry/data/data"][:] == h5out["/entry/data/data"][:]).all():
-            print "OK. overwriting with compressed file: %s # %.3f sec %.2f MB -> %.2f MB (%.1f %%)" % (infile, eltime, size1, size2, size2/size1*100.)
-            shutil.move(outfile, infile)
-        else:
-            print "Error! data not match: %s # %.3f sec" % (infile, eltime)
-    else:
-        print "Overwriting with compressed file: %s # %.3f sec %.2f MB -> %.2f MB (%.1f %%)" % (infile, eltime, size1, size2, size2/size1*100.)
+        print "%s with compressed file: %s # %.3f sec %.2f MB -> %.2f MB (%.1f %%) %.1f MB/s" % ("OK. overwriting" if check_data else "Overwriting",
+                                                                                                infile, eltime, size1, size2, size2/size1*100.,
+                                                                                                nbytes/1024.**2/eltime)
         shutil.move(outfile, infile)
+        return ret
+    finally:
+        # Not to leave large files (in /dev/shm) on any errors
+        if os.path.isfile(outfile): os.remove(outfile)
+# run_safe()
 
-    if os.path.isfile(outfile):
-        print " temporary file removed: %s" % outfile
-        os.remove(outfile)
-    
-# run()
+def run(params, files):
+    startt = time.time()
 
-def run_from_args(argv):
-    for f in argv:
+    def work(f):
         try:
-            run_safe(f)
+            return run_safe(f, params.check_data, params.tmpdir)
         except:
             print "Exception with %s" % f
             print traceback.format_exc()
+    # work()
+
+    results = easy_mp.pool_map(fixed_func=work, args=files, processes=params.nproc)
+    results = filter(lambda x: x is not None, results)
+
+    eltime = time.time() - startt
+    size1 = sum(map(lambda x: x[0], results)) / 1024.**2
+    size2 = sum(map(lambda x: x[1], results)) / 1024.**2
+    print "%d/%d files compressed in %.1f sec. %.1f MB -> %.1f MB (%.1f MB/s)" % (len(results), len(files), eltime,
+                                                                                  size1, size2, size1/eltime)
+# run()
+
+def run_from_args(argv):
+    cmdline = iotbx.phil.process_command_line(args=argv,
+                                              master_string=master_params_str)
+    params = cmdline.work.extract()
+
+    files = []
+    for arg in cmdline.remaining_args:
+        if os.path.isdir(arg):
+            files.extend(sorted(glob.glob(os.path.join(arg, "*_data_*.h5"))))
+        else:
+            files.append(arg)
+
+    run(params, files)
+# run_from_args()
 
 
 if __name__ == "__main__":
@@ -14,8 +14,79 @@ import traceback
 import tempfile
 import glob
 import math
+import bisect
 from yamtbx.dataproc import eiger
 
+def get_filter_ids(ds):
+    p = ds.id.get_create_plist()
+    return map(lambda i: p.get_filter(i)[0], xrange(p.get_nfilters()))
+# get_filter_ids()
+
+def write_frames(outfile, sources, newlow, newhigh, chunks):
+    """
+    Write frames newlow..newhigh (1-based image numbers) to a new data file.
+    sources: list of (image_nr_low, image_nr_high, h5py dataset) sorted by image_nr_low.
+    Output chunks which are aligned to chunks in a source dataset (with the same chunk shape and filters)
+    are copied as they are without decompression. Other chunks are assembled frame by frame.
+    Returns number of chunks copied without decompression.
+    """
+    lows = map(lambda x: x[0], sources)
+
+    def locate(frame): # returns index in sources and offset in the dataset
+        i = bisect.bisect_right(lows, frame) - 1
+        if i < 0 or frame > sources[i][1]: raise RuntimeError("Frame %d not found" % frame)
+        return i, frame - sources[i][0]
+    # locate()
+
+    nframes = newhigh - newlow + 1
+    shape = (nframes,) + sources[0][2].shape[1:]
+    dtype = sources[0][2].dtype
+
+    h5 = h5py.File(outfile, "w")
+    h5.create_group("/entry")
+    h5["/entry"].attrs["NX_class"] = "NXentry"
+    h5.create_group("/entry/data")
+    h5["/entry/data"].attrs["NX_class"] = "NXdata"
+    dataset = eiger.compress_h5data(h5, "/entry/data/data", None, chunks, shape=shape, dtype=dtype)
+    dataset.attrs["image_nr_low"] = newlow
+    dataset.attrs["image_nr_high"] = newhigh
+
+    out_filters = get_filter_ids(dataset)
+    can_copy = tuple(chunks[1:]) == tuple(shape[1:]) and hasattr(dataset.id, "write_direct_chunk")
+    copyable = {} # source index -> bool
+    zeros = (0,) * (len(shape)-1)
+    n_copied = 0
+
+    for o in xrange(0, nframes, chunks[0]):
+        n = min(chunks[0], nframes - o)
+        i, s = locate(newlow + o)
+        src = sources[i][2]
+
+        if i not in copyable:
+            copyable[i] = (can_copy and hasattr(src.id, "read_direct_chunk") and src.chunks == chunks and
+                           src.dtype == dtype and get_filter_ids(src) == out_filters)
+
+        if copyable[i] and s % chunks[0] == 0 and s + n <= src.shape[0]:
+            # Data beyond the extent in the last chunk (if any) are ignored by HDF5.
+            filter_mask, buf = src.id.read_direct_chunk((s,)+zeros)
+            dataset.id.write_direct_chunk((o,)+zeros, buf, filter_mask)
+            n_copied += 1
+            continue
+
+        pieces = []
+        f = newlow + o
+        while f < newlow + o + n:
+            i, s = locate(f)
+            m = min(newlow + o + n - f, sources[i][1] - f + 1)
+            pieces.append(sources[i][2][s:s+m])
+            f += m
+
+        dataset[o:o+n] = numpy.concatenate(pieces) if len(pieces) > 1 else pieces[0]
+
+    h5.close()
+    return n_copied
+# write_frames()
+
 def run(infile, nframes, tmpdir="/dev/shm"):
     wdir = tempfile.mkdtemp(prefix="h5split", dir=tmpdir)
     orgdir = os.path.normpath(os.path.dirname(infile))
@@ -28,54 +99,34 @@ def run(infile, nframes, tmpdir="/dev/shm"):
     h5in = h5py.File(infile_tmp, "a")
     h5org = h5py.File(infile, "r")
 
-    datasets = []
-    n_all = max(map(lambda k: h5org["/entry/data"][k].attrs["image_nr_high"], h5org["/entry/data"].keys()))
-    lookup = map(lambda x: 0, xrange(n_all))
+    sources = [] # (image_nr_low, image_nr_high, dataset)
     org_files = [infile]
 
     print "Reading original data"
-    for i, k in enumerate(sorted(h5org["/entry/data"].keys())):
+    for k in sorted(h5org["/entry/data"].keys()):
         print " %s %s" % (k, h5org["/entry/data"][k].shape)
-        datasets.append(h5org["/entry/data"][k])
-        low, high = h5org["/entry/data"][k].attrs["image_nr_low"], h5org["/entry/data"][k].attrs["image_nr_high"]
-        for j in xrange(low, high+1): lookup[j-1] = i
+        ds = h5org["/entry/data"][k]
+        sources.append((int(ds.attrs["image_nr_low"]), int(ds.attrs["image_nr_high"]), ds))
 
         del h5in["/entry/data"][k]
         org_files.append(os.path.join(orgdir, h5org["/entry/data"].get(k, getlink=True).filename))
 
+    sources.sort(key=lambda x: x[0])
+    n_all = max(map(lambda x: x[1], sources))
+    chunks = sources[0][2].chunks
+    if chunks is None: chunks = (1,) + sources[0][2].shape[1:]
+
     # Write data
-    cur_idx = 0
     for i in xrange(int(math.ceil(n_all/float(nframes)))):
         outname = "data_%.6d" % (i+1)
         print "preparing", outname
         newlow, newhigh = i*nframes+1, min((i+1)*nframes, n_all)
-        if lookup[newlow-1] == lookup[newhigh-1]:
-            lidx = len(filter(lambda x: x==lookup[newlow-1], lookup[:newlow-1]))
-            ridx = lidx + (newhigh - newlow + 1)
-            data = datasets[lookup[newlow-1]][lidx:ridx]
-            print " data_%.6d [%6d, %6d)" % (lookup[newlow-1]+1, lidx, ridx)
-        else:
-            data = None
-            for j in xrange(lookup[newlow-1], lookup[newhigh-1]+1):
-                if j == lookup[newlow-1]:
-                    lidx = len(filter(lambda x: x==j, lookup[:newlow])) - 1
-                    ridx = None # till end
-                elif j == lookup[newhigh-1]:
-                    lidx = 0
-                    ridx = len(filter(lambda x: x==j, lookup[:newhigh]))
-                else:
-                    lidx = 0
-                    ridx = None # till end
-
-                print " data_%.6d [%6s, %6s)" % (j+1, lidx, ridx)
-                if data is None: data = datasets[j][lidx:ridx]
-                else: data = numpy.concatenate((data, datasets[j][lidx:ridx]))
-        
-        eiger.create_data_file(os.path.join(wdir, outname+".h5"), data, datasets[0].chunks, newlow, newhigh)
+        n_copied = write_frames(os.path.join(wdir, outname+".h5"), sources, newlow, newhigh, chunks)
         h5in["/entry/data/%s"%outname] = h5py.ExternalLink(outname+".h5", "/entry/data/data")
-        print " wrote %s %s" % (outname+".h5", data.shape)
+        print " wrote %s frames %d-%d (%d chunks copied without decompression)" % (outname+".h5", newlow, newhigh, n_copied)
 
     h5in.close()
+    h5org.close()
 
     bdir = os.path.join(orgdir, "split_org_%s"%time.strftime("%y%m%d-%H%M%S"))
     os.mkdir(bdir)
@@ -95,4 +146,4 @@ def run(infile, nframes, tmpdir="/dev/shm"):
 
 if __name__ == "__main__":
     import sys
-    run_safe(sys.argv[1], int(sys.argv[2]))
+    run(sys.argv[1], int(sys.argv[2]))
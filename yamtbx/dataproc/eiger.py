@@ -14,6 +14,8 @@ import json
 import struct
 import numpy
 import os
+import collections
+import multiprocessing
 from yamtbx.dataproc import software_binning
 
 def read_stream_data(frames, bss_job_mode=4):
@@ -92,16 +94,26 @@ def extract_data(h5master, frameno, apply_pixel_mask=True, return_raw=False):
     if return_raw:
         return data
 
+    mask = None
+    if apply_pixel_mask and "/entry/instrument/detector/detectorSpecific/pixel_mask" in h5:
+        mask = h5["/entry/instrument/detector/detectorSpecific/pixel_mask"][:]
+
+    return mask_raw_data(data, mask)
+# extract_data()
+
+def mask_raw_data(data, mask=None):
+    """
+    Returns int32 copy of raw data; -3 for invalid (max value) pixels, -1 and -2 for pixels in mask (gap and bad).
+    """
     byte = data.dtype.itemsize
     data = data.astype(numpy.int32)
     data[data==2**(byte*8)-1] = -3 # To see pixels not masked by pixel mask.
-    if apply_pixel_mask and "/entry/instrument/detector/detectorSpecific/pixel_mask" in h5:
-        mask = h5["/entry/instrument/detector/detectorSpecific/pixel_mask"][:]
+    if mask is not None:
         data[mask==1] = -1
         data[mask>1] = -2
 
     return data
-# extract_data()
+# mask_raw_data()
 
 def extract_data_path(h5master, path, apply_pixel_mask=True, return_raw=False):
     h5 = h5py.File(h5master, "r")
@@ -162,7 +174,6 @@ def extract_data_range_sum(h5master, frames):
 # extract_data()
 
 def extract_to_minicbf(h5master, frameno_or_path, cbfout, binning=1):
-    from yamtbx.dataproc import cbf
     from yamtbx.dataproc.XIO.plugins import eiger_hdf5_interpreter
 
     if type(frameno_or_path) in (tuple, list):
@@ -181,13 +192,23 @@ def extract_to_minicbf(h5master, frameno_or_path, cbfout, binning=1):
 
     h = eiger_hdf5_interpreter.Interpreter().getRawHeadDict(h5master)
     h5 = h5py.File(h5master, "r")
+    h["Detector"] = h5["/entry/instrument/detector/description"].value
+    h["ExposurePeriod"] = h5["/entry/instrument/detector/frame_time"].value
+    save_minicbf(data, h, cbfout, nframes, binning)
+# extract_to_minicbf()
+
+def save_minicbf(data, header, cbfout, nframes=1, binning=1):
+    """
+    header: dict from eiger_hdf5_interpreter.getRawHeadDict() with Detector and ExposurePeriod added.
+    It is not modified.
+    """
+    from yamtbx.dataproc import cbf
 
+    h = dict(header)
     if binning>1:
         beamxy = h["BeamX"], h["BeamY"]
         data, (h["BeamX"], h["BeamY"]) = software_binning(data, binning, beamxy)
 
-    h["Detector"] = h5["/entry/instrument/detector/description"].value
-    h["ExposurePeriod"] = h5["/entry/instrument/detector/frame_time"].value
     h["PhiWidth"] *= nframes
     cbf.save_numpy_data_as_cbf(data.flatten(), size1=data.shape[1], size2=data.shape[0], title="",
                                cbfout=cbfout,
@@ -204,20 +225,72 @@ def extract_to_minicbf(h5master, frameno_or_path, cbfout, binning=1):
 # Start_angle %(PhiStart).6f deg.
 # Angle_increment %(PhiWidth).6f deg.
 """ % h)
-# extract_to_minicbf()
-
-def compress_h5data(h5obj, path, data, chunks, compression="bslz4"):
+# save_minicbf()
+
+class MinicbfExtractor:
+    """
+    Writes frames of a master file as minicbf one by one.
+    The master file is opened and the header and pixel mask are read only once,
+    unlike extract_to_minicbf() which does them for every frame.
+    """
+    def __init__(self, h5master, binning=1):
+        from yamtbx.dataproc.XIO.plugins import eiger_hdf5_interpreter
+
+        self.h5master = h5master
+        self.binning = binning
+        self.header = eiger_hdf5_interpreter.Interpreter().getRawHeadDict(h5master)
+        self.h5 = h5py.File(h5master, "r")
+        self.header["Detector"] = self.h5["/entry/instrument/detector/description"].value
+        self.header["ExposurePeriod"] = self.h5["/entry/instrument/detector/frame_time"].value
+
+        self.mask = None
+        if "/entry/instrument/detector/detectorSpecific/pixel_mask" in self.h5:
+            self.mask = self.h5["/entry/instrument/detector/detectorSpecific/pixel_mask"][:]
+
+        self.sources = [] # (image_nr_low, image_nr_high, dataset)
+        for k in sorted(self.h5["/entry/data"].keys()):
+            ds = self.h5["/entry/data"].get(k)
+            if not ds: continue
+            self.sources.append((ds.attrs["image_nr_low"], ds.attrs["image_nr_high"], ds))
+    # __init__()
+
+    def extract_data(self, frameno):
+        for low, high, ds in self.sources:
+            if low <= frameno <= high:
+                return mask_raw_data(ds[frameno - low,], self.mask)
+        return None
+    # extract_data()
+
+    def write_minicbf(self, frameno, cbfout):
+        data = self.extract_data(frameno)
+        if data is None:
+            raise RuntimeError("Cannot extract frame %s from %s"%(frameno, self.h5master))
+        save_minicbf(data, self.header, cbfout, binning=self.binning)
+    # write_minicbf()
+
+    def close(self):
+        self.sources = []
+        self.h5.close()
+    # close()
+# class MinicbfExtractor
+
+def compress_h5data(h5obj, path, data, chunks, compression="bslz4", shape=None, dtype=None):
+    """
+    If data is None, an empty dataset of shape and dtype is created.
+    """
     import bitshuffle.h5
 
+    if data is not None: shape, dtype = data.shape, data.dtype
+
     if compression=="bslz4":
-        dataset = h5obj.create_dataset(path, data.shape,
+        dataset = h5obj.create_dataset(path, shape,
                                        compression=bitshuffle.h5.H5FILTER,
                                        compression_opts=(0, bitshuffle.h5.H5_COMPRESS_LZ4),
-                                       chunks=chunks, dtype=data.dtype, data=data)
+                                       chunks=chunks, dtype=dtype, data=data)
     elif compression=="shuf+gz":
-        dataset = h5obj.create_dataset(path, data.shape,
+        dataset = h5obj.create_dataset(path, shape,
                                        compression="gzip",shuffle=True,
-                                       chunks=chunks, dtype=data.dtype, data=data)
+                                       chunks=chunks, dtype=dtype, data=data)
     else:
         raise "Unknwon compression name (%s)" % compression
 
@@ -238,6 +311,218 @@ def create_data_file(outfile, data, chunks, nrlow, nrhigh):
     h5.close()
 # create_data_file()
 
+def bslz4_compress_chunk(data):
+    """
+    Returns data compressed in the same format as the bitshuffle HDF5 filter,
+    which can be written by write_direct_chunk().
+    """
+    import bitshuffle
+
+    elem_size = data.dtype.itemsize
+    block_size = max(128, (8192 // elem_size) // 8 * 8) # same as bshuf_default_block_size()
+    compressed = bitshuffle.compress_lz4(numpy.ascontiguousarray(data).reshape(-1), block_size)
+    return struct.pack(">QI", data.nbytes, block_size * elem_size) + compressed.tostring()
+# bslz4_compress_chunk()
+
+def recompress_data_file(infile, outfile, dspath="/entry/data/data", verify=True):
+    """
+    Copy dataset in infile to a new data file compressed with bslz4, chunk by chunk.
+    Chunks are compressed here and written directly (without HDF5 filter pipeline) when possible.
+    If verify, each chunk is read back from the new file and compared with the original.
+    Only one chunk is kept in memory at a time.
+    Returns number of bytes (uncompressed) copied. Raises RuntimeError if verification failed.
+    """
+    h5in = h5py.File(infile, "r")
+    src = h5in[dspath]
+    shape = src.shape
+    chunks = src.chunks if src.chunks is not None else (1,)+shape[1:]
+
+    h5 = h5py.File(outfile, "w")
+    h5.create_group("/entry")
+    h5["/entry"].attrs["NX_class"] = "NXentry"
+    h5.create_group("/entry/data")
+    h5["/entry/data"].attrs["NX_class"] = "NXdata"
+
+    dataset = compress_h5data(h5, "/entry/data/data", None, chunks, shape=shape, dtype=src.dtype)
+    for k in ("image_nr_low", "image_nr_high"):
+        if k in src.attrs: dataset.attrs[k] = src.attrs[k]
+
+    direct = tuple(chunks[1:]) == tuple(shape[1:]) and hasattr(dataset.id, "write_direct_chunk")
+    if direct:
+        try:
+            import bitshuffle
+            direct = hasattr(bitshuffle, "compress_lz4")
+        except ImportError:
+            direct = False
+
+    nbytes = 0
+    for i0 in xrange(0, shape[0], chunks[0]):
+        data = src[i0:i0+chunks[0]]
+        i1 = i0 + data.shape[0]
+
+        if direct:
+            if data.shape[0] < chunks[0]: # last chunk must be written in full size
+                tmp = numpy.zeros(chunks, dtype=data.dtype)
+                tmp[:data.shape[0]] = data
+                dataset.id.write_direct_chunk((i0,)+(0,)*(len(shape)-1), bslz4_compress_chunk(tmp))
+            else:
+                dataset.id.write_direct_chunk((i0,)+(0,)*(len(shape)-1), bslz4_compress_chunk(data))
+        else:
+            dataset[i0:i1] = data
+
+        if verify and not numpy.array_equal(dataset[i0:i1], data):
+            h5.close()
+            h5in.close()
+            raise RuntimeError("Data not match in frames %d-%d of %s" % (i0+1, i1, infile))
+
+        nbytes += data.nbytes
+
+    h5.close()
+    h5in.close()
+    return nbytes
+# recompress_data_file()
+
+class FlatFieldCorrection:
+    """
+    Multiply flat field. Invalid pixels (maximum value of the type) are kept as they are.
+    """
+    def __init__(self, flatfield):
+        self.flatfield = flatfield
+
+    def __call__(self, data):
+        maxval = numpy.iinfo(data.dtype).max
+        ret = numpy.clip(data * self.flatfield + .5, 0, maxval-1).astype(data.dtype)
+        ret[data == maxval] = maxval
+        return ret
+# class FlatFieldCorrection
+
+class ApplyPixelMask:
+    def __init__(self, mask, value=None):
+        """
+        Pixels with mask != 0 are set to value (maximum of the type if None)
+        """
+        self.sel = mask != 0
+        self.value = value
+
+    def __call__(self, data):
+        data[:, self.sel] = self.value if self.value is not None else numpy.iinfo(data.dtype).max
+        return data
+# class ApplyPixelMask
+
+class ConvertDtype:
+    """
+    Convert to another integer type. Invalid pixels are set to the maximum of the new type.
+    """
+    def __init__(self, dtype):
+        self.dtype = numpy.dtype(dtype)
+
+    def __call__(self, data):
+        maxval, newmax = numpy.iinfo(data.dtype).max, numpy.iinfo(self.dtype).max
+        ret = numpy.clip(data, 0, newmax-1).astype(self.dtype)
+        ret[data == maxval] = newmax
+        return ret
+# class ConvertDtype
+
+_block_worker_ops = None
+_block_worker_files = {} # opened in each worker process
+
+def _init_block_worker(ops):
+    global _block_worker_ops
+    _block_worker_ops = ops
+    _block_worker_files.clear() # never use handles inherited from parent
+# _init_block_worker()
+
+def _process_block(infile, dspath, i0, i1, chunks, compress):
+    if infile not in _block_worker_files: _block_worker_files[infile] = h5py.File(infile, "r")
+    data = _block_worker_files[infile][dspath][i0:i1]
+    for op in _block_worker_ops: data = op(data)
+
+    if not compress: return i0, data
+
+    ret = []
+    for j in xrange(0, data.shape[0], chunks[0]):
+        chunk = data[j:j+chunks[0]]
+        if chunk.shape[0] < chunks[0]:
+            tmp = numpy.zeros(chunks, dtype=chunk.dtype)
+            tmp[:chunk.shape[0]] = chunk
+            chunk = tmp
+        ret.append((i0+j, bslz4_compress_chunk(chunk)))
+
+    return i0, ret
+# _process_block()
+
+def process_data_file(infile, outfile, ops, dspath="/entry/data/data", block_frames=10, nproc=1):
+    """
+    Read blocks of frames, apply ops and write to a new data file with bslz4 compression.
+    ops: list of functions (or callable objects) which take and return numpy array of (nframes, ny, nx).
+         Output frame shape and dtype may differ from input. Must be picklable if nproc > 1.
+    Blocks are processed in nproc worker processes, each of which opens infile by itself.
+    Compression is also done in workers when direct chunk writing is available.
+    At most 2*nproc blocks are in flight, so memory is bounded by block_frames.
+    Returns number of frames.
+    """
+    h5in = h5py.File(infile, "r")
+    src = h5in[dspath]
+    nframes = src.shape[0]
+    attrs = dict(map(lambda k: (k, src.attrs[k]), filter(lambda k: k in src.attrs, ("image_nr_low", "image_nr_high"))))
+    probe = src[0:1]
+    h5in.close() # Don't keep file open over fork
+
+    for op in ops: probe = op(probe)
+    chunks = (1,) + probe.shape[1:]
+
+    pool = None
+    if nproc > 1: pool = multiprocessing.Pool(nproc, initializer=_init_block_worker, initargs=(ops,))
+    else: _init_block_worker(ops)
+
+    h5 = h5py.File(outfile, "w")
+    h5.create_group("/entry")
+    h5["/entry"].attrs["NX_class"] = "NXentry"
+    h5.create_group("/entry/data")
+    h5["/entry/data"].attrs["NX_class"] = "NXdata"
+    dataset = compress_h5data(h5, "/entry/data/data", None, chunks, shape=(nframes,)+probe.shape[1:], dtype=probe.dtype)
+    for k in attrs: dataset.attrs[k] = attrs[k]
+
+    compress = hasattr(dataset.id, "write_direct_chunk")
+    if compress:
+        try:
+            import bitshuffle
+            compress = hasattr(bitshuffle, "compress_lz4")
+        except ImportError:
+            compress = False
+
+    def write(result):
+        i0, res = result
+        if compress:
+            for offset, buf in res: dataset.id.write_direct_chunk((offset,)+(0,)*(len(chunks)-1), buf)
+        else:
+            dataset[i0:i0+res.shape[0]] = res
+    # write()
+
+    blocks = map(lambda i0: (infile, dspath, i0, min(i0+block_frames, nframes), chunks, compress),
+                 xrange(0, nframes, block_frames))
+    try:
+        if pool is None:
+            for args in blocks: write(_process_block(*args))
+        else:
+            pending = collections.deque()
+            for args in blocks:
+                pending.append(pool.apply_async(_process_block, args))
+                if len(pending) >= 2*nproc: write(pending.popleft().get())
+            while pending: write(pending.popleft().get())
+            pool.close()
+    except:
+        if pool is not None: pool.terminate()
+        raise
+    finally:
+        if pool is not None: pool.join()
+        for f in _block_worker_files.values(): f.close()
+        _block_worker_files.clear()
+        h5.close()
+
+    return nframes
+# process_data_file()
+
 def get_masterh5_related_filenames(masterh5):
     ret = [masterh5]
 
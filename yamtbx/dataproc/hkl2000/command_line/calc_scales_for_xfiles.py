@@ -6,12 +6,18 @@ This software is released under the new BSD License; see LICENSE.
 """
 from yamtbx.dataproc.hkl2000.xfile import DenzoXfile
 from yamtbx.dataproc.scale_data import kBdecider, kBdecider3
+from yamtbx.util.maths import pack_hkl
 
 import iotbx.phil
 import iotbx.file_reader
 from cctbx.array_family import flex
+from libtbx import easy_mp
 
+import sys
+import numpy
 import traceback
+import itertools
+import cStringIO
 
 master_params_str = """
 lstin = None
@@ -35,6 +41,9 @@ reference {
   .type = float
 }
 
+nproc = 1
+ .type = int
+ .help = Number of x-files processed in parallel
 show_plot = False
  .type = bool
 help = False
@@ -42,32 +51,48 @@ help = False
 """
 
 
-def run(params, xfiles):
-    # read reference
-    arrays = iotbx.file_reader.any_file(params.reference.file).file_server.miller_arrays
-    arrays = filter(lambda ar: ar.is_xray_data_array(), arrays)
-    if params.reference.label is not None:
-        arrays = filter(lambda ar: ar.info().label_string() == params.reference.label, arrays)
-
-    if len(arrays) != 1:
-        print "Can't decide data to use in reference file:", params.reference.file
-        print "Choose label"
-        for ar in arrays: print ar.info().label_string()
-        return
-
-    refdata = arrays[0].as_intensity_array()
-    refdata = refdata.resolution_filter(d_max=params.reference.d_max, d_min=params.reference.d_min)
-
-    print "file n.common k b cc.org cc.mean cc.scaled a b c al be ga"
-    
-    for xf in xfiles:
+class ReferenceIndex:
+    """
+    Reference data with sorted hkl keys; prepared once and used for all x-files
+    instead of matching indices in common_sets() for each file.
+    """
+    def __init__(self, refdata):
+        self.refdata = refdata.map_to_asu()
+        keys = pack_hkl(self.refdata.indices())
+        self.order = numpy.argsort(keys, kind="mergesort")
+        self.keys = keys[self.order]
+    # __init__()
+
+    def common_sets(self, a):
+        """
+        a: merged array in asu. Returns (reference, a) of common reflections.
+        """
+        keys = pack_hkl(a.indices())
+        if len(self.keys) == 0 or len(keys) == 0: sel = numpy.zeros(len(keys), dtype=numpy.bool)
+        else:
+            pos = numpy.searchsorted(self.keys, keys)
+            pos[pos >= len(self.keys)] = 0
+            sel = self.keys[pos] == keys
+
+        refsel = self.order[pos[sel]] if sel.any() else numpy.zeros(0, dtype=numpy.int64)
+        return (self.refdata.select(flex.size_t(refsel.astype(numpy.uint64))),
+                a.select(flex.bool(sel)))
+    # common_sets()
+# class ReferenceIndex
+
+def scale_xfile(xf, ref, params):
+    """
+    Read x-file, merge, and determine scale and B against reference.
+    Returns dict; messages (also those printed by kBdecider) are in "log".
+    """
+    ret = dict(xf=xf)
+    log = cStringIO.StringIO()
+    stdout_org, sys.stdout = sys.stdout, log # Not to mix outputs from parallel processes
+
+    try:
         print "# Reading", xf
-        try:
-            xfile = DenzoXfile(xf)
-        except:
-            traceback.print_exc()
-            continue
-        a = xfile.miller_array(anomalous_flag=refdata.anomalous_flag())
+        xfile = DenzoXfile(xf)
+        a = xfile.miller_array(anomalous_flag=ref.refdata.anomalous_flag())
         a = a.select(a.sigmas() > 0)
         a = a.resolution_filter(d_min=params.d_min, d_max=params.d_max)
         if params.sigma_cutoff is not None:
@@ -75,15 +100,15 @@ def run(params, xfiles):
 
         a = a.merge_equivalents(use_internal_variance=False).array()
 
-        tmp, a = refdata.common_sets(a, assert_is_similar_symmetry=False)
-        n_common = tmp.size()
+        tmp, a = ref.common_sets(a)
+        ret["n_common"] = n_common = tmp.size()
 
         if n_common == 0:
             print "# No useful reflection in this file. skip."
-            continue
+            return ret
 
         corr = flex.linear_correlation(tmp.data(), a.data())
-        cc_org = corr.coefficient() if corr.is_well_defined() else float("nan")
+        ret["cc_org"] = corr.coefficient() if corr.is_well_defined() else float("nan")
 
         # Calc CC in resolution bin and average
         tmp.setup_binner(auto_binning=True)
@@ -94,60 +119,109 @@ def run(params, xfiles):
             if not corr.is_well_defined(): continue
             cc_bins.append(corr.coefficient())
 
-        cc_mean = sum(cc_bins) / float(len(cc_bins)) if len(cc_bins) > 0 else float("nan")
+        ret["cc_mean"] = sum(cc_bins) / float(len(cc_bins)) if len(cc_bins) > 0 else float("nan")
             
         # Determine scale and B
         k, b = kBdecider(tmp, a).run()
+        ret["k"], ret["b"] = k, b
 
         bfac = flex.exp(-b * a.d_star_sq().data()) if b != 0 else 1.
         corr = flex.linear_correlation(tmp.data(), a.data() * k*bfac)
-        cc_scaled = corr.coefficient() if corr.is_well_defined() else float("nan")
+        ret["cc_scaled"] = corr.coefficient() if corr.is_well_defined() else float("nan")
+        ret["cell"] = a.unit_cell().parameters()
+
+        if params.show_plot: ret["plot_data"] = (tmp, a, cc_bins)
+    except:
+        print traceback.format_exc()
+    finally:
+        sys.stdout = stdout_org
+        ret["log"] = log.getvalue()
+
+    return ret
+# scale_xfile()
+
+def show_plot(tmp, a, k, b, cc_bins):
+    import pylab
+    from matplotlib.ticker import FuncFormatter
+    s3_formatter = lambda x,pos: "inf" if x == 0 else "%.2f" % (x**(-1/3))
+
+    fig, ax1 = pylab.plt.subplots()
+
+    plot_x = map(lambda i: tmp.binner().bin_d_range(i)[1]**(-3), tmp.binner().range_used())
+
+    #for name, ar in (("reference", tmp), ("data", a)):
+    vals = map(lambda i: flex.mean(tmp.data().select(tmp.binner().selection(i))), tmp.binner().range_used())
+    pylab.plot(plot_x, vals, label="reference")
+
+    scale = flex.sum(tmp.data()*a.data()) / flex.sum(flex.pow2(a.data()))
+    print "Linear-scale=", scale
+    vals = map(lambda i: scale*flex.mean(a.data().select(tmp.binner().selection(i))), tmp.binner().range_used())
+    pylab.plot(plot_x, vals, label="data")
+    bfac = flex.exp(-b * a.d_star_sq().data()) if b != 0 else 1.
+    vals = map(lambda i: flex.mean((a.data()*k*bfac).select(tmp.binner().selection(i))), tmp.binner().range_used())
+    pylab.plot(plot_x, vals, label="data_scaled")
+
+    """
+    from mmtbx.scaling import absolute_scaling, relative_scaling
+    ls_scaling = relative_scaling.ls_rel_scale_driver(tmp, tmp.customized_copy(data=a.data(),sigmas=a.sigmas()), use_intensities=True, scale_weight=True, use_weights=True)
+    ls_scaling.show()
+    vals = map(lambda i: flex.mean(ls_scaling.derivative.resolution_filter(*tmp.binner().bin_d_range(i)).data()), tmp.binner().range_used())
+    pylab.plot(plot_x, vals, label="data_scaled2")
+    """
+    
+    pylab.legend()
+    pylab.xlabel('resolution (d^-3)')
+    pylab.ylabel('<I>')
+    pylab.setp(pylab.gca().get_legend().get_texts(), fontsize="small")
+    pylab.title('Scaled with B-factors (%.2f)' % b)
 
-        print "%s %5d %.3e %.3e %.4f %.4f %.4f" % (xf, n_common, k, b, cc_org, cc_mean, cc_scaled),
-        print ("%.3f "*6)%a.unit_cell().parameters()
+    pylab.gca().xaxis.set_major_formatter(FuncFormatter(s3_formatter))
 
-        if params.show_plot:
-            import pylab
-            from matplotlib.ticker import FuncFormatter
-            s3_formatter = lambda x,pos: "inf" if x == 0 else "%.2f" % (x**(-1/3))
-
-            fig, ax1 = pylab.plt.subplots()
-
-            plot_x = map(lambda i: tmp.binner().bin_d_range(i)[1]**(-3), tmp.binner().range_used())
-
-            #for name, ar in (("reference", tmp), ("data", a)):
-            vals = map(lambda i: flex.mean(tmp.data().select(tmp.binner().selection(i))), tmp.binner().range_used())
-            pylab.plot(plot_x, vals, label="reference")
-
-            scale = flex.sum(tmp.data()*a.data()) / flex.sum(flex.pow2(a.data()))
-            print "Linear-scale=", scale
-            vals = map(lambda i: scale*flex.mean(a.data().select(tmp.binner().selection(i))), tmp.binner().range_used())
-            pylab.plot(plot_x, vals, label="data")
-            vals = map(lambda i: flex.mean((a.data()*k*bfac).select(tmp.binner().selection(i))), tmp.binner().range_used())
-            pylab.plot(plot_x, vals, label="data_scaled")
-
-            """
-            from mmtbx.scaling import absolute_scaling, relative_scaling
-            ls_scaling = relative_scaling.ls_rel_scale_driver(tmp, tmp.customized_copy(data=a.data(),sigmas=a.sigmas()), use_intensities=True, scale_weight=True, use_weights=True)
-            ls_scaling.show()
-            vals = map(lambda i: flex.mean(ls_scaling.derivative.resolution_filter(*tmp.binner().bin_d_range(i)).data()), tmp.binner().range_used())
-            pylab.plot(plot_x, vals, label="data_scaled2")
-            """
-            
-            pylab.legend()
-            pylab.xlabel('resolution (d^-3)')
-            pylab.ylabel('<I>')
-            pylab.setp(pylab.gca().get_legend().get_texts(), fontsize="small")
-            pylab.title('Scaled with B-factors (%.2f)' % b)
-
-            pylab.gca().xaxis.set_major_formatter(FuncFormatter(s3_formatter))
-
-            ax2 = ax1.twinx()
-            ax2.plot(plot_x, cc_bins, "black")
-            ax2.set_ylabel('CC')
-            pylab.show()
-            
+    ax2 = ax1.twinx()
+    ax2.plot(plot_x, cc_bins, "black")
+    ax2.set_ylabel('CC')
+    pylab.show()
+# show_plot()
 
+def run(params, xfiles):
+    # read reference
+    arrays = iotbx.file_reader.any_file(params.reference.file).file_server.miller_arrays
+    arrays = filter(lambda ar: ar.is_xray_data_array(), arrays)
+    if params.reference.label is not None:
+        arrays = filter(lambda ar: ar.info().label_string() == params.reference.label, arrays)
+
+    if len(arrays) != 1:
+        print "Can't decide data to use in reference file:", params.reference.file
+        print "Choose label"
+        for ar in arrays: print ar.info().label_string()
+        return
+
+    refdata = arrays[0].as_intensity_array()
+    refdata = refdata.resolution_filter(d_max=params.reference.d_max, d_min=params.reference.d_min)
+    ref = ReferenceIndex(refdata)
+
+    print "file n.common k b cc.org cc.mean cc.scaled a b c al be ga"
+
+    # Workers are forked, so reference is not copied
+    worker = lambda xf: scale_xfile(xf, ref, params)
+    if params.nproc > 1 and not params.show_plot:
+        results = easy_mp.pool_map(fixed_func=worker,
+                                   args=xfiles,
+                                   processes=params.nproc)
+    else:
+        results = itertools.imap(worker, xfiles)
+    
+    for r in results:
+        sys.stdout.write(r["log"])
+        if "cc_scaled" not in r: continue
+
+        print "%s %5d %.3e %.3e %.4f %.4f %.4f" % (r["xf"], r["n_common"], r["k"], r["b"], r["cc_org"], r["cc_mean"], r["cc_scaled"]),
+        print ("%.3f "*6)%r["cell"]
+
+        if params.show_plot:
+            tmp, a, cc_bins = r["plot_data"]
+            show_plot(tmp, a, r["k"], r["b"], cc_bins)
+# run()
 
 if __name__ == "__main__":
     import sys
@@ -8,6 +8,34 @@ import numpy
 from cctbx.array_family import flex
 from cctbx import miller
 from cctbx import crystal
+from yamtbx.dataproc.xds.hkl_columns import as_miller_index
+
+# Columns of reflection lines: name, (start, end), type
+reflection_columns = (("h", (0,4), numpy.int32), ("k", (4,8), numpy.int32), ("l", (8,12), numpy.int32),
+                      ("isfull", (13,14), numpy.int32), ("Ipf", (14,22), numpy.float64),
+                      ("Ips", (22,30), numpy.float64), ("chisq", (30,37), numpy.float64),
+                      ("sigma", (37,43), numpy.float64), ("cos", (43,49), numpy.float64),
+                      ("calx", (49,56), numpy.float64), ("caly", (56,63), numpy.float64),
+                      ("lpo", (63,69), numpy.float64), ("strength", (69,77), numpy.float64))
+
+def parse_reflection_lines(lines):
+    """
+    Parse fixed-width reflection lines of x-file at once.
+    Lines are put in a 2d character array and each column is converted as a whole.
+    Returns numpy record array with fields of reflection_columns.
+    """
+    dtype = map(lambda x: (x[0], x[2]), reflection_columns)
+    if len(lines) == 0: return numpy.zeros(0, dtype=dtype)
+
+    width = reflection_columns[-1][1][1]
+    chars = numpy.array(lines, dtype="S%d"%width).view("S1").reshape(len(lines), width)
+    ret = numpy.zeros(len(lines), dtype=dtype)
+    for name, (start, end), typ in reflection_columns:
+        col = numpy.ascontiguousarray(chars[:,start:end]).view("S%d"%(end-start)).ravel()
+        ret[name] = col.astype(numpy.float64) if typ is numpy.float64 else col.astype(numpy.float64).astype(typ)
+
+    return ret.view(numpy.recarray)
+# parse_reflection_lines()
 
 class DenzoXfile:
     """
@@ -47,29 +75,25 @@ class DenzoXfile:
         # rather than as a floating point number - see example on line T above. Scalepack understands this Denzo
         # convention.
 
-        self.miller_indices = flex.miller_index()
-        self.data = flex.double()
-        self.sigmas = flex.double()
-        
-        for l in ifs:
-            if l.startswith(" 999 "):
-                boxsize = map(int, l.strip().split())[1:]
-                break
-            
-            #sp = l.strip().split()
-            sp = l[:4], l[4:8], l[8:12], l[13], l[14:22], l[22:30], l[30:37], l[37:43], l[43:49], l[49:56], l[56:63], l[63:69], l[69:77]
-            h, k, l, isfull = map(int, sp[:4])
-            Ipf, Ips, chisq, sigma, cos, calx, caly, lpo, strength = map(float, sp[4:])
+        body = ifs.read()
+        i_end = body.find("\n 999 ")
+        if body.startswith(" 999 "): end = 0 # no reflections
+        elif i_end >= 0: end = i_end + 1
+        else: end = len(body)
+        self.table = parse_reflection_lines(body[:end].splitlines())
+        tail = body[end:].splitlines()[1:] # after the line of " 999 " and box size
 
-            if onlyfull and not isfull: continue
-            if onlypartial and isfull: continue
-            
-            self.miller_indices.append((h,k,l))
-            self.data.append(Ips if read_I_sum else Ipf)
-            self.sigmas.append(sigma)
+        sel = numpy.ones(len(self.table), dtype=numpy.bool)
+        if onlyfull: sel = self.table["isfull"] != 0
+        if onlypartial: sel = self.table["isfull"] == 0
+        table = self.table[sel]
+
+        self.miller_indices = as_miller_index(table["h"], table["k"], table["l"])
+        self.data = flex.double(table["Ips" if read_I_sum else "Ipf"])
+        self.sigmas = flex.double(table["sigma"])
 
         self.intbox = [] # 1: background area, 0: guard area, 2: spot area
-        for l in ifs:
+        for l in tail:
             if l.startswith(" "):
                 self.intbox.append(map(int, l.strip()))
             elif l.startswith("unit cell"):
@@ -0,0 +1,224 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Synthetic data files for benchmarking and testing without real data.
+
+ - XDS_ASCII.HKL and INTEGRATE.HKL files with given number of reflections.
+   Intensities of all datasets come from the same 'true' intensities
+   (Wilson distribution with B-factor) so that datasets correlate as real
+   ones. Reflections are written with random symmetry-equivalent indices,
+   and optionally in the alternative indexing (for ambiguity resolution).
+ - EIGER-like HDF5 (master file with pixel mask, linked to data files
+   compressed with bslz4)
+ - CrystFEL stream
+"""
+
+import os
+import numpy
+from cctbx import crystal
+from cctbx import miller
+
+class TrueIntensities:
+    def __init__(self, cell=(60,60,90,90,90,90), space_group="P4", d_min=2.0, b_factor=20., seed=1234):
+        self.symm = crystal.symmetry(cell, space_group)
+        self.d_min = d_min
+        self.random = numpy.random.RandomState(seed)
+        ms = miller.build_set(self.symm, anomalous_flag=False, d_min=d_min)
+        self.indices = ms.indices().as_vec3_double().as_double().as_numpy_array().astype(numpy.int32).reshape(-1, 3)
+        d_star_sq = ms.d_star_sq().data().as_numpy_array()
+        self.intensities = 1000. * self.random.exponential(size=len(self.indices)) * numpy.exp(-b_factor * d_star_sq / 2.)
+        self.rotations = numpy.array(map(lambda x: x.r().as_double(),
+                                          self.symm.space_group().all_ops())).reshape(-1, 3, 3)
+    # __init__()
+
+    def observations(self, n_obs, reindex_op=None, scale=1., random=None):
+        """
+        Returns indices (n_obs,3), iobs, sigma for random observations.
+        reindex_op: sgtbx.change_of_basis_op applied to indices (e.g. to mimic indexing ambiguity)
+        """
+        if random is None: random = self.random
+        sel = random.randint(0, len(self.indices), size=n_obs)
+        rot = self.rotations[random.randint(0, len(self.rotations), size=n_obs)]
+        hkl = numpy.einsum("ni,nij->nj", self.indices[sel].astype(numpy.float64), rot)
+        hkl *= random.choice((-1, 1), size=n_obs)[:,None] # Friedel mates
+        if reindex_op is not None and not reindex_op.is_identity_op():
+            hkl = numpy.dot(hkl, numpy.array(reindex_op.c_inv().r().as_double()).reshape(3,3))
+
+        itrue = scale * self.intensities[sel]
+        sigma = numpy.sqrt(itrue + 10.) * 1.5
+        iobs = itrue + random.normal(size=n_obs) * sigma
+        return numpy.rint(hkl).astype(numpy.int32), iobs, sigma
+    # observations()
+
+# class TrueIntensities
+
+def write_xds_ascii(hklout, true_i, n_obs, reindex_op=None, nframes=100, seed=None):
+    random = numpy.random.RandomState(seed) if seed is not None else true_i.random
+    hkl, iobs, sigma = true_i.observations(n_obs, reindex_op, scale=random.uniform(0.5, 2.), random=random)
+    cell = true_i.symm.unit_cell().parameters()
+    sgnum = true_i.symm.space_group_info().type().number()
+
+    ofs = open(hklout, "w")
+    ofs.write("""\
+!FORMAT=XDS_ASCII    MERGE=FALSE    FRIEDEL'S_LAW=TRUE
+!OUTPUT_FILE=XDS_ASCII.HKL        DATE= 1-Jan-2015
+!Generated by yamtbx synthetic_data
+!SPACE_GROUP_NUMBER=%5d
+!UNIT_CELL_CONSTANTS=  %s
+!X-RAY_WAVELENGTH=  1.000000
+!NX=  2463  NY=  2527    QX=  0.172000  QY=  0.172000
+!ORGX=   1231.00  ORGY=   1263.00
+!DETECTOR_DISTANCE=   200.000
+!DATA_RANGE=       1 %7d
+!NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD=12
+!ITEM_H=1
+!ITEM_K=2
+!ITEM_L=3
+!ITEM_IOBS=4
+!ITEM_SIGMA(IOBS)=5
+!ITEM_XD=6
+!ITEM_YD=7
+!ITEM_ZD=8
+!ITEM_RLP=9
+!ITEM_PEAK=10
+!ITEM_CORR=11
+!ITEM_PSI=12
+!END_OF_HEADER
+""" % (sgnum, " ".join(map(lambda x: "%.3f"%x, cell)), nframes))
+
+    n = len(iobs)
+    cols = numpy.column_stack((hkl, iobs, sigma,
+                               random.uniform(0, 2463, n), random.uniform(0, 2527, n),
+                               random.uniform(0, nframes, n), random.uniform(0.5, 2., n),
+                               random.randint(80, 101, n), random.randint(0, 101, n),
+                               random.uniform(-180, 180, n)))
+    numpy.savetxt(ofs, cols, fmt="%6d%6d%6d %10.3E %10.3E %8.1f%8.1f%9.1f %9.5f %4d %3d %7.2f")
+    ofs.write("!END_OF_DATA\n")
+    ofs.close()
+    return n
+# write_xds_ascii()
+
+def write_integrate_hkl(hklout, true_i, n_obs, nframes=100, seed=None):
+    random = numpy.random.RandomState(seed) if seed is not None else true_i.random
+    hkl, iobs, sigma = true_i.observations(n_obs, random=random)
+    cell = true_i.symm.unit_cell().parameters()
+    sgnum = true_i.symm.space_group_info().type().number()
+
+    ofs = open(hklout, "w")
+    ofs.write("""\
+!OUTPUT_FILE=INTEGRATE.HKL      DATE= 1-Jan-2015
+!Generated by yamtbx synthetic_data
+!SPACE_GROUP_NUMBER=%5d
+!UNIT_CELL_CONSTANTS=  %s
+!X-RAY_WAVELENGTH=  1.000000
+!DETECTOR_DISTANCE=   200.000
+!H,K,L,IOBS,SIGMA,XCAL,YCAL,ZCAL,RLP,PEAK,CORR,MAXC,
+!               XOBS,YOBS,ZOBS,ALF0,BET0,ALF1,BET1,PSI,ISEG
+!END_OF_HEADER
+""" % (sgnum, " ".join(map(lambda x: "%.3f"%x, cell))))
+
+    n = len(iobs)
+    xyz = numpy.column_stack((random.uniform(0, 2463, n), random.uniform(0, 2527, n), random.uniform(0, nframes, n)))
+    cols = numpy.column_stack((hkl, iobs, sigma, xyz, random.uniform(0.5, 2., n),
+                               random.randint(80, 101, n), random.randint(0, 101, n), random.randint(0, 1000, n),
+                               xyz + random.normal(size=(n,3)), random.uniform(-180, 180, (n,4)),
+                               random.uniform(-180, 180, n), numpy.ones(n)))
+    numpy.savetxt(ofs, cols, fmt="%5d%5d%5d %10.3E %10.3E %7.1f %7.1f %8.1f %8.5f %5d %3d %6d %7.1f %7.1f %8.1f %7.2f %7.2f %7.2f %7.2f %7.2f %3d")
+    ofs.write("!END_OF_DATA\n")
+    ofs.close()
+    return n
+# write_integrate_hkl()
+
+def write_eiger_h5(prefix, nframes, shape=(1065,1030), frames_per_file=100, seed=1234):
+    """
+    Write prefix_master.h5 and prefix_data_%.6d.h5 (bslz4 compressed uint16).
+    Returns master file name.
+    """
+    import h5py
+    from yamtbx.dataproc import eiger
+
+    random = numpy.random.RandomState(seed)
+    master = prefix + "_master.h5"
+    h5 = h5py.File(master, "w")
+    h5.create_group("/entry/data")
+    h5["/entry/data"].attrs["NX_class"] = "NXdata"
+
+    mask = numpy.zeros(shape, dtype=numpy.uint32)
+    mask[shape[0]//2-5:shape[0]//2+5,:] = 1 # module gap
+    mask[random.randint(0, shape[0], 10), random.randint(0, shape[1], 10)] = 2 # bad pixels
+    det = "/entry/instrument/detector"
+    h5.create_dataset(det+"/detectorSpecific/pixel_mask", data=mask, compression="gzip")
+    h5[det+"/description"] = "Dectris EIGER 1M"
+    h5[det+"/frame_time"] = 0.1
+    h5[det+"/count_time"] = 0.1
+    h5[det+"/x_pixel_size"] = 75.e-6
+    h5[det+"/y_pixel_size"] = 75.e-6
+    h5[det+"/beam_center_x"] = shape[1]/2.
+    h5[det+"/beam_center_y"] = shape[0]/2.
+    h5[det+"/detector_distance"] = 0.2
+    h5[det+"/detectorSpecific/nimages"] = nframes
+    h5[det+"/detectorSpecific/ntrigger"] = 1
+    h5["/entry/instrument/beam/incident_wavelength"] = 1.0
+
+    for i, start in enumerate(xrange(0, nframes, frames_per_file)):
+        n = min(frames_per_file, nframes - start)
+        data = random.poisson(2., size=(n,)+shape).astype(numpy.uint16)
+        data[:, mask==1] = 2**16-1
+        dataf = "%s_data_%.6d.h5" % (prefix, i+1)
+        eiger.create_data_file(dataf, data, (1,)+shape, start+1, start+n)
+        h5["/entry/data/data_%.6d"%(i+1)] = h5py.ExternalLink(os.path.basename(dataf), "/entry/data/data")
+
+    h5.close()
+    return master
+# write_eiger_h5()
+
+def write_crystfel_stream(strout, true_i, n_chunks, n_obs_per_chunk, seed=None):
+    random = numpy.random.RandomState(seed) if seed is not None else true_i.random
+    cell = true_i.symm.unit_cell().parameters()
+    ofs = open(strout, "w")
+    ofs.write("CrystFEL stream format 2.2\nGenerated by yamtbx synthetic_data\n")
+    for i in xrange(n_chunks):
+        hkl, iobs, sigma = true_i.observations(n_obs_per_chunk, scale=random.uniform(0.5, 2.), random=random)
+        ofs.write("""\
+----- Begin chunk -----
+Image filename: synthetic_%.6d.h5
+Image serial number: %d
+indexed_by = mosflm
+photon_energy_eV = 12398.000000
+beam_divergence = 4.00e-04 rad
+beam_bandwidth = 5.20e-03 (fraction)
+average_camera_length = 0.200000 m
+num_peaks = 0
+num_saturated_peaks = 0
+Peaks from peak search
+  fs/px   ss/px (1/d)/nm^-1   Intensity  Panel
+End of peak list
+--- Begin crystal
+Cell parameters %.5f %.5f %.5f nm, %.5f %.5f %.5f deg
+astar = +0.1666667 +0.0000000 +0.0000000 nm^-1
+bstar = +0.0000000 +0.1666667 +0.0000000 nm^-1
+cstar = +0.0000000 +0.0000000 +0.1111111 nm^-1
+lattice_type = tetragonal
+centering = P
+unique_axis = c
+profile_radius = 0.00300 nm^-1
+diffraction_resolution_limit = 5.00 nm^-1 or %.2f A
+num_reflections = %d
+num_saturated_reflections = 0
+num_implausible_reflections = 0
+Reflections measured after indexing
+   h    k    l          I   sigma(I)       peak background  fs/px  ss/px panel
+""" % (i+1, i+1, cell[0]/10., cell[1]/10., cell[2]/10., cell[3], cell[4], cell[5], true_i.d_min, len(iobs)))
+        n = len(iobs)
+        cols = numpy.column_stack((hkl, iobs, sigma, random.uniform(10, 100, n), random.uniform(0, 10, n),
+                                   random.uniform(0, 1030, n), random.uniform(0, 1065, n)))
+        numpy.savetxt(ofs, cols, fmt="%4d %4d %4d %10.2f %10.2f %10.2f %10.2f %6.1f %6.1f q0")
+        ofs.write("End of reflections\n--- End crystal\n----- End chunk -----\n")
+
+    ofs.close()
+    return n_chunks * n_obs_per_chunk
+# write_crystfel_stream()
@@ -6,11 +6,68 @@ This software is released under the new BSD License; see LICENSE.
 """
 import os
 import collections
+import numpy
 from yamtbx.dataproc.xds import get_xdsinp_keyword
 from yamtbx.dataproc.xds import xds_ascii
 from cctbx.array_family import flex
+from yamtbx.util.maths import pack_hkl, grouped_linear_correlation
 from libtbx import easy_mp
 
+def calc_cc_by_frame(xac, merged_iobs):
+    """
+    CC between merged_iobs and intensities merged within each frame, for all frames at once.
+    Equivalent to merge_equivalents(use_internal_variance=False) and common_sets() for each frame,
+    but observations are grouped by (frame, hkl) with a single sort.
+    Observations with sigma <= 0 are not used.
+    Returns [[frame, n_all, n_common, cc], ...] for frames from min(iframe) to max(iframe).
+    """
+    iframe = numpy.array(xac.iframe, dtype=numpy.int64)
+    if len(iframe) == 0: return []
+    fmin, fmax = iframe.min(), iframe.max()
+    nframes = int(fmax - fmin + 1)
+
+    iobs = xac.i_obs(anomalous_flag=merged_iobs.anomalous_flag()).map_to_asu()
+    keys = pack_hkl(iobs.indices())
+    data = iobs.data().as_numpy_array()
+    sigmas = iobs.sigmas().as_numpy_array()
+    frames = iframe - fmin
+
+    sel = sigmas > 0
+    keys, data, sigmas, frames = keys[sel], data[sel], sigmas[sel], frames[sel]
+
+    # Weighted mean in each (frame, hkl) group
+    perm = numpy.lexsort((keys, frames))
+    keys, data, sigmas, frames = keys[perm], data[perm], sigmas[perm], frames[perm]
+    first = numpy.ones(len(keys), dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]) | (frames[1:] != frames[:-1])
+    starts = numpy.where(first)[0]
+    w = 1./sigmas**2
+    if len(starts) > 0:
+        g_data = numpy.add.reduceat(w*data, starts) / numpy.add.reduceat(w, starts)
+    else:
+        g_data = numpy.zeros(0)
+    g_keys, g_frames = keys[starts], frames[starts]
+
+    n_all = numpy.bincount(g_frames, minlength=nframes)
+
+    # Find the merged intensities of the same hkl
+    merged = merged_iobs.map_to_asu()
+    m_keys = pack_hkl(merged.indices())
+    m_perm = numpy.argsort(m_keys)
+    m_keys, m_data = m_keys[m_perm], merged.data().as_numpy_array()[m_perm]
+    if len(m_keys) > 0:
+        pos = numpy.searchsorted(m_keys, g_keys)
+        pos[pos >= len(m_keys)] = 0
+        common = m_keys[pos] == g_keys
+    else:
+        pos = numpy.zeros(len(g_keys), dtype=numpy.int64)
+        common = numpy.zeros(len(g_keys), dtype=bool)
+
+    n_common, cc = grouped_linear_correlation(g_frames[common], m_data[pos[common]], g_data[common], nframes)
+
+    return map(lambda i: [int(fmin+i), int(n_all[i]), int(n_common[i]), float(cc[i])], xrange(nframes))
+# calc_cc_by_frame()
+
 def eval_cc(f, merged_iobs):
     print "reading",f
 
@@ -26,21 +83,7 @@ def eval_cc(f, merged_iobs):
     cc = corr.coefficient() if corr.is_well_defined() else float("nan")
 
     ret1 = (n_all, n_common, cc)
-    ret2 = []
-
-    for frame in xrange(min(xac.iframe), max(xac.iframe)+1):
-        sel = xac.iframe == frame
-        iobs = xac.i_obs(anomalous_flag=merged_iobs.anomalous_flag()).select(sel)
-        iobs = iobs.merge_equivalents(use_internal_variance=False).array()
-        n_all = iobs.size()
-
-        m, i = merged_iobs.common_sets(iobs, assert_is_similar_symmetry=False)
-        n_common = m.size()
-
-        corr = flex.linear_correlation(m.data(), i.data())
-        cc = corr.coefficient() if corr.is_well_defined() else float("nan")
-
-        ret2.append([frame, n_all, n_common, cc])
+    ret2 = calc_cc_by_frame(xac, merged_iobs)
     return ret1, ret2
 # eval_cc()
 
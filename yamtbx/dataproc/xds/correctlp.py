@@ -7,6 +7,7 @@ This software is released under the new BSD License; see LICENSE.
 from cctbx import sgtbx
 from cctbx import uctbx
 from yamtbx.util import safe_float
+from yamtbx.util import parsecache
 
 def get_ISa(lp, check_valid=False):
     read_flag = False
@@ -196,6 +197,11 @@ class CorrectLp:
         return not (a == "4.000E+00" and b == "1.000E-04") # in this case error model adjustment is failed.
     # is_ISa_valid()
 
+def parse_cached(lpin):
+    # Returns CorrectLp object. Parsed result is kept on disk and reused unless the file is modified.
+    return parsecache.load_parsed(lpin, CorrectLp, tag="correctlp1")
+# parse_cached()
+
 if __name__ == "__main__":
     import sys
     lp = CorrectLp(sys.argv[1])
@@ -0,0 +1,106 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Columnar reading of XDS reflection files (INTEGRATE.HKL, XDS_ASCII.HKL).
+
+read_header() reads only the header part and returns the byte offset of the
+first data record. read_columns() then parses the data part in large chunks
+with numpy (no python loop over lines) and keeps only the requested columns,
+so that memory is not wasted for unused columns. By default the file is
+memory-mapped and chunks are taken from the mapping directly.
+"""
+
+import re
+import mmap
+import numpy
+from cctbx.array_family import flex
+
+def read_header(filein):
+    """
+    Returns (list of header lines, byte offset of the first data line).
+    offset is None if !END_OF_HEADER was not found.
+    """
+    headers = []
+    ifs = open(filein, "rb")
+    while True:
+        line = ifs.readline()
+        if line == "": return headers, None
+        if line.startswith("!END_OF_HEADER"): return headers, ifs.tell()
+        headers.append(line)
+# read_header()
+
+def integrate_hkl_column_names(headers):
+    """
+    Column names in INTEGRATE.HKL header, e.g.
+    !H,K,L,IOBS,SIGMA,XCAL,YCAL,ZCAL,RLP,PEAK,CORR,MAXC,
+    !               XOBS,YOBS,ZOBS,ALF0,BET0,ALF1,BET1,PSI,ISEG
+    """
+    re_column_info = re.compile("[A-Z],[A-Z]")
+    column_names = []
+    for l in headers:
+        if not re_column_info.search(l): continue
+        column_names.extend(filter(lambda x: x != "", map(lambda x: x.strip(), l[1:].strip().split(","))))
+    return column_names
+# integrate_hkl_column_names()
+
+def read_columns(filein, offset, ncols, usecols, chunk_bytes=64*1024**2, use_mmap=True):
+    """
+    Parse data records starting at byte offset until !END_OF_DATA (or end of file).
+    offset: as returned by read_header(). If None (no !END_OF_HEADER), no records are read.
+    ncols: number of items in each record
+    usecols: column indices (0-based) to return
+    Returns list of numpy float64 arrays, in the order of usecols.
+    """
+    usecols = list(usecols)
+    if offset is None: return map(lambda i: numpy.zeros(0, dtype=numpy.float64), usecols)
+
+    chunks = []
+    ifs = open(filein, "rb")
+
+    if use_mmap:
+        try:
+            buf = mmap.mmap(ifs.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError): # e.g. empty file
+            buf = ifs.read()
+    else:
+        buf = ifs.read()
+
+    end = buf.find("!END_OF_DATA", offset)
+    if end < 0: end = len(buf)
+
+    start = offset
+    while start < end:
+        stop = buf.find("\n", min(start + chunk_bytes, end - 1))
+        stop = end if stop < 0 or stop >= end else stop + 1
+        vals = numpy.fromstring(buf[start:stop], dtype=numpy.float64, sep=" ")
+        if vals.size % ncols != 0:
+            raise RuntimeError("Unexpected number of items in data records of %s" % filein)
+
+        vals = vals.reshape(-1, ncols)
+        chunks.append(map(lambda i: vals[:,i].copy(), usecols))
+        start = stop
+
+    if isinstance(buf, mmap.mmap): buf.close()
+    ifs.close()
+
+    if not chunks: return map(lambda i: numpy.zeros(0, dtype=numpy.float64), usecols)
+    return map(lambda i: numpy.concatenate(map(lambda x: x[i], chunks)), xrange(len(usecols)))
+# read_columns()
+
+def as_miller_index(h, k, l):
+    """
+    Make flex.miller_index from numpy arrays of h, k, l.
+    """
+    hkl = flex.vec3_double(flex.double(numpy.ascontiguousarray(h, dtype=numpy.float64)),
+                           flex.double(numpy.ascontiguousarray(k, dtype=numpy.float64)),
+                           flex.double(numpy.ascontiguousarray(l, dtype=numpy.float64)))
+    return flex.miller_index(hkl.iround())
+# as_miller_index()
+
+def as_flex_double(a):
+    return flex.double(numpy.ascontiguousarray(a, dtype=numpy.float64))
+# as_flex_double()
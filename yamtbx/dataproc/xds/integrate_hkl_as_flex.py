@@ -4,12 +4,13 @@ Author: Keitaro Yamashita
 
 This software is released under the new BSD License; see LICENSE.
 """
-import re
 import os
+import numpy
 from cctbx.array_family import flex
 from cctbx import uctbx
 from cctbx import crystal
 from cctbx import miller
+from yamtbx.dataproc.xds import hkl_columns
 
 def is_integrate_hkl(filein):
     if not os.path.isfile(filein): return False
@@ -19,19 +20,17 @@ def is_integrate_hkl(filein):
 # is_xds_ascii()
 
 class reader:
-    def __init__(self, filein, read_columns, read_data=True):
+    def __init__(self, filein, read_columns, read_data=True, as_numpy=False, use_mmap=True):
+        """
+        Only read_columns (and H,K,L) are parsed from data records.
+        If as_numpy, self.hkl is numpy array of shape (n,3) and self.data values are numpy arrays;
+        otherwise flex.miller_index and flex.double.
+        """
         assert len(set(["H","K","L"]).intersection(set(read_columns))) == 0
 
-        read_data_flag = False
-        re_column_info = re.compile("[A-Z],[A-Z]")
-        column_names = []
-        read_indices = []
-
-        self.hkl = flex.miller_index()
-        self.data = {}
-        
-        for l in open(filein):
+        headers, offset = hkl_columns.read_header(filein)
 
+        for l in headers:
             if l.startswith("!UNIT_CELL_CONSTANTS="):
                 cell = map(lambda x:float(x), l[len("!UNIT_CELL_CONSTANTS="):].strip().split())
                 self.unit_cell = uctbx.unit_cell(cell)
@@ -49,42 +48,39 @@ class reader:
             elif l.startswith("!UNIT_CELL_C-AXIS="):
                 self.c_axis = map(float, l[len("!UNIT_CELL_C-AXIS="):].strip().split())
 
+        column_names = hkl_columns.integrate_hkl_column_names(headers)
 
-            if re_column_info.search(l):
-                l = l[1:].strip() # remove !
-                column_names.extend(filter(lambda x:x!="", l.split(",")))
-
-            if l.startswith("!END_OF_HEADER"):
-                if not read_data:
-                    break
-
-                assert set(read_columns).issubset(set(column_names))
-
-                read_data_flag = True
-                read_indices = [i for i, c in enumerate(column_names) if c in read_columns]
-                # Set up data structure
-                for i in read_indices:
-                    self.data[column_names[i]] = flex.double()
-                continue
-
-            if read_data_flag:
-                if l.startswith("!END_OF_DATA"):
-                    break
-
-                sp = l.split()
-                self.hkl.append(map(lambda x:int(x), sp[:3]))
-                for i in xrange(3, len(sp)):
-                    if i in read_indices:
-                        self.data[column_names[i]].append(float(sp[i]))
+        self.hkl = numpy.zeros((0,3), dtype=numpy.int32) if as_numpy else flex.miller_index()
+        self.data = {}
 
+        if read_data and offset is not None:
+            assert set(read_columns).issubset(set(column_names))
 
-        #print column_names, read_indices
-        #print self.data
+            read_indices = [i for i, c in enumerate(column_names) if c in read_columns]
+            cols = hkl_columns.read_columns(filein, offset, len(column_names), [0,1,2]+read_indices,
+                                            use_mmap=use_mmap)
+            if as_numpy:
+                self.hkl = numpy.column_stack(cols[:3]).astype(numpy.int32)
+                for i, col in zip(read_indices, cols[3:]): self.data[column_names[i]] = col
+            else:
+                self.hkl = hkl_columns.as_miller_index(*cols[:3])
+                for i, col in zip(read_indices, cols[3:]): self.data[column_names[i]] = hkl_columns.as_flex_double(col)
 
         self.column_names = column_names
         self._filein = filein
+        self._as_numpy = as_numpy
     # __init__ ()
 
+    def _flex_hkl(self):
+        if not self._as_numpy: return self.hkl
+        return hkl_columns.as_miller_index(self.hkl[:,0], self.hkl[:,1], self.hkl[:,2])
+    # _flex_hkl()
+
+    def _flex_data(self, key):
+        if not self._as_numpy: return self.data[key]
+        return hkl_columns.as_flex_double(self.data[key])
+    # _flex_data()
+
     def get_column_names(self): return self.column_names
 
     def crystal_symmetry(self):
@@ -93,12 +89,13 @@ class reader:
 
     def arrays(self):
         ret = {}
+        indices = self._flex_hkl()
 
         for key in self.data:
             arr = miller.array(miller_set=miller.set(crystal_symmetry=self.crystal_symmetry(),
-                                                     indices=self.hkl,
+                                                     indices=indices,
                                                      anomalous_flag=False),
-                               data=self.data[key])
+                               data=self._flex_data(key))
             ret[key] = arr
 
         return ret
@@ -110,10 +107,10 @@ class reader:
 
         array_info = miller.array_info(source_type="xds_integrate")#, wavelength=)
         return miller.array(miller_set=miller.set(crystal_symmetry=self.crystal_symmetry(),
-                                                  indices=self.hkl,
+                                                  indices=self._flex_hkl(),
                                                   anomalous_flag=anomalous_flag),
-                            data=self.data["IOBS"],
-                            sigmas=self.data["SIGMA"]).set_info(array_info).set_observation_type_xray_intensity()
+                            data=self._flex_data("IOBS"),
+                            sigmas=self._flex_data("SIGMA")).set_info(array_info).set_observation_type_xray_intensity()
     # i_obs()
 
     def write_peak_corrected(self, hklout):
@@ -13,6 +13,7 @@ from cctbx import uctbx
 from cctbx.array_family import flex
 from libtbx.utils import null_out
 from yamtbx.dataproc.xds import re_xds_kwd
+from yamtbx.dataproc.xds import hkl_columns
 
 def is_xds_ascii(filein):
     if not os.path.isfile(filein): return False
@@ -43,22 +44,11 @@ class XDS_ASCII:
 
         colindex = {} # {"H":1, "K":2, "L":3, ...}
         nitemfound = 0
-        flag_data_start = False
-        num_hkl = 0
 
         headers = []
+        header_lines, self._data_offset = hkl_columns.read_header(self._filein)
 
-        for line in open(self._filein):
-            if flag_data_start:
-                if line.startswith("!END_OF_DATA"):
-                    break
-                num_hkl += 1
-                continue
-
-            if line.startswith('!END_OF_HEADER'):
-                flag_data_start = True
-                continue
-
+        for line in header_lines:
             if line.startswith("!Generated by dials"):
                 self.by_dials = True
                 continue
@@ -128,7 +118,7 @@ class XDS_ASCII:
         assert nitem == len(colindex)
 
         self._colindex = colindex
-        self._num_hkl = num_hkl
+        self._nitem = nitem
         self.symm = crystal.symmetry(unit_cell=(a, b, c, al, be, ga),
                                      space_group=ispgrp)
 
@@ -140,49 +130,33 @@ class XDS_ASCII:
     def read_data(self):
         colindex = self._colindex
         is_xscale = "RLP" not in colindex
-        flag_data_start = False
-
-        col_H, col_K, col_L = colindex["H"], colindex["K"], colindex["L"]
-        col_i, col_sig, col_xd, col_yd, col_zd = colindex["IOBS"], colindex["SIGMA(IOBS)"], colindex["XD"], colindex["YD"], colindex["ZD"]
-        col_rlp, col_peak, col_corr, col_iset = colindex.get("RLP", None), colindex.get("PEAK", None), colindex.get("CORR", None), colindex.get("ISET", None)
-        self.indices = []
-        self.xd, self.yd, self.zd = [], [], []
-        self.iframe, self.rlp, self.peak, self.corr, self.iset = [], [], [], [], []
-        for line in open(self._filein):
-            if flag_data_start:
-                if line.startswith("!END_OF_DATA"):
-                    break
 
-                sp = line.split()
-                h, k, l = int(sp[col_H]), int(sp[col_K]), int(sp[col_L])
-                self.indices.append([h,k,l])
-
-                self.iobs.append(float(sp[col_i]))
-                self.sigma_iobs.append(float(sp[col_sig]))
-                if not self.i_only:
-                    self.xd.append(float(sp[col_xd]))
-                    self.yd.append(float(sp[col_yd]))
-                    self.zd.append(float(sp[col_zd]))
-                    self.iframe.append(int(self.zd[-1])+1)
-                    if not is_xscale:
-                        self.rlp.append(float(sp[col_rlp]))
-                        self.peak.append(float(sp[col_peak]))
-                        self.corr.append(float(sp[col_corr]))
-                    else:
-                        self.iset.append(int(sp[col_iset]))
-                    #res = symm.unit_cell().d((h,k,l))
-
-                    if self.iframe[-1] < 0:
-                        self.iframe[-1] = 0
-                        print >>self._log, 'reflection with surprisingly low z-value:', self.zd[-1]
-
-            if line.startswith('!END_OF_HEADER'):
-                flag_data_start = True
-
-        self.indices = flex.miller_index(self.indices)
-        self.iobs, self.sigma_iobs, self.xd, self.yd, self.zd, self.rlp, self.peak, self.corr = [flex.double(x) for x in (self.iobs, self.sigma_iobs, self.xd, self.yd, self.zd, self.rlp, self.peak, self.corr)]
-        self.iframe = flex.int(self.iframe)
-        self.iset = flex.int(self.iset) # only for XSCALE
+        names = ["H", "K", "L", "IOBS", "SIGMA(IOBS)"]
+        if not self.i_only:
+            names += ["XD", "YD", "ZD"]
+            names += ["ISET"] if is_xscale else ["RLP", "PEAK", "CORR"]
+
+        cols = dict(zip(names, hkl_columns.read_columns(self._filein, self._data_offset, self._nitem,
+                                                        map(lambda x: colindex[x], names))))
+
+        self.indices = hkl_columns.as_miller_index(cols["H"], cols["K"], cols["L"])
+        self.iobs = hkl_columns.as_flex_double(cols["IOBS"])
+        self.sigma_iobs = hkl_columns.as_flex_double(cols["SIGMA(IOBS)"])
+        self.xd, self.yd, self.zd, self.rlp, self.peak, self.corr = [flex.double() for i in xrange(6)]
+        self.iframe, self.iset = flex.int(), flex.int() # iset only for XSCALE
+
+        if not self.i_only:
+            self.xd, self.yd, self.zd = map(lambda x: hkl_columns.as_flex_double(cols[x]), ("XD", "YD", "ZD"))
+            iframe = numpy.trunc(cols["ZD"]).astype(numpy.int32) + 1
+            for zd in cols["ZD"][iframe < 0]:
+                print >>self._log, 'reflection with surprisingly low z-value:', zd
+            iframe[iframe < 0] = 0
+            self.iframe = flex.int(iframe)
+
+            if not is_xscale:
+                self.rlp, self.peak, self.corr = map(lambda x: hkl_columns.as_flex_double(cols[x]), ("RLP", "PEAK", "CORR"))
+            else:
+                self.iset = flex.int(cols["ISET"].astype(numpy.int32))
 
         print >>self._log, "Reading data done.\n"
 
@@ -191,21 +165,9 @@ class XDS_ASCII:
     def get_frame_range(self): 
         """quick function only to get frame number range"""
 
-        flag_data_start = False
-        col_zd = self._colindex["ZD"]
-        min_frame, max_frame = 0, 0
-        for line in open(self._filein):
-            if flag_data_start:
-                if line.startswith("!END_OF_DATA"):
-                    break
-
-                sp = line.split()
-                iframe = int(float(sp[col_zd]))+1
-                if iframe > 0 and iframe < min_frame: min_frame = iframe 
-                if iframe > max_frame: max_frame = iframe
-
-            if line.startswith('!END_OF_HEADER'):
-                flag_data_start = True
+        zd, = hkl_columns.read_columns(self._filein, self._data_offset, self._nitem, [self._colindex["ZD"]])
+        iframe = numpy.trunc(zd).astype(numpy.int32) + 1
+        min_frame, max_frame = 0, (max(0, int(iframe.max())) if len(iframe) > 0 else 0)
 
         return min_frame, max_frame
     # get_frame_range()
@@ -240,76 +202,112 @@ class XDS_ASCII:
         self.remove_selection(sel)
     # remove_rejected()
 
-    def write_selected(self, sel, hklout):
+    def _write_filtered(self, hklout, data_filter, header_filter=None, chunk_size=10000):
+        """
+        Stream self._filein to hklout. Header lines are written as they are (or header_filter(line) if given),
+        and data lines are given to data_filter() every chunk_size lines, which returns lines to be written.
+        Only header is needed; works with read_data=False.
+        Returns number of data lines written.
+        """
         ofs = open(hklout, "w")
 
         data_flag = False
         count = 0
+        chunk = []
+        end_line = None
         for line in open(self._filein):
-            if line.startswith('!END_OF_HEADER'):
-                ofs.write(line)
-                data_flag = True
-            elif line.startswith("!END_OF_DATA"):
-                ofs.write(line)
-                break
-            elif not data_flag:
-                ofs.write(line)
-            elif data_flag:
-                if sel[count]: ofs.write(line)
-                count += 1
+            if data_flag:
+                if line.startswith("!END_OF_DATA"):
+                    end_line = line
+                    break
+                chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    lines = data_filter(chunk)
+                    ofs.writelines(lines)
+                    count += len(lines)
+                    chunk = []
+            else:
+                if line.startswith('!END_OF_HEADER'): data_flag = True
+                ofs.write(header_filter(line) if header_filter else line)
+
+        lines = data_filter(chunk)
+        ofs.writelines(lines)
+        count += len(lines)
+        if end_line is not None: ofs.write(end_line)
+        ofs.close()
+        return count
+    # _write_filtered()
+
+    def write_selected(self, sel, hklout):
+        """
+        sel: selection for all data lines (including rejected ones)
+        """
+        counter = [0]
+        def data_filter(lines):
+            s = counter[0]
+            counter[0] += len(lines)
+            return [l for i, l in enumerate(lines) if sel[s+i]]
+
+        self._write_filtered(hklout, data_filter)
     # write_selected()
 
+    def write_selected_frames(self, frames, hklout):
+        """
+        Write reflections recorded on the specified frames only (frame number defined as in read_data()).
+        Returns number of reflections written.
+        """
+        col_zd = self._colindex["ZD"]
+        frames = set(frames)
+        def data_filter(lines):
+            return [l for l in lines if max(0, int(float(l.split()[col_zd]))+1) in frames]
+
+        return self._write_filtered(hklout, data_filter)
+    # write_selected_frames()
+
     def write_reindexed(self, op, hklout, space_group=None):
         """
         XXX Assuming hkl has 6*3 width!!
         """
-        ofs = open(hklout, "w")
         col_H, col_K, col_L = map(lambda x:self._colindex[x], "HKL")
         assert col_H==0 and col_K==1 and col_L==2
 
         tr_mat = numpy.array(op.c_inv().r().as_double()).reshape(3,3).transpose()
         transformed = numpy.dot(tr_mat, numpy.array([self.a_axis, self.b_axis, self.c_axis]))
-        
-        data_flag = False
+        cell_tr = [None]
 
-        for line in open(self._filein):
+        def header_filter(line):
             if line.startswith('!UNIT_CELL_CONSTANTS='):
                 # XXX split by fixed columns
                 cell = uctbx.unit_cell(line[line.index("=")+1:].strip())
-                cell_tr = cell.change_basis(op)
-                if space_group is not None: cell_tr = space_group.average_unit_cell(cell_tr)
-                ofs.write("!UNIT_CELL_CONSTANTS=%10.3f%10.3f%10.3f%8.3f%8.3f%8.3f\n" % cell_tr.parameters())
+                cell_tr[0] = cell.change_basis(op)
+                if space_group is not None: cell_tr[0] = space_group.average_unit_cell(cell_tr[0])
+                return "!UNIT_CELL_CONSTANTS=%10.3f%10.3f%10.3f%8.3f%8.3f%8.3f\n" % cell_tr[0].parameters()
             elif line.startswith('!SPACE_GROUP_NUMBER=') and space_group is not None:
-                ofs.write("!SPACE_GROUP_NUMBER=%5d \n" % space_group.type().number())
+                return "!SPACE_GROUP_NUMBER=%5d \n" % space_group.type().number()
             elif line.startswith("!UNIT_CELL_A-AXIS="):
-                ofs.write("!UNIT_CELL_A-AXIS=%10.3f%10.3f%10.3f\n" % tuple(transformed[0,:]))
+                return "!UNIT_CELL_A-AXIS=%10.3f%10.3f%10.3f\n" % tuple(transformed[0,:])
             elif line.startswith("!UNIT_CELL_B-AXIS="):
-                ofs.write("!UNIT_CELL_B-AXIS=%10.3f%10.3f%10.3f\n" % tuple(transformed[1,:]))
+                return "!UNIT_CELL_B-AXIS=%10.3f%10.3f%10.3f\n" % tuple(transformed[1,:])
             elif line.startswith("!UNIT_CELL_C-AXIS="):
-                ofs.write("!UNIT_CELL_C-AXIS=%10.3f%10.3f%10.3f\n" % tuple(transformed[2,:]))
-            elif line.startswith('!END_OF_HEADER'):
-                ofs.write(line)
-                data_flag = True
-            elif line.startswith("!END_OF_DATA"):
-                ofs.write(line)
-                break
-            elif not data_flag:
-                ofs.write(line)
-            elif data_flag:
-                if not self.by_dials:
-                    hkl = tuple(map(int, line[:18].split()))
-                    hkl = op.apply(hkl)
-                    ofs.write("%6d%6d%6d"%hkl)
-                    ofs.write(line[18:])
-                else:
-                    sp = line.split()
-                    hkl = op.apply(tuple(map(int, sp[:3])))
-                    ofs.write(" ".join(map(str, hkl)))
-                    ofs.write(" ")
-                    ofs.write(" ".join(sp[3:]))
-                    ofs.write("\n")
-        return cell_tr
-    # write_selected()
+                return "!UNIT_CELL_C-AXIS=%10.3f%10.3f%10.3f\n" % tuple(transformed[2,:])
+            return line
+
+        def data_filter(lines):
+            if not lines: return []
+            sps = map(lambda l: l.split(), lines) if self.by_dials else None
+            if self.by_dials: indices = flex.miller_index(map(lambda sp: tuple(map(int, sp[:3])), sps))
+            else: indices = flex.miller_index(map(lambda l: tuple(map(int, l[:18].split())), lines))
+
+            indices = op.apply(indices)
+
+            if not self.by_dials:
+                return map(lambda x: "%6d%6d%6d"%x[0] + x[1][18:], zip(indices, lines))
+            else:
+                return map(lambda x: " ".join(map(str, x[0])) + " " + " ".join(x[1][3:]) + "\n", zip(indices, sps))
+
+        self._write_filtered(hklout, data_filter, header_filter)
+        return cell_tr[0]
+    # write_reindexed()
 
 #class XDS_ASCII
 
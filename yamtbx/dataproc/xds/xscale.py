@@ -7,7 +7,10 @@ This software is released under the new BSD License; see LICENSE.
 import os
 import shutil
 import glob
+import time
+import threading
 import traceback
+import collections
 
 from yamtbx.dataproc.xds import xscalelp
 from yamtbx.dataproc.xds.command_line import xds_aniso_analysis
@@ -38,13 +41,45 @@ def run_xscale(d_min=None, d_max=100, nbins=9, anomalous_flag=None, min_ios=None
         inp_out.write("SPACE_GROUP_NUMBER= %s\nUNIT_CELL_CONSTANTS= %s\n\n" % (sg, cell))
     """
 
-def run_xscale(xscale_inp, cbf_to_dat=False, aniso_analysis=False, use_tmpdir_if_available=False):
+def _xscale_postprocess(wdir, outfile, cbf_to_dat, aniso_analysis):
+    if cbf_to_dat:
+        xscale_lp = os.path.join(wdir, "XSCALE.LP")
+        cbfouts = glob.glob(os.path.join(wdir, "*.cbf"))
+        if len(cbfouts) > 0:
+            xscalelp.cbf_to_dat(xscale_lp)
+            for f in cbfouts: os.remove(f)
+
+    if aniso_analysis:
+        aniso_out = open(os.path.join(wdir, "aniso.log"), "w")
+        try:
+            xds_aniso_analysis.run(os.path.join(wdir, outfile),
+                                   cone_angle=20., n_bins=10,
+                                   log_out=aniso_out)
+        except:
+            aniso_out.write(traceback.format_exc())
+
+        aniso_out.close()
+# _xscale_postprocess()
+
+def run_xscale(xscale_inp, cbf_to_dat=False, aniso_analysis=False, use_tmpdir_if_available=False,
+               copy_back=None, postprocess_in_background=False):
+    """
+    Input files are staged as symlinks (in a local temp directory if use_tmpdir_if_available).
+    copy_back: when temp directory is used, only files matching these glob patterns (relative to the directory)
+               are moved back. All files if None. The OUTPUT_FILE is included if "OUTPUT_FILE" is given in the list.
+    postprocess_in_background: cbf_to_dat and aniso_analysis are done in a thread, which is returned (started).
+                               Caller should join() it before using the results or reusing the directory.
+    Time for each step is printed and appended to xscale_timing.log.
+    Returns the post-processing thread if in background, otherwise None.
+    """
     ftable = {}
     outfile = None
     count = 0
     inpdir = os.path.dirname(os.path.abspath(xscale_inp))
     wdir = inpdir # may be overridden
     tmpdir = None
+    timings = collections.OrderedDict()
+    t0 = time.time()
 
     if use_tmpdir_if_available:
         tmpdir = util.get_temp_local_dir("xscale", min_gb=1) # TODO guess required tempdir size
@@ -85,9 +120,15 @@ def run_xscale(xscale_inp, cbf_to_dat=False, aniso_analysis=False, use_tmpdir_if
     if len(ftable) == 0:
         os.rename(xscale_inp+".org", xscale_inp)
 
+    timings["staging"] = time.time() - t0
+    t0 = time.time()
+
     # Run xscale
     util.call(xscale_comm, wdir=wdir)
 
+    timings["xscale"] = time.time() - t0
+    t0 = time.time()
+
     # Replace file names if needed
     if len(ftable) > 0:
         for i, f in enumerate(("XSCALE.LP", outfile)):
@@ -120,30 +161,44 @@ def run_xscale(xscale_inp, cbf_to_dat=False, aniso_analysis=False, use_tmpdir_if
 
         os.rename(xscale_inp+".org", xscale_inp)
 
-    if cbf_to_dat:
-        xscale_lp = os.path.join(wdir, "XSCALE.LP")
-        cbfouts = glob.glob(os.path.join(wdir, "*.cbf"))
-        if len(cbfouts) > 0:
-            xscalelp.cbf_to_dat(xscale_lp)
-            for f in cbfouts: os.remove(f)
-
-    if aniso_analysis:
-        aniso_out = open(os.path.join(wdir, "aniso.log"), "w")
-        try:
-            xds_aniso_analysis.run(os.path.join(wdir, outfile),
-                                   cone_angle=20., n_bins=10,
-                                   log_out=aniso_out)
-        except:
-            aniso_out.write(traceback.format_exc())
-
-        aniso_out.close()
+    timings["rename"] = time.time() - t0
+    t0 = time.time()
 
-    # Move to original directory
+    # Move to original directory. Post-processing is done there.
     if tmpdir is not None:
-        for f in glob.glob(os.path.join(tmpdir, "*")):
-            shutil.copy2(f, inpdir)
+        if copy_back is None:
+            files = glob.glob(os.path.join(tmpdir, "*"))
+        else:
+            patterns = map(lambda x: outfile if x == "OUTPUT_FILE" else x, copy_back)
+            if cbf_to_dat: patterns.append("*.cbf")
+            files = set(reduce(lambda x, y: x+y, map(lambda x: glob.glob(os.path.join(tmpdir, x)), patterns), []))
+
+        for f in files:
+            shutil.move(f, os.path.join(inpdir, os.path.basename(f)))
 
         shutil.rmtree(tmpdir)
+        timings["copy_back"] = time.time() - t0
+
+    def postprocess():
+        t0 = time.time()
+        try:
+            _xscale_postprocess(inpdir, outfile, cbf_to_dat, aniso_analysis)
+        except:
+            # Not to die silently in background thread
+            print "xscale: post-processing failed in %s" % inpdir
+            print traceback.format_exc()
+        timings["postprocess"] = time.time() - t0
+        timing_str = ", ".join(map(lambda x: "%s= %.2f" % x, timings.items()))
+        print "xscale: timings (sec) in %s: %s" % (inpdir, timing_str)
+        open(os.path.join(inpdir, "xscale_timing.log"), "a").write("%s\n" % timing_str)
+    # postprocess()
+
+    if postprocess_in_background:
+        th = threading.Thread(target=postprocess)
+        th.start()
+        return th
+
+    postprocess()
 # run_xscale()
 
 def _calc_cchalf_by_removing_worker_1(wdir, inp_head, inpfiles, iex, nproc=None):
@@ -192,7 +247,8 @@ def _calc_cchalf_by_removing_worker_2(wdir, tmpdir, iex, stat_bin):
     return iex, cchalf_exi, nuniq
 # _calc_cchalf_by_removing_worker_2()
 
-def calc_cchalf_by_removing(wdir, inp_head, inpfiles, with_sigma=False, stat_bin="total", nproc=1, nproc_each=None, batchjobs=None):
+def calc_cchalf_by_removing(wdir, inp_head, inpfiles, with_sigma=False, stat_bin="total", nproc=1, nproc_each=None, batchjobs=None,
+                            use_tmpdir_if_available=False):
     assert not with_sigma # Not supported now
     assert stat_bin in ("total", "outer")
 
@@ -217,7 +273,9 @@ def calc_cchalf_by_removing(wdir, inp_head, inpfiles, with_sigma=False, stat_bin
 
         batchjobs.wait_all(jobs)
     else:
-        easy_mp.pool_map(fixed_func=lambda x: util.call(xscale_comm, wdir=x),
+        # Only .INP and .LP are needed. Output reflection files are left (and discarded) in local temp dir if used.
+        easy_mp.pool_map(fixed_func=lambda x: run_xscale(os.path.join(x, "XSCALE.INP"), use_tmpdir_if_available=use_tmpdir_if_available,
+                                                         copy_back=("XSCALE.INP", "XSCALE.LP")),
                          args=tmpdirs,
                          processes=nproc)
     # Finish runs
@@ -312,7 +370,7 @@ def decide_scaling_reference_based_on_bfactor(lpin, ref, return_as="index"):
     assert ref in ("bmed", "bmin", "bmax")
     assert return_as in ("index", "filename")
 
-    KBs = map(lambda x: [x[0]]+x[1], enumerate(xscalelp.get_k_b(lpin))) # list of [i, K, B, filename]
+    KBs = map(lambda x: [x[0]]+x[1], enumerate(xscalelp.parse_cached(lpin).k_b)) # list of [i, K, B, filename]
     KBs.sort(key=lambda x: x[2])
 
     if len(KBs) == 0:
@@ -10,13 +10,20 @@ import collections
 from yamtbx.dataproc.xds import correctlp
 from yamtbx.dataproc import xds
 from yamtbx.dataproc import cbf
+from yamtbx.util import parsecache
 
 re_data_info = re.compile("([0-9]+) *([-\.0-9E\+]+) * ([0-9]+) *([0-9]+) * ([^ ]*)")
 
+def _lines(lpin):
+    # lpin can be file name or list of lines already read
+    if isinstance(lpin, list): return lpin
+    return open(lpin)
+# _lines()
+
 def get_pairwise_correlations(lpin):
     read_flag = False
     ret = []
-    for l in open(lpin):
+    for l in _lines(lpin):
         if "  #i   #j     REFLECTIONS     BETWEEN" in l:
             read_flag = True
         elif read_flag and l.strip() != "":
@@ -44,7 +51,7 @@ def construct_data_graph(lpin, min_common_refs=10):
 
 def read_no_common_ref_datasets(lpin):
     ret = []
-    for l in open(lpin):
+    for l in _lines(lpin):
         if "no common reflections with data set" in l:
             idx = int(l.split()[-1])
             ret.append(idx-1)
@@ -60,7 +67,7 @@ def get_read_data(lpin):
 
     read_flag = False
     ret = []
-    for l in open(lpin):
+    for l in _lines(lpin):
         if l.startswith(" SET# INTENSITY  ACCEPTED REJECTED"):
             read_flag = True
         elif read_flag:
@@ -81,7 +88,7 @@ def get_k_b(lpin):
 
     read_flag = False
     ret = [] # list of [K, B, filename]
-    for l in open(lpin):
+    for l in _lines(lpin):
         if "K        B           DATA SET NAME" in l:
             read_flag = True
         elif read_flag:
@@ -100,7 +107,7 @@ def get_ISa(lpin):
 
     read_flag = False
     ret = [] # list of [a, b, ISa, ISa0, filename]
-    for l in open(lpin):
+    for l in _lines(lpin):
         if "a        b          ISa    ISa0   INPUT DATA SET" in l:
             read_flag = True
         elif read_flag:
@@ -135,7 +142,7 @@ def get_rfactors_for_each(lpin):
     read_flag = False
     filename = None
     ret = collections.OrderedDict() # {filename: list of [dmin, Robs, Rexpt, Compared]}
-    for l in open(lpin):
+    for l in _lines(lpin):
         if "R-FACTORS FOR INTENSITIES OF DATA SET" in l:
             filename = l.strip().split()[-1]
         elif "LIMIT      observed   expected" in l:
@@ -156,7 +163,7 @@ def get_rfactors_for_each(lpin):
 def snip_symm_and_cell(lpin):
     s = ""
     read_flag = False
-    for l in open(lpin):
+    for l in _lines(lpin):
         if "THE DATA COLLECTION STATISTICS REPORTED BELOW ASSUMES:" in l:
             read_flag = True
         elif read_flag:
@@ -169,7 +176,7 @@ def snip_symm_and_cell(lpin):
 def snip_stats_table(lpin):
     s = ""
     read_flag = False
-    for l in open(lpin):
+    for l in _lines(lpin):
         if "SUBSET OF INTENSITY DATA WITH SIGNAL/NOISE >= -3.0 AS FUNCTION OF RESOLUTION" in l:
             read_flag = True
 
@@ -210,10 +217,38 @@ def read_stats_table(lpin):
     return table
 # read_stats_table()
 
+class XscaleLp:
+    """
+    All known sections of XSCALE.LP, read at once.
+    Use parse_cached() to avoid reading the same file again.
+    """
+    def __init__(self, lpin):
+        lines = open(lpin).readlines()
+
+        self.pairwise_correlations = get_pairwise_correlations(lines)
+        self.no_common_ref_datasets = read_no_common_ref_datasets(lines)
+        self.read_data = get_read_data(lines)
+        self.k_b = get_k_b(lines)
+        self.ISa = get_ISa(lines)
+        self.rfactors_for_each = get_rfactors_for_each(lines)
+        self.symm_and_cell = snip_symm_and_cell(lines)
+        self.stats_table_snip = snip_stats_table(lines)
+        try:
+            self.stats_table = read_stats_table(lines)
+        except AssertionError:
+            self.stats_table = None # unexpected table format. Callers using it must check.
+        self.control_cards = read_control_cards(lines)
+    # __init__()
+# class XscaleLp
+
+def parse_cached(lpin):
+    return parsecache.load_parsed(lpin, XscaleLp, tag="xscalelp1")
+# parse_cached()
+
 def snip_control_cards(lpin):
     ret = ""
     read_flag = False
-    for l in open(lpin):
+    for l in _lines(lpin):
         if "CONTROL CARDS" in l:
             read_flag = True
         elif read_flag:
@@ -247,7 +282,7 @@ def cbf_to_dat(lpin):
     ofs_dec = open(os.path.join(lpdir, "corfac_decay.dat"), "w")
     ofs_dec.write("file ix xmin xmax iy ymin ymax fac\n")
 
-    for l in open(lpin):
+    for l in _lines(lpin):
         if l.startswith(" CORRECTION FACTORS for visual inspection"):
             filename = l.split()[-1]
         elif l.startswith(" NUMBER OF REFLECTIONS USED FOR DETERMINING"):
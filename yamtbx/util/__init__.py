@@ -5,10 +5,14 @@ Author: Keitaro Yamashita
 This software is released under the new BSD License; see LICENSE.
 """
 import os
+import errno
 import sys
 import re
 import shutil
+import time
+import signal
 import subprocess
+import threading
 import commands
 import glob
 import tempfile
@@ -17,18 +21,26 @@ from libtbx.utils import null_out
 def call(cmd, arg="",
          stdin=None, stdout=subprocess.PIPE,
          wdir=None,
-         expects_in=[], expects_out=[]):
+         expects_in=[], expects_out=[],
+         env=None, timeout=None, cancel_event=None, stats=None):
 
     ##
     # call the external program using subprocess.
+    # The working directory of this process is not changed, so this can be called from multiple threads.
     #
+    # @param stdout subprocess.PIPE (output is returned), file object or file name (output is written there)
     # @param expects_in expected files before running
     # @param expects_out expected files after running
+    # @param env dict of environment variables added to (a copy of) os.environ for the program
+    # @param timeout in seconds. The program (and its children) are killed after this.
+    # @param cancel_event threading.Event. The program is killed when it is set.
+    # @param stats dict; wall_time, user_time, sys_time (sec) and max_rss_mb (of the program and its children) are set.
     #
     # expected_in/out must be written as relative path from wdir or absolute path.
     #
 
     def check_exist(files):
+        files = [os.path.join(wdir, f) for f in files]
         is_exist = [os.path.isfile(f) for f in files]
 
         if sum(is_exist) != len(is_exist):
@@ -40,30 +52,105 @@ def call(cmd, arg="",
     if wdir is None:
         wdir = os.getcwd()
 
-    # Go to working directory
-    cwd = os.getcwd()
-    os.chdir(wdir)
-
     # check before run
     check_exist(expects_in)
 
-    # call the program
+    child_env = None
+    if env is not None:
+        child_env = os.environ.copy()
+        child_env.update(env)
+
+    ofs = open(stdout, "a") if isinstance(stdout, basestring) else stdout
+
+    # call the program. close_fds is needed to avoid other threads' children holding our pipes.
+    # The program is put in its own process group (not session) so that it can be killed with all its children.
+    # NOTE: preexec_fn runs in the forked child before exec. os.setpgrp is a single C call taking no python-level
+    #       locks, but python2 subprocess still runs it as python code in the child, which is not guaranteed to be
+    #       safe when other threads are running (e.g. call() from a thread pool).
+    t_start = time.time()
     p = subprocess.Popen("%s %s" % (cmd, arg),
                          shell=True,
+                         cwd=wdir,
+                         env=child_env,
+                         close_fds=True,
+                         preexec_fn=os.setpgrp, # to kill all processes started by the shell
                          stdin=subprocess.PIPE,
-                         stdout=stdout,
-                         stderr=stdout
+                         stdout=ofs,
+                         stderr=ofs
                          )
 
-    if stdin is not None:
-        p.stdin.write(stdin)    
+    # Pipes are read in threads so that the program never blocks
+    outputs = {}
+    def read_pipe(key, pipe): outputs[key] = pipe.read()
+    def write_stdin():
+        try:
+            if stdin is not None: p.stdin.write(stdin)
+            p.stdin.close()
+        except IOError: # program finished without reading
+            pass
 
-    if stdout == subprocess.PIPE:
-        out, err = p.communicate()
-    else:
-        out, err = None, None
-        p.stdin.close()
-        p.wait()
+    threads = [threading.Thread(target=write_stdin)]
+    if ofs == subprocess.PIPE:
+        threads.append(threading.Thread(target=read_pipe, args=("out", p.stdout)))
+        threads.append(threading.Thread(target=read_pipe, args=("err", p.stderr)))
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    # wait4() instead of wait() to get resource usage of the program
+    killed = None
+    interval = 0.01
+    try:
+        try:
+            while True:
+                if timeout is None and cancel_event is None:
+                    # Nothing to watch; just block until the program finishes.
+                    try:
+                        pid, status, rusage = os.wait4(p.pid, 0)
+                    except OSError, e:
+                        if e.errno == errno.EINTR: continue
+                        raise
+                    break
+
+                pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+                if pid != 0: break
+
+                if killed is None:
+                    if timeout is not None and time.time() - t_start > timeout: killed = "timeout"
+                    elif cancel_event is not None and cancel_event.is_set(): killed = "cancelled"
+                    if killed is not None:
+                        print >>sys.stderr, cmd, ":", killed, "; killing"
+                        _kill_process_group(p.pid, signal.SIGTERM)
+                        t_killed = time.time()
+                elif time.time() - t_killed > 5:
+                    _kill_process_group(p.pid, signal.SIGKILL)
+
+                time.sleep(interval)
+                interval = min(interval * 2, 0.2)
+        except BaseException:
+            # e.g. KeyboardInterrupt. The program is not in our process group, so it must be killed here.
+            print >>sys.stderr, cmd, ": interrupted; killing"
+            _kill_process_group(p.pid, signal.SIGTERM)
+            for i in xrange(50):
+                if os.waitpid(p.pid, os.WNOHANG)[0] != 0: break
+                time.sleep(0.1)
+            else:
+                _kill_process_group(p.pid, signal.SIGKILL)
+                os.waitpid(p.pid, 0)
+            _kill_process_group(p.pid, signal.SIGKILL) # remaining children, if any
+            raise
+
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        if killed is not None: _kill_process_group(p.pid, signal.SIGKILL) # remaining children, if any
+
+        for t in threads: t.join()
+    finally:
+        if ofs is not stdout: ofs.close()
+
+    if stats is not None:
+        stats.update(wall_time=time.time() - t_start,
+                     user_time=rusage.ru_utime, sys_time=rusage.ru_stime,
+                     max_rss_mb=rusage.ru_maxrss / 1024.) # kB on Linux
 
     if p.returncode < 0:
         print >>sys.stderr, cmd, ": returncode is", p.returncode
@@ -71,12 +158,16 @@ def call(cmd, arg="",
     # check after run
     check_exist(expects_out)
 
-    # go back to the previous working directory
-    os.chdir(cwd)
-
-    return p.returncode, out, err
+    return p.returncode, outputs.get("out"), outputs.get("err")
 # call()
 
+def _kill_process_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError: # already finished
+        pass
+# _kill_process_group()
+
 def rotate_file(filename, copy=False):
     """
     Rotate file like logrotate.
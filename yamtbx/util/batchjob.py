@@ -36,6 +36,10 @@ echo
 echo finished at `date "+%Y-%m-%d %H:%M:%S"`
 """
 
+# Number of cores assigned when the job is started by LocalThread with max_cores.
+# Scripts can use this instead of Job.nproc given at submission.
+nproc_env_name = "YAMTBX_JOB_NPROC"
+
 class SgeError(Exception):
     pass
 
@@ -57,11 +61,12 @@ class JobManager: # interface
     # wait_all()
 # class JobManager
 class LocalThread(threading.Thread):
-    def __init__(self, num_jobs):
+    def __init__(self, num_jobs, max_cores=None):
         self._stopevent = threading.Event()
         self._sleepperiod = 1.0
 
         self.num_jobs = num_jobs
+        self.max_cores = max_cores # if given, jobs are started while cores are free, with up to Job.nproc cores
         self.waiting_jobs = [] # [Job, ...]
         self.p_list = [] # running process list [(Job, subprocess.Popen), ..]
 
@@ -69,10 +74,12 @@ class LocalThread(threading.Thread):
     # __init__()
 
     def start_job(self, j):
+        env = os.environ.copy()
+        env[nproc_env_name] = str(j.nproc)
         p = subprocess.Popen(os.path.join(".", j.script_name), shell=True, cwd=j.wdir,
                              stdout=open(os.path.join(j.wdir, j.script_name + ".out"), "w"),
                              stderr=open(os.path.join(j.wdir, j.script_name + ".err"), "w"),
-                             )
+                             env=env)
         return p
     # start_job()
     
@@ -90,6 +97,13 @@ class LocalThread(threading.Thread):
             for i in range(self.num_jobs - len(self.p_list)):
                 # Start conversion
                 if len(self.waiting_jobs) > 0:
+                    if self.max_cores is not None:
+                        # Backfill: start with free cores rather than waiting for all requested cores.
+                        # Job.nproc is updated to the number of assigned cores.
+                        free = self.max_cores - sum(map(lambda x: x[0].nproc, self.p_list))
+                        if free < 1: break
+                        self.waiting_jobs[0].nproc = max(1, min(self.waiting_jobs[0].nproc, free))
+
                     j = self.waiting_jobs.pop(0)
                     self.p_list.append( (j, self.start_job(j)) )
                     j.state = STATE_RUNNING
@@ -111,10 +125,10 @@ class LocalThread(threading.Thread):
  
 class ExecLocal(JobManager):
        
-    def __init__(self, max_parallel):
+    def __init__(self, max_parallel, max_cores=None):
         JobManager.__init__(self)
         self.num_jobs = max_parallel # referred by control tower when pickling
-        self._thread = LocalThread(num_jobs=self.num_jobs)
+        self._thread = LocalThread(num_jobs=self.num_jobs, max_cores=max_cores)
         self._thread.start()
         
     # __init__()
@@ -275,7 +289,7 @@ class Job:
                     env += ":".join(map(lambda x: '"%s"'%x, filter(lambda x: os.path.isdir(x), sh)))
                     env += "\n"
                 else:
-                    if re_allowed_env.match(k):
+                    if re_allowed_env.match(k) and k != nproc_env_name:
                         env += 'export %s="%s"\n' % (k, os.environ[k].replace('"', r'\"'))
                 
             env += "\n"
@@ -0,0 +1,143 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Timing and memory measurement for benchmarks.
+
+Each measurement is done in a forked child process, because peak RSS
+(ru_maxrss) never decreases within a process and one case should not affect
+others. Results are dicts like
+ dict(case=, scale=, items=, unit=, seconds=, throughput=, peak_rss_mb=, rss_start_mb=, children_peak_rss_mb=)
+and can be saved as JSON and compared with a baseline saved before.
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import traceback
+import cPickle as pickle
+
+def current_rss_mb():
+    try:
+        return int(open("/proc/self/statm").read().split()[1]) * resource.getpagesize() / 1024.**2
+    except (IOError, IndexError, ValueError):
+        return float("nan")
+# current_rss_mb()
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux (bytes on Mac)
+    scale = 1024.**2 if sys.platform == "darwin" else 1024.
+    return resource.getrusage(who).ru_maxrss / scale
+# peak_rss_mb()
+
+def _measure_here(func, args, kwds, repeat):
+    ret = dict(rss_start_mb=current_rss_mb())
+    times = []
+    for i in xrange(repeat):
+        t0 = time.time()
+        items = func(*args, **kwds)
+        times.append(time.time() - t0)
+
+    ret["seconds"] = min(times)
+    ret["items"] = items
+    ret["throughput"] = items/ret["seconds"] if items is not None and ret["seconds"] > 0 else None
+    ret["peak_rss_mb"] = peak_rss_mb()
+    ret["children_peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return ret
+# _measure_here()
+
+def measure(func, args=(), kwds={}, repeat=1, fork=True):
+    """
+    func(*args, **kwds) should return the number of processed items (e.g. reflections or frames), or None.
+    Best time of repeat runs is taken.
+    Returns dict of seconds, items, throughput (items/sec), peak_rss_mb, rss_start_mb, children_peak_rss_mb;
+    or dict(error=traceback string) if func raised an exception.
+    """
+    if not fork or not hasattr(os, "fork"):
+        try:
+            return _measure_here(func, args, kwds, repeat)
+        except:
+            return dict(error=traceback.format_exc())
+
+    sys.stdout.flush()
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0: # child
+        os.close(rfd)
+        try:
+            ret = _measure_here(func, args, kwds, repeat)
+        except:
+            ret = dict(error=traceback.format_exc())
+        ofs = os.fdopen(wfd, "wb")
+        pickle.dump(ret, ofs, -1)
+        ofs.close()
+        sys.stdout.flush()
+        os._exit(0)
+
+    os.close(wfd)
+    ifs = os.fdopen(rfd, "rb")
+    data = ifs.read()
+    ifs.close()
+    os.waitpid(pid, 0)
+
+    if not data: return dict(error="measurement process died")
+    return pickle.loads(data)
+# measure()
+
+def save_results(results, jsonout):
+    json.dump(results, open(jsonout, "w"), indent=1)
+# save_results()
+
+def load_results(jsonin):
+    return json.load(open(jsonin))
+# load_results()
+
+def compare_with_baseline(results, baseline, tolerance=0.2):
+    """
+    Adds time_ratio, rss_ratio (to baseline) and status ("slower", "faster", "same", "new" or "error")
+    to each result. Results are matched by (case, scale).
+    """
+    base = dict(map(lambda x: ((x["case"], x["scale"]), x), baseline))
+    for r in results:
+        b = base.get((r["case"], r["scale"]))
+        r["time_ratio"], r["rss_ratio"] = None, None
+        if "error" in r or "skipped" in r:
+            r["status"] = "error" if "error" in r else "skipped"
+            continue
+        if b is None or not b.get("seconds"):
+            r["status"] = "new"
+            continue
+
+        r["time_ratio"] = r["seconds"] / b["seconds"]
+        if b.get("peak_rss_mb"): r["rss_ratio"] = r["peak_rss_mb"] / b["peak_rss_mb"]
+
+        if r["time_ratio"] > 1. + tolerance: r["status"] = "slower"
+        elif r["time_ratio"] < 1. / (1. + tolerance): r["status"] = "faster"
+        else: r["status"] = "same"
+
+    return results
+# compare_with_baseline()
+
+def show_results(results, out=sys.stdout):
+    print >>out, "%-20s %6s %10s %10s %14s %10s %8s %8s" % ("case", "scale", "items", "seconds", "throughput",
+                                                         "peakRSS/MB", "t/base", "status")
+    for r in results:
+        if "error" in r or "skipped" in r:
+            print >>out, "%-20s %6s %s" % (r["case"], r["scale"],
+                                           "ERROR" if "error" in r else "skipped: %s" % r["skipped"])
+            continue
+
+        print >>out, "%-20s %6s %10s %10.3f %14s %10.1f %8s %8s" % (r["case"], r["scale"],
+                                                                    r["items"] if r["items"] is not None else "-",
+                                                                    r["seconds"],
+                                                                    "%.1f %s/s" % (r["throughput"], r.get("unit", ""))
+                                                                    if r["throughput"] is not None else "-",
+                                                                    r["peak_rss_mb"],
+                                                                    "%.2f" % r["time_ratio"] if r.get("time_ratio") else "-",
+                                                                    r.get("status", ""))
+# show_results()
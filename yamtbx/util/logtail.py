@@ -0,0 +1,101 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Incremental reading of growing log files.
+
+LogTail remembers, for each file, the byte offset of the data already read,
+the number of lines read and the identity (device and inode) of the file,
+and keeps the file open. read() seeks to the offset and returns only new
+complete lines; an incomplete last line is left until its newline is
+written. The position is advanced only by commit(), so lines are read again
+if the caller failed to process them.
+
+When the file was rotated (the path now points to another inode), the rest
+of the old file is returned first (as continuation of the old file), and
+after it is committed, the new file is read from the beginning. When the
+file was truncated, reading starts from the beginning again.
+"""
+
+import os
+
+class _State:
+    def __init__(self, path):
+        self.ifs = open(path, "rb")
+        st = os.fstat(self.ifs.fileno())
+        self.ident = (st.st_dev, st.st_ino)
+        self.offset = 0
+        self.lineno = 0
+        self.pending = None # (offset, lineno) after the lines returned by read()
+    # __init__()
+
+    def read_complete_lines(self, offset, lineno):
+        self.ifs.seek(offset)
+        data = self.ifs.read()
+        end = data.rfind("\n") + 1
+        lines = map(lambda x: x+"\n", data[:end-1].split("\n")) if end > 0 else []
+        self.pending = (offset + end, lineno + len(lines))
+        return lines
+    # read_complete_lines()
+# class _State
+
+class LogTail:
+    def __init__(self):
+        self.states = {} # path -> _State
+    # __init__()
+
+    def read(self, path):
+        """
+        Returns (restarted, first_lineno, lines). Call commit(path) after the lines are processed.
+        restarted: True if lines are from the beginning of file (first read, new file after rotation, or truncated).
+        first_lineno: 0-based line number of lines[0] in the file.
+        Lines are always from one file; the rest of the rotated file is returned before the new file.
+        """
+        state = self.states.get(path)
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+
+        if state is None:
+            if st is None: return True, 0, []
+            state = self.states[path] = _State(path)
+            return True, 0, state.read_complete_lines(0, 0)
+
+        if st is not None and (st.st_dev, st.st_ino) != state.ident:
+            # Rotated. Rest of the old file first, and then the new one.
+            lines = state.read_complete_lines(state.offset, state.lineno)
+            if lines: return False, state.lineno, lines
+
+            self.forget(path)
+            state = self.states[path] = _State(path)
+            return True, 0, state.read_complete_lines(0, 0)
+
+        if os.fstat(state.ifs.fileno()).st_size < state.offset:
+            # Truncated
+            return True, 0, state.read_complete_lines(0, 0)
+
+        return False, state.lineno, state.read_complete_lines(state.offset, state.lineno)
+    # read()
+
+    def commit(self, path):
+        """
+        Mark the lines returned by the last read(path) as processed.
+        """
+        state = self.states.get(path)
+        if state is None or state.pending is None: return
+        state.offset, state.lineno = state.pending
+        state.pending = None
+    # commit()
+
+    def forget(self, path):
+        state = self.states.pop(path, None)
+        if state is not None: state.ifs.close()
+    # forget()
+
+    def paths(self): return self.states.keys()
+# class LogTail
@@ -101,3 +101,48 @@ def weighted_correlation_coefficient(x, y, w):
         return weighted_correlation_coefficient(numpy.array(x), numpy.array(y), numpy.array(w))
 
 # weighted_correlation_coefficient()
+
+def pack_hkl(indices):
+    """
+    Encode miller indices into int64 keys that can be sorted and searched.
+    indices: flex.miller_index or numpy array of shape (n,3). |h|,|k|,|l| must be < 2**20.
+    """
+    if isinstance(indices, flex.miller_index):
+        indices = indices.as_vec3_double().as_double().as_numpy_array().reshape(-1, 3)
+
+    hkl = numpy.asarray(indices).astype(numpy.int64) + 2**20
+    return (hkl[:,0] << 42) | (hkl[:,1] << 21) | hkl[:,2]
+# pack_hkl()
+
+def linear_correlation(x, y):
+    """
+    Same as flex.linear_correlation(x, y).coefficient() for numpy arrays; nan if not well defined.
+    """
+    if len(x) < 1: return float("nan")
+    dx, dy = x - x.mean(), y - y.mean()
+    denom = numpy.sqrt(numpy.sum(dx**2) * numpy.sum(dy**2))
+    if denom == 0: return float("nan")
+    return float(numpy.sum(dx*dy) / denom)
+# linear_correlation()
+
+def grouped_linear_correlation(group, x, y, ngroups):
+    """
+    Correlation coefficients between x and y for each group at once.
+    group: int array of group ids (0 <= id < ngroups) for each element of x and y.
+    Returns (n, cc) arrays of size ngroups. cc is nan if not well defined.
+    """
+    n = numpy.bincount(group, minlength=ngroups)
+    nf = numpy.maximum(n, 1).astype(numpy.float64)
+    mx = numpy.bincount(group, weights=x, minlength=ngroups) / nf
+    my = numpy.bincount(group, weights=y, minlength=ngroups) / nf
+    dx, dy = x - mx[group], y - my[group]
+    sxy = numpy.bincount(group, weights=dx*dy, minlength=ngroups)
+    denom = numpy.sqrt(numpy.bincount(group, weights=dx**2, minlength=ngroups) *
+                       numpy.bincount(group, weights=dy**2, minlength=ngroups))
+
+    cc = numpy.empty(ngroups)
+    cc.fill(float("nan"))
+    ok = denom > 0
+    cc[ok] = sxy[ok] / denom[ok]
+    return n, cc
+# grouped_linear_correlation()
@@ -0,0 +1,155 @@
+"""
+(c) RIKEN 2015. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+"""
+Caches of parsed results of (log) files.
+
+load_parsed(): the parsed object is pickled next to the original file (or
+in cache_dir) together with the absolute path, mtime and size of the source
+file, and is reused only when all of them match.
+
+MtimeLruCache: size-bounded in-memory cache validated by mtime, which can be
+saved to and loaded from a single pickle file.
+"""
+
+import os
+import collections
+import threading
+import tempfile
+import cPickle as pickle
+
+def file_stamp(filename):
+    st = os.stat(filename)
+    return st.st_mtime, st.st_size
+# file_stamp()
+
+def cache_filename(filename, tag, cache_dir=None):
+    if cache_dir is None: cache_dir = os.path.dirname(os.path.abspath(filename))
+    return os.path.join(cache_dir, ".%s.%s.pkl" % (os.path.basename(filename), tag))
+# cache_filename()
+
+def _dump_atomic(obj, pklout):
+    # Write to a unique temporary file and rename, so that other processes and threads never read
+    # partial files nor write to the same temporary file.
+    fd, tmpf = tempfile.mkstemp(prefix=os.path.basename(pklout)+".", suffix=".tmp", dir=os.path.dirname(pklout))
+    try:
+        os.chmod(tmpf, 0644) # mkstemp() makes it 0600, but cache may be shared with other users
+        with os.fdopen(fd, "wb") as ofs:
+            pickle.dump(obj, ofs, -1)
+        os.rename(tmpf, pklout)
+    except:
+        if os.path.exists(tmpf): os.remove(tmpf)
+        raise
+# _dump_atomic()
+
+def load_parsed(filename, parser, tag, cache_dir=None):
+    """
+    Returns parser(filename), using cache if the file is not modified.
+    tag should be changed when the format of parsed object is changed.
+    """
+    abspath = os.path.abspath(filename)
+    stamp = file_stamp(abspath)
+    cachef = cache_filename(abspath, tag, cache_dir)
+
+    if os.path.isfile(cachef):
+        try:
+            cached = pickle.load(open(cachef, "rb"))
+            if cached["path"] == abspath and cached["stamp"] == stamp:
+                return cached["obj"]
+        except:
+            pass # Broken or incompatible cache. Just parse again.
+
+    obj = parser(abspath)
+
+    try:
+        _dump_atomic(dict(path=abspath, stamp=stamp, obj=obj), cachef)
+    except (IOError, OSError):
+        pass # e.g. read-only directory. Cache is not mandatory.
+
+    return obj
+# load_parsed()
+
+def _same_entry(a, b):
+    # nan != nan, but putting the same nan again should not mark the cache modified
+    if a is None or b is None: return a is b
+    if a[0] != b[0]: return False
+    if a[1] is b[1]: return True
+    if isinstance(a[1], float) and isinstance(b[1], float) and a[1] != a[1] and b[1] != b[1]: return True
+    return a[1] == b[1]
+# _same_entry()
+
+class MtimeLruCache:
+    """
+    Thread-safe LRU cache of objects made from files. {(key, filename): (mtime, obj)}
+    An entry is valid only when the file's mtime is unchanged.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._modified = False
+    # __init__()
+
+    def __len__(self): return len(self._data)
+
+    def put(self, key, filename, obj, mtime=None):
+        if mtime is None: mtime = os.path.getmtime(filename)
+
+        with self._lock:
+            old = self._data.pop((key, filename), None)
+            self._data[(key, filename)] = (mtime, obj)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False) # least recently used
+            if not _same_entry(old, (mtime, obj)): self._modified = True
+    # put()
+
+    def get(self, key, filename, mtime=None):
+        """
+        mtime: if given, compared instead of the file's mtime (any comparable stamp, like in put()).
+        """
+        with self._lock:
+            if (key, filename) not in self._data: return None
+
+            if mtime is None:
+                if not os.path.isfile(filename):
+                    return None
+                mtime = os.path.getmtime(filename)
+
+            last_mtime, obj = self._data.pop((key, filename))
+            if last_mtime != mtime:
+                self._modified = True # stale entry is dropped
+                return None
+
+            self._data[(key, filename)] = (last_mtime, obj) # most recently used
+            return obj
+    # get()
+
+    def save(self, pklout, only_if_modified=True):
+        with self._lock:
+            if only_if_modified and not self._modified: return
+            items = self._data.items()
+            self._modified = False
+
+        _dump_atomic(items, os.path.abspath(pklout))
+    # save()
+
+    def load(self, pklin):
+        """
+        Entries are validated when used. Broken file is just ignored.
+        """
+        try:
+            items = pickle.load(open(pklin, "rb"))
+        except:
+            return False
+
+        with self._lock:
+            for k, v in items[-self.maxsize:]:
+                self._data[k] = v
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return True
+    # load()
+# class MtimeLruCache